@@ -2,10 +2,14 @@
 from django.conf.urls.defaults import *
 from django.contrib.admin.views.decorators import staff_member_required
 
-from django_lean.experiments.views import experiment_details, list_experiments
+from django_lean.experiments.views import (experiment_details,
+                                           export_reports, list_experiments,
+                                           live_experiment)
 
 
 urlpatterns = patterns('django_lean.experiments.views',
+    url(r'^export\.(?P<format>csv|json)$', staff_member_required(export_reports), name="experiments_export_reports"),
+    url(r'^(?P<experiment_name>.+)/live/$', staff_member_required(live_experiment), name="experiments_live_experiment"),
     url(r'^(?P<experiment_name>.+)/$', staff_member_required(experiment_details), name="experiments_experiment_details"),
     url(r'^$', staff_member_required(list_experiments), name="experiments_list_experiments")
 )
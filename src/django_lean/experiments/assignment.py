@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import logging
+l = logging.getLogger(__name__)
+
+import random
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+from django.conf import settings
+from django.core.urlresolvers import get_callable
+
+
+DEFAULT_ASSIGNMENT = 'django_lean.experiments.assignment.RandomAssignment'
+
+
+def get_assignment():
+    """
+    Returns the group assignment strategy named by LEAN_GROUP_ASSIGNMENT.
+    """
+    return get_callable(getattr(settings, 'LEAN_GROUP_ASSIGNMENT',
+                                DEFAULT_ASSIGNMENT))()
+
+def get_user_identity(user_id):
+    return 'user:%s' % user_id
+
+def get_anonymous_identity(anonymous_id):
+    return 'anonymous:%s' % anonymous_id
+
+
+class BaseAssignment(object):
+    """
+    Assigns experiment users to the test or control group.
+
+    The share of users assigned to the test group defaults to one half, and
+    may be configured per experiment name with LEAN_TEST_GROUP_RATIOS:
+
+    LEAN_TEST_GROUP_RATIOS = {'my_experiment': 0.1}
+    """
+    # When True, assign() always returns the same group for the same
+    # experiment and identity, so stored enrollments are only an audit record.
+    deterministic = False
+
+    def get_test_ratio(self, experiment):
+        ratios = getattr(settings, 'LEAN_TEST_GROUP_RATIOS', {})
+        return ratios.get(experiment.name, 0.5)
+
+    def get_group(self, experiment, value):
+        """Maps `value`, in the range [0, 1), to a group."""
+        from django_lean.experiments.models import Participant
+        if value < self.get_test_ratio(experiment):
+            return Participant.TEST_GROUP
+        return Participant.CONTROL_GROUP
+
+    def assign(self, experiment, identity):
+        """
+        Returns the group for the user with the given identity, which is None
+        for users that have not been identified yet.
+        """
+        raise NotImplementedError()
+
+
+class RandomAssignment(BaseAssignment):
+    """Assigns groups at random; the stored enrollment is authoritative."""
+    def assign(self, experiment, identity):
+        return self.get_group(experiment, random.random())
+
+
+class HashAssignment(BaseAssignment):
+    """
+    Assigns groups from a stable hash of the experiment name, a salt
+    (LEAN_GROUP_ASSIGNMENT_SALT) and the user's identity, so that the group
+    can be recomputed without reading the user's enrollment back.
+
+    Users without an identity (visitors who have not been confirmed as
+    human) are assigned at random, and reassigned from their anonymous
+    visitor once they are confirmed.
+    """
+    deterministic = True
+
+    def get_salt(self):
+        return getattr(settings, 'LEAN_GROUP_ASSIGNMENT_SALT', '')
+
+    def assign(self, experiment, identity):
+        if identity is None:
+            return self.get_group(experiment, random.random())
+        key = u':'.join((self.get_salt(), experiment.name, identity))
+        digest = md5(key.encode('utf-8')).hexdigest()
+        return self.get_group(experiment, int(digest[:15], 16) / 16. ** 15)
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+import logging
+l = logging.getLogger(__name__)
+
+import random
+import time
+from datetime import date
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+class ExperimentCache(object):
+    """
+    In-process cache of experiment definitions, keyed by experiment name.
+
+    The whole experiment table is loaded with a single query the first time
+    an experiment is looked up, and again once the cache has expired or has
+    been invalidated. Set LEAN_EXPERIMENT_CACHE_TIMEOUT to the number of
+    seconds an experiment definition may be served from memory; the cache is
+    disabled by default.
+
+    With LEAN_EXPERIMENT_SHARED_CACHE enabled, the experiment table is also
+    published to the Django cache backend under a version stamp. Saving an
+    experiment in any process publishes a new stamp; other processes check
+    the stamp whenever their in-process copy expires and only reload the
+    table when it has changed. The published table itself expires after
+    LEAN_EXPERIMENT_SHARED_CACHE_TIMEOUT seconds, which bounds how long a
+    table read before a state change was committed can be served.
+
+    The cached Experiment instances are shared between callers and must be
+    treated as read-only.
+    """
+    VERSION_KEY = 'django_lean.experiments.version'
+    TABLE_KEY = 'django_lean.experiments.table.%s'
+    VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+    def __init__(self):
+        self._version = None
+        self._experiments = None
+        self._expires = 0
+
+    def get_timeout(self):
+        return getattr(settings, 'LEAN_EXPERIMENT_CACHE_TIMEOUT', 0) or 0
+
+    def is_enabled(self):
+        return self.get_timeout() > 0
+
+    def is_shared(self):
+        return getattr(settings, 'LEAN_EXPERIMENT_SHARED_CACHE', False)
+
+    def get_shared_timeout(self):
+        return getattr(settings, 'LEAN_EXPERIMENT_SHARED_CACHE_TIMEOUT', 300)
+
+    def get(self, name):
+        """
+        Returns the experiment named `name`.
+        Raises Experiment.DoesNotExist if there is no such experiment.
+        """
+        from django_lean.experiments.models import Experiment
+        if not self.is_enabled():
+            return Experiment.objects.get(name=name)
+
+        experiments = self._experiments
+        if experiments is None or time.time() >= self._expires:
+            experiments = self._refresh()
+        try:
+            return experiments[name]
+        except KeyError:
+            raise Experiment.DoesNotExist("Experiment matching query does "
+                                          "not exist.")
+
+    def invalidate(self):
+        """
+        Forgets all cached experiments, and tells other processes to do the
+        same if the shared cache is enabled.
+        """
+        self._experiments = None
+        self._expires = 0
+        if self.is_shared():
+            cache.set(self.VERSION_KEY, uuid4().hex, self.VERSION_TIMEOUT)
+
+    def _load(self):
+        from django_lean.experiments.models import Experiment
+        return list(Experiment.objects.values_list('id', 'name', 'state',
+                                                   'start_date', 'end_date'))
+
+    def _refresh(self):
+        if not self.is_shared():
+            return self._reload(self._load())
+
+        version = self._version
+        table_key = self.TABLE_KEY % version
+        values = cache.get_many([self.VERSION_KEY, table_key])
+        current = values.get(self.VERSION_KEY)
+        if current is None:
+            cache.add(self.VERSION_KEY, uuid4().hex, self.VERSION_TIMEOUT)
+            current = cache.get(self.VERSION_KEY)
+
+        if current == version and table_key in values:
+            if self._experiments is not None:
+                # Nothing changed since our last reload.
+                self._expires = time.time() + self.get_timeout()
+                return self._experiments
+            table = values[table_key]
+        else:
+            table = cache.get(self.TABLE_KEY % current)
+        if table is None:
+            table = self._load()
+            cache.set(self.TABLE_KEY % current, table,
+                      self.get_shared_timeout())
+        self._version = current
+        return self._reload(table)
+
+    def _reload(self, table):
+        from django_lean.experiments.models import Experiment
+        experiments = {}
+        for (id, name, state, start_date, end_date) in table:
+            experiments[name] = Experiment(id=id, name=name, state=state,
+                                           start_date=start_date,
+                                           end_date=end_date)
+        self._experiments = experiments
+        self._expires = time.time() + self.get_timeout()
+        return experiments
+
+
+class GoalTypeCache(object):
+    """
+    In-process cache of goal types, keyed by name.
+
+    Goal types are only ever added, so the table is reloaded when an unknown
+    name is requested, at most once every MISS_INTERVAL seconds.
+    """
+    MISS_INTERVAL = 10
+
+    def __init__(self):
+        self.invalidate()
+
+    def get(self, name, create=False):
+        """
+        Returns the goal type named `name`, creating it if `create` is True.
+        Raises GoalType.DoesNotExist if there is no such goal type.
+        """
+        from django_lean.experiments.models import GoalType
+        goal_types = self._goal_types
+        if name not in goal_types and time.time() >= self._next_reload:
+            goal_types = self._reload()
+        if name not in goal_types:
+            if not create:
+                raise GoalType.DoesNotExist("GoalType matching query does "
+                                            "not exist.")
+            goal_type, created = GoalType.objects.get_or_create(name=name)
+            goal_types[name] = goal_type
+        return goal_types[name]
+
+    def invalidate(self):
+        self._goal_types = {}
+        self._next_reload = 0
+
+    def _reload(self):
+        from django_lean.experiments.models import GoalType
+        goal_types = dict((g.name, g) for g in GoalType.objects.all())
+        self._goal_types = goal_types
+        self._next_reload = time.time() + self.MISS_INTERVAL
+        return goal_types
+
+
+class ReportCache(object):
+    """
+    Caches the data displayed for the daily conversion and engagement
+    reports of finished days in the Django cache backend, keyed by
+    experiment, date and kind of report.
+
+    Reports of past days are only written once, so their data is served
+    from the cache until the report is regenerated: saving or deleting a
+    report, or storing reports with create_reports(), invalidates the
+    entries of its date. Set LEAN_REPORT_CACHE_TIMEOUT to the number of
+    seconds entries may be kept; the cache is disabled by default.
+
+    Conversion data lists every goal type, so the entries are stored with a
+    goal types version stamp, and creating a goal type makes them stale.
+    """
+    CONVERSION = 'conversion'
+    ENGAGEMENT = 'engagement'
+
+    GOAL_TYPES_KEY = 'django_lean.reports.goal_types'
+    KEY = 'django_lean.reports.%s.%s.%s'
+
+    def get_timeout(self):
+        return getattr(settings, 'LEAN_REPORT_CACHE_TIMEOUT', 0) or 0
+
+    def is_enabled(self):
+        return self.get_timeout() > 0
+
+    def _key(self, experiment_id, kind, report_date):
+        return self.KEY % (experiment_id, report_date.isoformat(), kind)
+
+    def get(self, experiment_id, dates):
+        """
+        Returns {(kind, date): data} for the entries of the given experiment
+        and dates that are cached.
+        """
+        if not self.is_enabled() or not dates:
+            return {}
+        keys = {}
+        for report_date in dates:
+            for kind in (self.CONVERSION, self.ENGAGEMENT):
+                keys[self._key(experiment_id, kind, report_date)] = (
+                    kind, report_date)
+        values = cache.get_many([self.GOAL_TYPES_KEY] + keys.keys())
+        version = values.pop(self.GOAL_TYPES_KEY, None)
+        if version is None:
+            return {}
+        return dict((keys[key], data)
+                    for key, (entry_version, data) in values.iteritems()
+                    if entry_version == version)
+
+    def set(self, experiment_id, entries):
+        """
+        Caches the {(kind, date): data} entries of the given experiment,
+        leaving out those of days that are not over yet.
+        """
+        if not self.is_enabled():
+            return
+        today = date.today()
+        entries = dict(((kind, report_date), data)
+                       for (kind, report_date), data in entries.iteritems()
+                       if report_date < today and data is not None)
+        if not entries:
+            return
+        cache.add(self.GOAL_TYPES_KEY, uuid4().hex, self.get_timeout())
+        version = cache.get(self.GOAL_TYPES_KEY)
+        cache.set_many(dict((self._key(experiment_id, kind, report_date),
+                             (version, data))
+                            for (kind, report_date), data
+                            in entries.iteritems()),
+                       self.get_timeout())
+
+    def invalidate(self, experiment_id, dates):
+        """Forgets the entries of the given experiment and dates."""
+        if not self.is_enabled():
+            return
+        cache.delete_many([self._key(experiment_id, kind, report_date)
+                           for report_date in dates
+                           for kind in (self.CONVERSION, self.ENGAGEMENT)])
+
+    def invalidate_goal_types(self):
+        """Makes all the cached entries stale."""
+        if not self.is_enabled():
+            return
+        cache.set(self.GOAL_TYPES_KEY, uuid4().hex, self.get_timeout())
+
+
+class LiveCounters(object):
+    """
+    Approximate counters of the day's enrollments and converting visitors
+    per experiment group, kept in the Django cache backend when
+    LEAN_LIVE_COUNTERS is enabled.
+
+    Each counter is split into LEAN_LIVE_COUNTER_SHARDS keys (default 8),
+    one of which is incremented at random, so that the visitors of a busy
+    experiment do not all contend for the same key. Counters expire after
+    TIMEOUT seconds, and are lost whenever the cache backend evicts them.
+    """
+    ENROLLED = 'enrolled'
+    ANY = 'any'
+
+    KEY = 'django_lean.live.%s.%s.%s.%s.%d'
+    TIMEOUT = 60 * 60 * 48
+
+    def is_enabled(self):
+        return getattr(settings, 'LEAN_LIVE_COUNTERS', False)
+
+    def get_shards(self):
+        return getattr(settings, 'LEAN_LIVE_COUNTER_SHARDS', 8)
+
+    def _key(self, day, experiment_id, group, name, shard):
+        return self.KEY % (day.isoformat(), experiment_id, group, name, shard)
+
+    def incr(self, experiment_id, group, name):
+        """
+        Counts one more `name` (ENROLLED, ANY or a goal type id) for the
+        experiment group today.
+        """
+        if not self.is_enabled():
+            return
+        key = self._key(date.today(), experiment_id, group, name,
+                        random.randrange(self.get_shards()))
+        try:
+            cache.incr(key)
+        except ValueError:
+            # The first count of the day on this shard.
+            if not cache.add(key, 1, self.TIMEOUT):
+                try:
+                    cache.incr(key)
+                except ValueError:
+                    l.warning("Unable to increment %s" % key)
+
+    def get(self, experiment_id, groups, names, day=None):
+        """
+        Returns {(group, name): count} for the given groups and names of the
+        experiment on `day` (today by default).
+        """
+        day = day or date.today()
+        keys = {}
+        for group in groups:
+            for name in names:
+                for shard in range(self.get_shards()):
+                    keys[self._key(day, experiment_id, group, name,
+                                   shard)] = (group, name)
+        counts = dict(((group, name), 0) for group in groups
+                      for name in names)
+        for key, count in cache.get_many(keys.keys()).iteritems():
+            counts[keys[key]] += int(count)
+        return counts
+
+
+experiment_cache = ExperimentCache()
+goal_type_cache = GoalTypeCache()
+report_cache = ReportCache()
+live_counters = LiveCounters()
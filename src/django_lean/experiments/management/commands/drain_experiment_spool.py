@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+import logging
+l = logging.getLogger(__name__)
+
+import time
+from fcntl import LOCK_EX
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_lean.experiments.writebehind import drain_spool, get_spool_path
+from django_lean.lockfile import lockfile
+
+
+LOCKFILE = 'drain_experiment_spool.lock'
+
+
+class Command(BaseCommand):
+    """manage.py drain_experiment_spool"""
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--batch-size', type='int', default=1000,
+            help='Number of events to insert at a time.'
+        ),
+        make_option(
+            '--interval', type='int', default=0, metavar='SECONDS',
+            help='Keep draining the spool every SECONDS seconds.'
+        ),
+        make_option(
+            '--wait', action='store_true', default=False,
+            help='Wait for lock.'
+        ),
+    )
+
+    help = ('Writes the goal records and enrollments spooled by the '
+            'SpoolWriter to the database')
+
+    def info(self, message, **options):
+        if int(options.get('verbosity', 1)) >= 1:
+            print message
+
+    def handle(self, *args, **options):
+        if len(args):
+            raise CommandError("This command does not take any arguments")
+        path = get_spool_path()
+        with lockfile(LOCKFILE, LOCK_EX, wait=options['wait']):
+            while True:
+                count = drain_spool(path, batch_size=options['batch_size'])
+                self.info('Drained: %d' % count, **options)
+                if not options['interval']:
+                    break
+                time.sleep(options['interval'])
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+import logging
+l = logging.getLogger(__name__)
+
+import csv
+import gzip
+import sys
+from datetime import date
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import simplejson
+
+from django_lean.experiments.models import Experiment, GoalRecord, Participant
+
+
+# The first field of each table must be its primary key.
+TABLES = {
+    'participants': (
+        ('id', 'group', 'user', 'anonymous_visitor', 'enrollment_date'),
+        ('id', 'group', 'user_id', 'anonymous_visitor_id', 'enrollment_date'),
+    ),
+    'goal_records': (
+        ('id', 'anonymous_visitor', 'goal_type__name', 'created'),
+        ('id', 'anonymous_visitor_id', 'goal_type', 'created'),
+    ),
+}
+
+
+def get_queryset(experiment, table):
+    if table == 'participants':
+        return Participant.objects.filter(experiment=experiment)
+    return GoalRecord.objects.filter(
+        anonymous_visitor__participant__experiment=experiment)
+
+
+def iterate_rows(queryset, fields, after_id=0, batch_size=10000):
+    """
+    Yields the `fields` values of the rows of `queryset` whose primary key
+    is greater than `after_id`, in primary key order. Rows are fetched
+    `batch_size` at a time, seeking past the last key of the previous batch
+    rather than using an OFFSET, so every batch costs the same.
+    """
+    queryset = queryset.order_by('pk').values_list(*fields)
+    while True:
+        rows = list(queryset.filter(pk__gt=after_id)[:batch_size])
+        if not rows:
+            break
+        for row in rows:
+            yield row
+        after_id = rows[-1][0]
+
+
+def _format(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+
+class JSONLinesWriter(object):
+    def __init__(self, output, names):
+        self.output = output
+        self.names = names
+
+    def write(self, row):
+        self.output.write(simplejson.dumps(
+                dict(zip(self.names, [_format(value) for value in row]))))
+        self.output.write('\n')
+
+
+class CSVWriter(object):
+    def __init__(self, output, names):
+        self.writer = csv.writer(output)
+        self.writer.writerow(names)
+
+    def write(self, row):
+        self.writer.writerow([
+                value is not None and unicode(_format(value)).encode('utf-8')
+                or '' for value in row])
+
+
+WRITERS = {'jsonl': JSONLinesWriter, 'csv': CSVWriter}
+
+
+class Command(BaseCommand):
+    """manage.py export_experiment_data <experiment> <table>"""
+
+    args = '<experiment name> <%s>' % '|'.join(sorted(TABLES))
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--format', choices=sorted(WRITERS), default='jsonl',
+            help='Output format: %s. (Default: jsonl)' %
+                 ', '.join(sorted(WRITERS))
+        ),
+        make_option(
+            '--output', default='-', metavar='FILE',
+            help='File to write to. (Default: standard output)'
+        ),
+        make_option(
+            '--gzip', action='store_true', default=False,
+            help='Compress the output with gzip.'
+        ),
+        make_option(
+            '--after-id', type='int', default=0,
+            help='Only export rows with a greater id, to resume an export.'
+        ),
+        make_option(
+            '--batch-size', type='int', default=10000,
+            help='Number of rows to read at a time.'
+        ),
+    )
+
+    help = ('Streams the participants or goal records of an experiment, in '
+            'id order, for offline analysis')
+
+    def handle(self, *args, **options):
+        if len(args) != 2 or args[1] not in TABLES:
+            raise CommandError("Usage: export_experiment_data %s" % self.args)
+        experiment_name, table = args
+        try:
+            experiment = Experiment.objects.get(name=experiment_name)
+        except Experiment.DoesNotExist:
+            raise CommandError("No experiment named %r" % experiment_name)
+        fields, names = TABLES[table]
+
+        path = options.get('output') or '-'
+        if path == '-':
+            output = sys.stdout
+        else:
+            output = open(path, 'wb')
+        stream = output
+        if options.get('gzip'):
+            stream = gzip.GzipFile(fileobj=output, mode='wb')
+        writer = WRITERS[options.get('format') or 'jsonl'](stream, names)
+
+        last_id = options.get('after_id') or 0
+        count = 0
+        try:
+            for row in iterate_rows(get_queryset(experiment, table), fields,
+                                    after_id=last_id,
+                                    batch_size=options.get('batch_size') or
+                                               10000):
+                writer.write(row)
+                last_id = row[0]
+                count += 1
+        finally:
+            if stream is not output:
+                stream.close()
+            if output is not sys.stdout:
+                output.close()
+            # Resume an interrupted export with --after-id.
+            if int(options.get('verbosity', 1)) >= 1:
+                sys.stderr.write("Exported %d rows; last id: %d\n" %
+                                 (count, last_id))
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+import logging
+l = logging.getLogger(__name__)
+
+import time
+from fcntl import LOCK_EX
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_lean.experiments.rollups import rollup_goal_records
+from django_lean.lockfile import lockfile
+
+
+LOCKFILE = 'rollup_goal_records.lock'
+
+
+class Command(BaseCommand):
+    """manage.py rollup_goal_records"""
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--batch-size', type='int', default=10000,
+            help='Number of goal records to roll up per transaction.'
+        ),
+        make_option(
+            '--interval', type='int', default=0, metavar='SECONDS',
+            help='Keep rolling up new goal records every SECONDS seconds.'
+        ),
+        make_option(
+            '--wait', action='store_true', default=False,
+            help='Wait for lock.'
+        ),
+    )
+
+    help = ('Adds the goal records stored since the previous run to the '
+            'hourly goal rollups')
+
+    def info(self, message, **options):
+        if int(options.get('verbosity', 1)) >= 1:
+            print message
+
+    def handle(self, *args, **options):
+        if len(args):
+            raise CommandError("This command does not take any arguments")
+        batch_size = options.get('batch_size') or 10000
+        with lockfile(LOCKFILE, LOCK_EX, wait=options.get('wait', False)):
+            while True:
+                total = 0
+                while True:
+                    count = rollup_goal_records(batch_size)
+                    total += count
+                    if count < batch_size:
+                        break
+                self.info('Rolled up: %d' % total, **options)
+                if not options.get('interval'):
+                    break
+                time.sleep(options['interval'])
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import logging
+l = logging.getLogger(__name__)
+
+import os
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_lean.experiments.models import Experiment
+
+
+class Command(BaseCommand):
+    """manage.py snapshot_experiments --directory=DIRECTORY [experiment ...]"""
+
+    args = '[experiment name ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--directory', metavar='DIRECTORY',
+            help='Directory holding the snapshots.'
+        ),
+    )
+
+    help = ('Creates or updates NumPy snapshots of the participants and '
+            'conversions of the given experiments (default: all the started '
+            'experiments)')
+
+    def info(self, message, **options):
+        if int(options.get('verbosity', 1)) >= 1:
+            print message
+
+    def handle(self, *args, **options):
+        directory = options.get('directory')
+        if not directory or not os.path.isdir(directory):
+            raise CommandError("--directory must name an existing directory")
+        try:
+            from django_lean.experiments.snapshots import (get_snapshot_path,
+                                                           update_snapshot)
+            import numpy
+        except ImportError:
+            raise CommandError("Snapshots require NumPy")
+        if args:
+            experiments = list(Experiment.objects.filter(name__in=args))
+            unknown = set(args) - set(e.name for e in experiments)
+            if unknown:
+                raise CommandError("Unknown experiments: %s" %
+                                   ', '.join(sorted(unknown)))
+        else:
+            experiments = Experiment.objects.filter(start_date__isnull=False)
+        for experiment in experiments:
+            path = get_snapshot_path(directory, experiment)
+            count = update_snapshot(experiment, path)
+            self.info('%s: %d participants in %s' % (experiment.name, count,
+                                                     path), **options)
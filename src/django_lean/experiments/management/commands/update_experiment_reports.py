@@ -1,17 +1,43 @@
 # -*- coding: utf-8 -*-
+from __future__ import with_statement
 import logging
 l=logging.getLogger(__name__)
 
+from fcntl import LOCK_EX
+from optparse import make_option
+
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 
 from django_lean.experiments.reports import (EngagementReportGenerator,
-                                             ConversionReportGenerator)
+                                             CONVERSION_REPORT_ENGINES,
+                                             generate_reports)
+from django_lean.lockfile import lockfile
+
+
+LOCKFILE = 'update_experiment_reports.lock'
 
 
 class Command(BaseCommand):
     help = ('update_experiment_reports : Generate all the daily reports for'
             ' for the SplitTesting experiments')
+    
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--engine', choices=sorted(CONVERSION_REPORT_ENGINES.keys()),
+            default='default',
+            help=('Conversion report engine: %s. (Default: default)' %
+                  ', '.join(sorted(CONVERSION_REPORT_ENGINES.keys())))
+        ),
+        make_option(
+            '--workers', type='int', default=1,
+            help='Number of processes generating reports in parallel.'
+        ),
+        make_option(
+            '--wait', action='store_true', default=False,
+            help='Wait for lock.'
+        ),
+    )
 
     def __init__(self):
         super(self.__class__, self).__init__()
@@ -19,11 +45,25 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         if len(args):
             raise CommandError("This command does not take any arguments")
+        generators = []
         engagement_calculator = getattr(settings, 'LEAN_ENGAGEMENT_CALCULATOR', None)
         if engagement_calculator:
             engagement_calculator = _load_function(engagement_calculator)()
-            EngagementReportGenerator(engagement_score_calculator=engagement_calculator).generate_all_daily_reports()
-        ConversionReportGenerator().generate_all_daily_reports()
+            generators.append(EngagementReportGenerator(engagement_score_calculator=engagement_calculator))
+        engine = CONVERSION_REPORT_ENGINES[options.get('engine') or 'default']
+        generators.append(engine())
+        
+        failed = []
+        with lockfile(LOCKFILE, LOCK_EX, wait=options.get('wait', False)):
+            for generator in generators:
+                failed.extend(generate_reports(generator,
+                                               options.get('workers') or 1))
+        if failed:
+            raise CommandError("Unable to generate the reports of "
+                               "experiments: %s" %
+                               ", ".join(sorted(set(str(experiment_id)
+                                                    for experiment_id, dates
+                                                    in failed))))
 
 def _load_function(fully_qualified_name):
     i = fully_qualified_name.rfind('.')
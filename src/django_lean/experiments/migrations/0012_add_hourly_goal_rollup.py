@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+from south.db import db
+
+from django.db import models
+
+from django_lean.experiments.models import *
+
+class Migration:
+    def forwards(self, orm):
+        # Adding model 'HourlyGoalRollup'
+        db.create_table('experiments_hourlygoalrollup', (
+            ('id', orm['experiments.hourlygoalrollup:id']),
+            ('goal_type', orm['experiments.hourlygoalrollup:goal_type']),
+            ('experiment', orm['experiments.hourlygoalrollup:experiment']),
+            ('group', orm['experiments.hourlygoalrollup:group']),
+            ('hour', orm['experiments.hourlygoalrollup:hour']),
+            ('count', orm['experiments.hourlygoalrollup:count']),
+        ))
+        db.send_create_signal('experiments', ['HourlyGoalRollup'])
+        
+        # Creating unique_together for [goal_type, experiment, group, hour] on HourlyGoalRollup.
+        db.create_unique('experiments_hourlygoalrollup', ['goal_type_id', 'experiment_id', 'group', 'hour'])
+        
+        # Adding model 'ReportWatermark'
+        db.create_table('experiments_reportwatermark', (
+            ('id', orm['experiments.reportwatermark:id']),
+            ('name', orm['experiments.reportwatermark:name']),
+            ('position', orm['experiments.reportwatermark:position']),
+        ))
+        db.send_create_signal('experiments', ['ReportWatermark'])
+    
+    def backwards(self, orm):
+        # Deleting model 'HourlyGoalRollup'
+        db.delete_table('experiments_hourlygoalrollup')
+        
+        # Deleting model 'ReportWatermark'
+        db.delete_table('experiments_reportwatermark')
+    
+    models = {
+        'auth.group': {
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'unique_together': "(('content_type', 'codename'),)"},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True', 'blank': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'unique_together': "(('app_label', 'model'),)", 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'experiments.anonymousvisitor': {
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'db_index': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'})
+        },
+        'experiments.conversionreportcheckpoint': {
+            'date': ('django.db.models.fields.DateField', [], {}),
+            'experiment': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['experiments.Experiment']", 'unique': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'})
+        },
+        'experiments.dailyconversionreport': {
+            'confidence': ('django.db.models.fields.FloatField', [], {'null': 'True'}),
+            'control_group_size': ('django.db.models.fields.IntegerField', [], {}),
+            'date': ('django.db.models.fields.DateField', [], {'db_index': 'True'}),
+            'experiment': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['experiments.Experiment']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'overall_control_conversion': ('django.db.models.fields.IntegerField', [], {}),
+            'overall_test_conversion': ('django.db.models.fields.IntegerField', [], {}),
+            'test_group_size': ('django.db.models.fields.IntegerField', [], {})
+        },
+        'experiments.dailyconversionreportgoaldata': {
+            'confidence': ('django.db.models.fields.FloatField', [], {'null': 'True'}),
+            'control_conversion': ('django.db.models.fields.IntegerField', [], {}),
+            'goal_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['experiments.GoalType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'report': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['experiments.DailyConversionReport']"}),
+            'test_conversion': ('django.db.models.fields.IntegerField', [], {})
+        },
+        'experiments.dailyengagementcontribution': {
+            'Meta': {'unique_together': "(('user', 'date'),)"},
+            'date': ('django.db.models.fields.DateField', [], {'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"}),
+            'value': ('django.db.models.fields.FloatField', [], {})
+        },
+        'experiments.dailyengagementreport': {
+            'confidence': ('django.db.models.fields.FloatField', [], {'null': 'True'}),
+            'control_group_size': ('django.db.models.fields.IntegerField', [], {}),
+            'control_score': ('django.db.models.fields.FloatField', [], {'null': 'True'}),
+            'date': ('django.db.models.fields.DateField', [], {'db_index': 'True'}),
+            'experiment': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['experiments.Experiment']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'test_group_size': ('django.db.models.fields.IntegerField', [], {}),
+            'test_score': ('django.db.models.fields.FloatField', [], {'null': 'True'})
+        },
+        'experiments.experiment': {
+            'end_date': ('django.db.models.fields.DateField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '128'}),
+            'start_date': ('django.db.models.fields.DateField', [], {'db_index': 'True', 'null': 'True', 'blank': 'True'}),
+            'state': ('django.db.models.fields.IntegerField', [], {'default': '0'})
+        },
+        'experiments.goalrecord': {
+            'anonymous_visitor': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['experiments.AnonymousVisitor']"}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'db_index': 'True', 'blank': 'True'}),
+            'goal_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['experiments.GoalType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'})
+        },
+        'experiments.goaltype': {
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '128'})
+        },
+        'experiments.hourlygoalrollup': {
+            'Meta': {'unique_together': "(('goal_type', 'experiment', 'group', 'hour'),)"},
+            'count': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'experiment': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['experiments.Experiment']"}),
+            'goal_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['experiments.GoalType']"}),
+            'group': ('django.db.models.fields.IntegerField', [], {}),
+            'hour': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'})
+        },
+        'experiments.participant': {
+            'Meta': {'unique_together': "(('user', 'experiment'), ('anonymous_visitor', 'experiment'))"},
+            'anonymous_visitor': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['experiments.AnonymousVisitor']", 'null': 'True', 'blank': 'True'}),
+            'enrollment_date': ('django.db.models.fields.DateField', [], {'auto_now_add': 'True', 'db_index': 'True', 'blank': 'True'}),
+            'experiment': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['experiments.Experiment']"}),
+            'group': ('django.db.models.fields.IntegerField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']", 'null': 'True'})
+        },
+        'experiments.participantconversion': {
+            'Meta': {'unique_together': "(('participant', 'goal_type'),)"},
+            'date': ('django.db.models.fields.DateField', [], {'db_index': 'True'}),
+            'goal_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['experiments.GoalType']", 'null': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'participant': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['experiments.Participant']"})
+        },
+        'experiments.reportwatermark': {
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '128'}),
+            'position': ('django.db.models.fields.BigIntegerField', [], {'default': '0'})
+        }
+    }
+    
+    complete_apps = ['experiments']
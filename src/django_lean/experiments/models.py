@@ -2,17 +2,27 @@
 import logging
 l = logging.getLogger(__name__)
 
-from datetime import date
-import random
+from datetime import date, datetime
 
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models.signals import post_delete, post_save
 from django.core.exceptions import ObjectDoesNotExist
 
+from django_lean.experiments.assignment import (get_anonymous_identity,
+                                                get_assignment,
+                                                get_user_identity)
+from django_lean.experiments.cache import (experiment_cache, goal_type_cache,
+                                           live_counters, report_cache)
 from django_lean.experiments.signals import goal_recorded, user_enrolled
 
 
+def _get_writer():
+    from django_lean.experiments.writebehind import get_writer
+    return get_writer()
+
+
 class AnonymousVisitor(models.Model):
     """An anonymous visitor"""
     created = models.DateTimeField(auto_now_add=True, db_index=True)
@@ -41,15 +51,29 @@ class GoalRecord(models.Model):
         """
         anonymous_id = experiment_user.get_anonymous_id()
         if anonymous_id:
-            anonymous_visitor = AnonymousVisitor.objects.get(id=anonymous_id)
-            if getattr(settings, 'LEAN_AUTOCREATE_GOAL_TYPES', False):
-                (goal_type, created) = GoalType.objects.get_or_create(name=goal_name)
+            autocreate = getattr(settings, 'LEAN_AUTOCREATE_GOAL_TYPES', False)
+            writer = _get_writer()
+            if writer is not None:
+                # The record is queued rather than saved, so it has no id.
+                goal_type = goal_type_cache.get(goal_name, create=autocreate)
+                goal_record = GoalRecord(anonymous_visitor_id=anonymous_id,
+                                         goal_type=goal_type,
+                                         created=datetime.now())
+                writer.record_goal(anonymous_id, goal_type.id,
+                                   goal_record.created)
             else:
-                goal_type = GoalType.objects.get(name=goal_name)
-
-            goal_record = GoalRecord.objects.create(
-                goal_type=goal_type, anonymous_visitor=anonymous_visitor
-            )
+                anonymous_visitor = AnonymousVisitor.objects.get(
+                    id=anonymous_id)
+                if autocreate:
+                    (goal_type, created) = GoalType.objects.get_or_create(name=goal_name)
+                else:
+                    goal_type = GoalType.objects.get(name=goal_name)
+
+                goal_record = GoalRecord.objects.create(
+                    goal_type=goal_type, anonymous_visitor=anonymous_visitor
+                )
+            if live_counters.is_enabled():
+                _count_goal(experiment_user, goal_record.goal_type_id)
             goal_recorded.send(sender=cls, goal_record=goal_record,
                                experiment_user=experiment_user)
             return goal_record
@@ -66,12 +90,133 @@ class GoalRecord(models.Model):
             l.exception("Unexpected exception in GoalRecord.record")
 
 
+def _get_enrollment_cache(experiment_user):
+    get_enrollment_cache = getattr(experiment_user, 'get_enrollment_cache',
+                                   None)
+    if get_enrollment_cache is not None:
+        return get_enrollment_cache()
+
+def _get_enrollments(experiment_user, key, **filters):
+    """
+    Returns a dict mapping experiment ids to groups for all the Participant
+    rows matching `filters`, loaded with a single query the first time
+    `key` is requested from the experiment user's enrollment cache.
+    Returns None if the experiment user does not provide an enrollment cache.
+    """
+    enrollment_cache = _get_enrollment_cache(experiment_user)
+    if enrollment_cache is None:
+        return None
+    if key not in enrollment_cache:
+        enrollment_cache[key] = dict(
+            Participant.objects.filter(**filters).values_list('experiment',
+                                                              'group'))
+    return enrollment_cache[key]
+
+def _remember_enrollment(experiment_user, key, experiment, group_id):
+    enrollment_cache = _get_enrollment_cache(experiment_user)
+    if enrollment_cache is not None and key in enrollment_cache:
+        enrollment_cache[key][experiment.id] = group_id
+
+def _get_recorded_enrollment(experiment_user, identity, experiment):
+    """
+    Returns the group of the enrollment recorded earlier in the session, or
+    None.
+    """
+    session = getattr(experiment_user, 'session', None)
+    if session is None:
+        return None
+    recorded = session.get('recorded_enrollments', {})
+    return recorded.get(identity, {}).get(experiment.id)
+
+def _mark_enrollment_recorded(experiment_user, identity, experiment,
+                              group_id):
+    session = getattr(experiment_user, 'session', None)
+    if session is not None:
+        recorded = session.get('recorded_enrollments', {})
+        recorded.setdefault(identity, {})[experiment.id] = group_id
+        session['recorded_enrollments'] = recorded
+
+def _get_stored_group(experiment, **kwargs):
+    """
+    Returns the group of the stored enrollment in the experiment of the
+    user or anonymous visitor given in `kwargs`, or None.
+    """
+    groups = list(Participant.objects.filter(
+            experiment=experiment, **kwargs).values_list('group', flat=True))
+    if groups:
+        return groups[0]
+
+def _get_live_enrollments(session):
+    """
+    Returns today's date and the {experiment id: [group, counted goals]}
+    enrollments of the visitor today, as kept in the session.
+    """
+    today = date.today().isoformat()
+    day, enrollments = session.get('live_enrollments', [today, {}])
+    if day != today:
+        enrollments = {}
+    return today, enrollments
+
+def _count_enrollment(experiment_user, experiment, group_id):
+    """
+    Bumps the live enrollment counter of the experiment group, and remembers
+    the enrollment in the session, so that the visitor's goals are counted
+    in the same group today. Visitors without a session are not counted.
+    """
+    session = getattr(experiment_user, 'session', None)
+    if not live_counters.is_enabled() or session is None:
+        return
+    today, enrollments = _get_live_enrollments(session)
+    enrollments[experiment.id] = [group_id, []]
+    session['live_enrollments'] = [today, enrollments]
+    live_counters.incr(experiment.id, group_id, live_counters.ENROLLED)
+
+def _count_goal(experiment_user, goal_type_id):
+    """
+    Bumps the live counters of the goal type and of any goal in each
+    experiment group the visitor enrolled in today, the first time the
+    visitor achieves them, so that the counters are the number of today's
+    participants who converted.
+    """
+    session = getattr(experiment_user, 'session', None)
+    if session is None:
+        return
+    today, enrollments = _get_live_enrollments(session)
+    counted_any = False
+    for experiment_id, (group_id, counted) in enrollments.iteritems():
+        for name in (goal_type_id, live_counters.ANY):
+            if name not in counted:
+                counted.append(name)
+                live_counters.incr(experiment_id, group_id, name)
+                counted_any = True
+    if counted_any:
+        session['live_enrollments'] = [today, enrollments]
+
+def _create_participant(**kwargs):
+    """
+    Creates a Participant, or returns None if it can't be stored, for
+    instance because the user or anonymous visitor is already enrolled in the
+    experiment.
+    """
+    sid = transaction.savepoint()
+    try:
+        participant = Participant.objects.create(**kwargs)
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+        return None
+    transaction.savepoint_commit(sid)
+    return participant
+
+
 class Experiment(models.Model):
     """ Defines a split testing experiment"""
     class __UnverifiedUser(object):
         def __init__(self, experiment_user):
             self.experiment_user = experiment_user
 
+        def get_identity(self, create=False):
+            return None
+
         def get_enrollment(self, experiment):
             return self.experiment_user.get_temporary_enrollment(
                 experiment.name)
@@ -88,23 +233,81 @@ class Experiment(models.Model):
         def __init__(self, experiment_user):
             self.experiment_user = experiment_user
 
+        def get_identity(self, create=False):
+            return get_user_identity(
+                self.experiment_user.get_registered_user().pk)
+
         def get_enrollment(self, experiment):
+            user = self.experiment_user.get_registered_user()
+            enrollments = _get_enrollments(self.experiment_user,
+                                           ('user', user.pk), user=user)
+            if enrollments is not None:
+                return enrollments.get(experiment.id)
+
             participants = Participant.objects.filter(
-                user=self.experiment_user.get_registered_user(),
-                experiment=experiment)
+                user=user, experiment=experiment)
             if participants.count() == 1:
                 return participants[0].group
 
         def set_enrollment(self, experiment, group_id):
-            participant = Participant.objects.create(
-                user=self.experiment_user.get_registered_user(),
-                experiment=experiment, group=group_id
-            )
+            user = self.experiment_user.get_registered_user()
+            writer = _get_writer()
+            if writer is not None:
+                writer.enroll(experiment.id, group_id, date.today(),
+                              user_id=user.pk)
+            else:
+                Participant.objects.create(
+                    user=user, experiment=experiment, group=group_id
+                )
+            _remember_enrollment(self.experiment_user, ('user', user.pk),
+                                 experiment, group_id)
             user_enrolled.send(sender=self.__class__,
                                experiment=experiment,
                                experiment_user=self.experiment_user,
                                group_id=group_id)
 
+        def record_enrollment(self, experiment, group_id):
+            """
+            Stores the enrollment once per session, and returns the user's
+            group: the stored one if the user was enrolled already, for
+            instance before the assignment strategy was changed.
+            """
+            identity = self.get_identity()
+            recorded = _get_recorded_enrollment(self.experiment_user,
+                                                identity, experiment)
+            if recorded is not None:
+                return recorded
+            user = self.experiment_user.get_registered_user()
+            writer = _get_writer()
+            if writer is not None:
+                # Whether the enrollment is new is only known once it is
+                # written, so the signal is sent once per session.
+                stored = _get_stored_group(experiment, user=user)
+                if stored is None:
+                    writer.enroll(experiment.id, group_id, date.today(),
+                                  user_id=user.pk)
+            elif _create_participant(user=user, experiment=experiment,
+                                     group=group_id):
+                stored = None
+            else:
+                stored = _get_stored_group(experiment, user=user)
+                if stored is None:
+                    # Not enrolled before, so the enrollment is retried
+                    # later.
+                    l.warning("Can't enroll user %s in the Experiment named "
+                              "%s" % (user.pk, experiment.name))
+                    return group_id
+            if stored is None:
+                user_enrolled.send(sender=self.__class__,
+                                   experiment=experiment,
+                                   experiment_user=self.experiment_user,
+                                   group_id=group_id)
+            else:
+                group_id = stored
+            _mark_enrollment_recorded(self.experiment_user, identity,
+                                      experiment, group_id)
+            return group_id
+
     class __AnonymousUser(object):
         def __init__(self, experiment_user):
             self.experiment_user = experiment_user
@@ -116,7 +319,23 @@ class Experiment(models.Model):
                 if anonymous_visitors.count() == 1:
                     return anonymous_visitors[0]
 
+        def get_identity(self, create=False):
+            anonymous_id = self.experiment_user.get_anonymous_id()
+            if not anonymous_id and create:
+                anonymous_id = AnonymousVisitor.objects.create().id
+                self.experiment_user.set_anonymous_id(anonymous_id)
+            if anonymous_id:
+                return get_anonymous_identity(anonymous_id)
+
         def get_enrollment(self, experiment):
+            anonymous_id = self.experiment_user.get_anonymous_id()
+            if anonymous_id:
+                enrollments = _get_enrollments(self.experiment_user,
+                                               ('anonymous', anonymous_id),
+                                               anonymous_visitor=anonymous_id)
+                if enrollments is not None:
+                    return enrollments.get(experiment.id)
+
             anonymous_visitor = self.__get_anonymous_visitor()
 
             if anonymous_visitor:
@@ -133,15 +352,73 @@ class Experiment(models.Model):
                 anonymous_visitor.save()
                 self.experiment_user.set_anonymous_id(anonymous_visitor.id)
 
-            Participant.objects.create(
-                anonymous_visitor=anonymous_visitor,
-                experiment=experiment, group=group_id
-            )
+            writer = _get_writer()
+            if writer is not None:
+                writer.enroll(experiment.id, group_id, date.today(),
+                              anonymous_visitor_id=anonymous_visitor.id)
+            else:
+                Participant.objects.create(
+                    anonymous_visitor=anonymous_visitor,
+                    experiment=experiment, group=group_id
+                )
+            _remember_enrollment(self.experiment_user,
+                                 ('anonymous', anonymous_visitor.id),
+                                 experiment, group_id)
+            _count_enrollment(self.experiment_user, experiment, group_id)
             user_enrolled.send(sender=self.__class__,
                                experiment=experiment,
                                experiment_user=self.experiment_user,
                                group_id=group_id)
 
+        def record_enrollment(self, experiment, group_id):
+            """
+            Stores the enrollment once per session, and returns the
+            visitor's group: the stored one if the visitor was enrolled
+            already, for instance before the assignment strategy was changed.
+            """
+            identity = self.get_identity()
+            recorded = _get_recorded_enrollment(self.experiment_user,
+                                                identity, experiment)
+            if recorded is not None:
+                return recorded
+            anonymous_id = self.experiment_user.get_anonymous_id()
+            writer = _get_writer()
+            if writer is not None:
+                # Whether the enrollment is new is only known once it is
+                # written, so the signal is sent once per session.
+                stored = _get_stored_group(experiment,
+                                           anonymous_visitor=anonymous_id)
+                if stored is None:
+                    writer.enroll(experiment.id, group_id, date.today(),
+                                  anonymous_visitor_id=anonymous_id)
+            elif _create_participant(
+                    # Avoid reading the visitor back; only its id is needed.
+                    anonymous_visitor=AnonymousVisitor(id=anonymous_id),
+                    experiment=experiment, group=group_id):
+                stored = None
+            else:
+                stored = _get_stored_group(experiment,
+                                           anonymous_visitor=anonymous_id)
+                if stored is None:
+                    # Not enrolled before, for instance because the visitor
+                    # no longer exists, so the enrollment is retried later.
+                    l.warning("Can't enroll anonymous visitor %s in the "
+                              "Experiment named %s" % (anonymous_id,
+                                                       experiment.name))
+                    return group_id
+            if stored is None:
+                _count_enrollment(self.experiment_user, experiment,
+                                  group_id)
+                user_enrolled.send(sender=self.__class__,
+                                   experiment=experiment,
+                                   experiment_user=self.experiment_user,
+                                   group_id=group_id)
+            else:
+                group_id = stored
+            _mark_enrollment_recorded(self.experiment_user, identity,
+                                      experiment, group_id)
+            return group_id
+
     @classmethod
     def __create_user(cls, experiment_user):
         if not experiment_user.is_anonymous():
@@ -198,7 +475,9 @@ class Experiment(models.Model):
                       and not old_self.end_date):
                     #promoting
                     self.end_date = date.today()
-        return super(Experiment, self).save(*args, **kwargs)
+        result = super(Experiment, self).save(*args, **kwargs)
+        experiment_cache.invalidate()
+        return result
 
     @staticmethod
     def control(experiment_name, experiment_user):
@@ -228,7 +507,7 @@ class Experiment(models.Model):
 
         experiment = None
         try:
-            experiment = Experiment.objects.get(name=experiment_name)
+            experiment = experiment_cache.get(experiment_name)
         except Experiment.DoesNotExist:
             if settings.DEBUG:
                 raise Exception("Can't find the Experiment named %s" %
@@ -246,17 +525,34 @@ class Experiment(models.Model):
             raise Exception("Invalid experiment state !")
 
         user = cls.__create_user(experiment_user)
+        assignment = get_assignment()
+
+        if assignment.deterministic:
+            # The group is computed rather than read back; the Participant
+            # row is only written once per session. Users enrolled before
+            # hash assignment was enabled keep their stored group.
+            identity = user.get_identity(create=True)
+            if identity is not None:
+                assigned_group = user.record_enrollment(
+                    experiment, assignment.assign(experiment, identity))
+                return queried_group == assigned_group
 
         assigned_group = user.get_enrollment(experiment)
 
         if assigned_group == None:
-            assigned_group = random.choice((Participant.CONTROL_GROUP,
-                                            Participant.TEST_GROUP))
+            assigned_group = assignment.assign(experiment,
+                                               user.get_identity())
             user.set_enrollment(experiment, assigned_group)
 
         return queried_group == assigned_group
 
 
+def invalidate_experiment_cache(sender, **kwargs):
+    experiment_cache.invalidate()
+
+post_delete.connect(invalidate_experiment_cache, sender=Experiment)
+
+
 class Participant(models.Model):
     """A participant in a split testing experiment """
 
@@ -321,3 +617,105 @@ class  DailyConversionReportGoalData(models.Model):
     test_conversion = models.IntegerField()
     control_conversion = models.IntegerField()
     confidence = models.FloatField(null=True)
+
+
+class ParticipantConversion(models.Model):
+    """
+    Stores the date on which a participant first achieved a goal type (or
+    any goal, when goal_type is None) since enrolling. Maintained by the
+    incremental conversion report engine.
+    """
+    participant = models.ForeignKey(Participant)
+    goal_type = models.ForeignKey(GoalType, null=True)
+    date = models.DateField(db_index=True)
+
+    class Meta:
+        unique_together = (('participant', 'goal_type'),)
+
+
+class ConversionReportCheckpoint(models.Model):
+    """
+    Stores the last date whose goal records have been folded into the
+    ParticipantConversion rows of an experiment.
+    """
+    experiment = models.ForeignKey(Experiment, unique=True)
+    date = models.DateField()
+
+
+class DailyEngagementContribution(models.Model):
+    """
+    Stores a user's engagement on a single day, for engagement calculators
+    which score users by adding up their daily contributions.
+    """
+    user = models.ForeignKey(User)
+    date = models.DateField(db_index=True)
+    value = models.FloatField()
+
+    class Meta:
+        unique_together = (('user', 'date'),)
+
+
+class HourlyGoalRollup(models.Model):
+    """
+    Stores the number of goal records of a goal type recorded in an hour by
+    the participants of an experiment group. Maintained by the
+    rollup_goal_records management command for external dashboards; the
+    reports do not read it.
+    """
+    goal_type = models.ForeignKey(GoalType)
+    experiment = models.ForeignKey(Experiment)
+    group = models.IntegerField(choices=Participant.GROUPS)
+    hour = models.DateTimeField(db_index=True)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = (('goal_type', 'experiment', 'group', 'hour'),)
+
+
+class ReportWatermark(models.Model):
+    """
+    Stores how far a background job has read an append-only table, usually
+    as the last primary key it has processed.
+    """
+    name = models.CharField(max_length=128, unique=True)
+    position = models.BigIntegerField(default=0)
+
+
+class FirstConversion(models.Model):
+    """
+    When an anonymous visitor first achieved a goal type, compacted from
+    the goal records by the compact_goal_records management command.
+    """
+    class Meta:
+        unique_together = (('anonymous_visitor', 'goal_type'),)
+
+    anonymous_visitor = models.ForeignKey(AnonymousVisitor)
+    goal_type = models.ForeignKey(GoalType)
+    created = models.DateTimeField(db_index=True)
+
+
+def invalidate_report_cache(sender, instance, **kwargs):
+    report_cache.invalidate(instance.experiment_id, [instance.date])
+
+def invalidate_goal_data_report_cache(sender, instance, **kwargs):
+    if not report_cache.is_enabled():
+        return
+    # The report may be gone already if it is being deleted, in which case
+    # its own deletion invalidates the cache.
+    for experiment_id, report_date in DailyConversionReport.objects.filter(
+            id=instance.report_id).values_list('experiment', 'date'):
+        report_cache.invalidate(experiment_id, [report_date])
+
+def invalidate_goal_types_report_cache(sender, created=True, **kwargs):
+    if created:
+        report_cache.invalidate_goal_types()
+
+for report_model in (DailyEngagementReport, DailyConversionReport):
+    post_save.connect(invalidate_report_cache, sender=report_model)
+    post_delete.connect(invalidate_report_cache, sender=report_model)
+post_save.connect(invalidate_goal_data_report_cache,
+                  sender=DailyConversionReportGoalData)
+post_delete.connect(invalidate_goal_data_report_cache,
+                    sender=DailyConversionReportGoalData)
+post_save.connect(invalidate_goal_types_report_cache, sender=GoalType)
+post_delete.connect(invalidate_goal_types_report_cache, sender=GoalType)
@@ -1,15 +1,33 @@
 # -*- coding: utf-8 -*-
+from __future__ import with_statement
 import logging
 l = logging.getLogger(__name__)
 
 from datetime import datetime, timedelta
+from fcntl import LOCK_EX
+from itertools import islice
+from operator import itemgetter
 
-from django_lean.experiments.models import (DailyEngagementReport,
+from django.db import connections, transaction, IntegrityError
+from django.db.models import Count, F, Min, Q, Sum
+
+from django_lean.experiments.cache import live_counters, report_cache
+from django_lean.experiments.models import (ConversionReportCheckpoint,
+                                            DailyEngagementContribution,
+                                            DailyEngagementReport,
                                             DailyConversionReport,
                                             DailyConversionReportGoalData,
                                             Experiment, Participant,
+                                            ParticipantConversion,
                                             GoalRecord, GoalType)
+from django_lean.experiments.rollups import (COMPACT_LOCKFILE,
+                                             FIRST_CONVERSIONS,
+                                             compact_all_goal_records,
+                                             get_watermark)
 from django_lean.experiments.significance import chi_square_p_value
+from django_lean.experiments.stats import RunningStats
+from django_lean.lockfile import lockfile
+from django_lean.utils import bulk_insert
 
 
 def calculate_participant_conversion(participant, goal_type, report_date):
@@ -56,6 +74,37 @@ def find_experiment_group_participants(group, experiment, report_date):
                                       experiment=experiment,
                                       anonymous_visitor__isnull=False)
 
+def cumulative_counts(events, dates):
+    """
+    Given `events`, a sequence of (date, key) pairs, returns one dictionary
+    per date of the sorted sequence `dates`, mapping each key to the number
+    of events on or before that date.
+    """
+    events = sorted(events, key=itemgetter(0))
+    counts = {}
+    result = []
+    i = 0
+    for date in dates:
+        while i < len(events) and events[i][0] <= date:
+            key = events[i][1]
+            counts[key] = counts.get(key, 0) + 1
+            i += 1
+        result.append(dict(counts))
+    return result
+
+def _numpy_cumulative_counts(numpy, keys, days, report_days):
+    """
+    Returns a dictionary mapping each distinct value of the `keys` array to
+    an array with, for each of the sorted `report_days`, the number of
+    `days` on or before it that belong to that key.
+    """
+    counts = {}
+    for key in numpy.unique(keys):
+        key_days = numpy.sort(days[keys == key])
+        counts[int(key)] = numpy.searchsorted(key_days, report_days,
+                                              side='right')
+    return counts
+
 def __rate(a, b):
     if not b or a == None:
         return None
@@ -97,6 +146,11 @@ def get_conversion_data(experiment, date):
     
     <goal_type_name> will map to None if a report was generated for a given day, but no goal type report was generated for <goal_type_name>
     """
+    key = (report_cache.CONVERSION, date)
+    cached = report_cache.get(experiment.id, [date])
+    if key in cached:
+        return cached[key]
+    
     report_set = DailyConversionReport.objects.filter(experiment=experiment, date=date)
     if report_set.count() != 1:
         l.warn("No conversion report for date %s and experiment %s" %
@@ -104,16 +158,36 @@ def get_conversion_data(experiment, date):
         return None
     
     report = report_set[0]
+    data = _conversion_data(report, _group_goal_data(report.goal_data.all()),
+                            GoalType.objects.all())
+    report_cache.set(experiment.id, {key: data})
+    return data
+
+def _group_goal_data(goal_data):
+    """
+    Returns {report id: {goal type id: [goal data]}} for the given
+    DailyConversionReportGoalData rows.
+    """
+    grouped = {}
+    for goal_type_data in goal_data:
+        (grouped.setdefault(goal_type_data.report_id, {}).
+         setdefault(goal_type_data.goal_type_id, []).append(goal_type_data))
+    return grouped
+
+def _conversion_data(report, goal_data, goal_types):
+    """
+    Builds the get_conversion_data() dict of `report`, given the grouped
+    goal data returned by _group_goal_data() and all the goal types.
+    """
     test_rate = __rate(report.overall_test_conversion, report.test_group_size)
     control_rate = __rate(report.overall_control_conversion, report.control_group_size)
     improvement = __improvement(test_rate, control_rate)
     
-    all_goal_types = GoalType.objects.all()
-    
+    report_goal_data = goal_data.get(report.id, {})
     goal_types_data = {}
-    for goal_type in all_goal_types:
-        goal_type_data_set = report.goal_data.filter(goal_type=goal_type)
-        if goal_type_data_set.count() != 1:
+    for goal_type in goal_types:
+        goal_type_data_set = report_goal_data.get(goal_type.id, [])
+        if len(goal_type_data_set) != 1:
             goal_data = None
         else:
             goal_type_data = goal_type_data_set[0]
@@ -145,14 +219,332 @@ def get_conversion_data(experiment, date):
         }
     return data
 
+class _LiveCounts(object):
+    """
+    Stands for a DailyConversionReport or its goal data in
+    get_live_conversion_data(), as the live counters carry no confidence.
+    """
+    id = None
+    confidence = None
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+def get_live_conversion_data(experiment, day):
+    """
+    Returns the get_conversion_data() dict approximated from the live
+    counters of `day`, without reading the participants or goal records.
+
+    The group sizes are the anonymous visitors enrolled on `day`, and the
+    counts those of them who achieved a goal on the same day. The counters
+    may lose counts when the cache evicts them, so confidences are None.
+    """
+    goal_types = list(GoalType.objects.all())
+    names = ([live_counters.ENROLLED, live_counters.ANY] +
+             [goal_type.id for goal_type in goal_types])
+    groups = (Participant.CONTROL_GROUP, Participant.TEST_GROUP)
+    counts = live_counters.get(experiment.id, groups, names, day)
+    control = lambda name: counts[(Participant.CONTROL_GROUP, name)]
+    test = lambda name: counts[(Participant.TEST_GROUP, name)]
+    report = _LiveCounts(date=day,
+                         control_group_size=control(live_counters.ENROLLED),
+                         test_group_size=test(live_counters.ENROLLED),
+                         overall_control_conversion=control(live_counters.ANY),
+                         overall_test_conversion=test(live_counters.ANY))
+    goal_data = dict((goal_type.id, [_LiveCounts(
+                    control_conversion=control(goal_type.id),
+                    test_conversion=test(goal_type.id))])
+                     for goal_type in goal_types)
+    return _conversion_data(report, {None: goal_data}, goal_types)
+
+def get_engagement_data(report):
+    """
+    Returns:
+    {
+      "control_group_size",
+      "control_group_score",
+      "test_group_size",
+      "test_group_score",
+      "test_group_improvement",
+      "confidence"
+    }
+    for the given DailyEngagementReport.
+    """
+    improvement = None
+    
+    if report.control_score > 0:
+        improvement = ((report.test_score - report.control_score) /
+                       report.control_score) * 100
+    return {
+        "control_group_size": report.control_group_size,
+        "control_group_score": report.control_score,
+        "test_group_size": report.test_group_size,
+        "test_group_score": report.test_score,
+        "test_group_improvement": improvement,
+        "confidence": report.confidence}
+
+def _reports_by_date(reports):
+    """
+    Returns {date: report} for the given reports. Dates with more than one
+    report map to None, as no single report can be shown for them.
+    """
+    by_date = {}
+    for report in reports:
+        if report.date in by_date:
+            by_date[report.date] = None
+        else:
+            by_date[report.date] = report
+    return by_date
+
+def get_daily_data(experiment, start_date, end_date, step=1):
+    """
+    Returns a list with, for every `step` days from end_date back to
+    start_date:
+    {
+      "date",
+      "conversion_data" (as returned by get_conversion_data),
+      "engagement_data" (as returned by get_engagement_data)
+    }
+    
+    The reports of all those dates are loaded at once, so the number of
+    queries does not depend on the number of dates or goal types. Days whose
+    data is in the report cache are not loaded at all.
+    """
+    dates = [end_date - timedelta(days=i)
+             for i in range(0, (end_date - start_date).days + 1, step)]
+    cached = report_cache.get(experiment.id, dates)
+    engagement_dates = [d for d in dates
+                        if (report_cache.ENGAGEMENT, d) not in cached]
+    conversion_dates = [d for d in dates
+                        if (report_cache.CONVERSION, d) not in cached]
+    engagement_reports = {}
+    if engagement_dates:
+        engagement_reports = _reports_by_date(
+            DailyEngagementReport.objects.filter(experiment=experiment,
+                                                 date__in=engagement_dates))
+    conversion_reports = {}
+    if conversion_dates:
+        conversion_reports = _reports_by_date(
+            DailyConversionReport.objects.filter(experiment=experiment,
+                                                 date__in=conversion_dates))
+    goal_data = {}
+    goal_types = []
+    if conversion_reports:
+        goal_data = _group_goal_data(
+            DailyConversionReportGoalData.objects.filter(
+                report__experiment=experiment,
+                report__date__in=conversion_dates))
+        goal_types = list(GoalType.objects.all())
+    
+    loaded = {}
+    for current_date in engagement_dates:
+        engagement_report = engagement_reports.get(current_date)
+        if engagement_report:
+            loaded[(report_cache.ENGAGEMENT, current_date)] = (
+                get_engagement_data(engagement_report))
+        else:
+            l.warn("No engagement report for date %s and experiment %s" %
+                   (current_date, experiment.name))
+    for current_date in conversion_dates:
+        conversion_report = conversion_reports.get(current_date)
+        if conversion_report:
+            loaded[(report_cache.CONVERSION, current_date)] = (
+                _conversion_data(conversion_report, goal_data, goal_types))
+        else:
+            l.warn("No conversion report for date %s and experiment %s" %
+                   (current_date, experiment.name))
+    report_cache.set(experiment.id, loaded)
+    cached.update(loaded)
+    
+    daily_data = []
+    for current_date in dates:
+        daily_data.append({
+                "date": current_date,
+                "conversion_data": cached.get((report_cache.CONVERSION,
+                                               current_date)),
+                "engagement_data": cached.get((report_cache.ENGAGEMENT,
+                                               current_date))})
+    return daily_data
+
+EXPORT_FIELDS = ('experiment', 'date', 'report', 'goal_type',
+                 'control_group_size', 'test_group_size', 'control', 'test',
+                 'confidence')
+
+def _report_batches(reports, batch_size):
+    """
+    Yields the given reports in lists of up to `batch_size`, ordered by date.
+    Each list is read with its own query, so that no more than `batch_size`
+    reports are ever fetched from the database at once.
+    """
+    reports = reports.order_by('date', 'id')
+    batch = list(reports[:batch_size])
+    while batch:
+        yield batch
+        last = batch[-1]
+        batch = list(reports.filter(Q(date__gt=last.date) |
+                                    Q(date=last.date, id__gt=last.id))
+                     [:batch_size])
+
+def generate_report_rows(experiments, batch_size=500):
+    """
+    Yields one tuple of EXPORT_FIELDS values per engagement report,
+    conversion report and conversion report goal type of the given
+    experiments, ordered by experiment and date.
+    
+    'report' is 'engagement' or 'conversion'. 'control' and 'test' hold the
+    groups' scores, or their number of conversions for the goal type (an
+    empty goal type stands for any goal). Reports are read `batch_size` at a
+    time, so memory use does not grow with the number of reports.
+    """
+    goal_type_names = dict(GoalType.objects.values_list('id', 'name'))
+    for experiment in experiments:
+        for batch in _report_batches(DailyEngagementReport.objects.filter(
+                experiment=experiment), batch_size):
+            for report in batch:
+                yield (experiment.name, report.date, 'engagement', None,
+                       report.control_group_size, report.test_group_size,
+                       report.control_score, report.test_score,
+                       report.confidence)
+        for batch in _report_batches(DailyConversionReport.objects.filter(
+                experiment=experiment), batch_size):
+            goal_data = _group_goal_data(
+                DailyConversionReportGoalData.objects.filter(
+                    report__in=[report.id for report in batch]))
+            for report in batch:
+                yield (experiment.name, report.date, 'conversion', None,
+                       report.control_group_size, report.test_group_size,
+                       report.overall_control_conversion,
+                       report.overall_test_conversion, report.confidence)
+                report_goal_data = goal_data.get(report.id, {})
+                for goal_type_id in sorted(report_goal_data,
+                                           key=goal_type_names.get):
+                    for data in report_goal_data[goal_type_id]:
+                        yield (experiment.name, report.date, 'conversion',
+                               goal_type_names[goal_type_id],
+                               report.control_group_size,
+                               report.test_group_size,
+                               data.control_conversion, data.test_conversion,
+                               data.confidence)
+
+_worker_generator = None
+
+def _init_worker(generator):
+    global _worker_generator
+    _worker_generator = generator
+
+def _generate_unit(unit, generator=None):
+    experiment_id, report_dates = unit
+    generator = generator or _worker_generator
+    try:
+        experiment = Experiment.objects.get(id=experiment_id)
+        generator.generate_daily_reports_for_experiment(experiment,
+                                                        report_dates)
+    except Exception:
+        transaction.rollback_unless_managed()
+        l.exception("Unable to generate the reports of experiment %s from "
+                    "%s to %s" % (experiment_id, report_dates[0],
+                                  report_dates[-1]))
+        return False
+    return True
+
+def generate_reports(generator, workers=1):
+    """
+    Generates all the missing reports of `generator`, one unit of work per
+    experiment, using a pool of `workers` processes. A unit that fails is
+    logged and does not stop the others.
+    
+    Returns the (experiment id, report dates) units that failed.
+    """
+    missing = generator.find_missing_reports()
+    generator.prepare_reports(missing)
+    units = [(experiment.id, report_dates)
+             for experiment, report_dates in missing]
+    if workers > 1 and len(units) > 1:
+        from multiprocessing import Pool
+        # Each worker must open its own database connections rather than
+        # share the ones inherited from this process.
+        for connection in connections.all():
+            connection.close()
+        pool = Pool(min(workers, len(units)), _init_worker, (generator,))
+        try:
+            results = pool.map(_generate_unit, units, chunksize=1)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        results = [_generate_unit(unit, generator) for unit in units]
+    return [unit for unit, result in zip(units, results) if not result]
+
+
+def store_engagement_contributions(date, contributions):
+    """
+    Stores the {user id: value} engagement contributions for the given date.
+    Contributions stored in the meantime by another report run are kept.
+    """
+    rows = [(user_id, date, value)
+            for user_id, value in contributions.iteritems()]
+    fields = ('user', 'date', 'value')
+    try:
+        bulk_insert(DailyEngagementContribution, fields, rows)
+    except IntegrityError:
+        transaction.rollback_unless_managed()
+        existing = set(DailyEngagementContribution.objects.filter(
+            date=date, user__in=contributions.keys()
+        ).values_list('user', flat=True))
+        bulk_insert(DailyEngagementContribution, fields,
+                    [row for row in rows if row[0] not in existing])
+
+
+def _count_converted(converted, goal_type_field):
+    """
+    Returns the count_conversions() dictionary of the `converted`
+    participants queryset, joined to goal types through `goal_type_field`.
+    """
+    counts = {}
+    for group, count in converted.values_list('group').annotate(
+            Count('id', distinct=True)):
+        counts[(group, None)] = count
+    for group, goal_type_id, count in converted.values_list(
+            'group', goal_type_field).annotate(Count('id', distinct=True)):
+        counts[(group, goal_type_id)] = count
+    return counts
+
+
 class BaseReportGenerator(object):
     def __init__(self, report_model_class):
         self.report_model_class = report_model_class
     
     def generate_all_daily_reports(self):
         """ Generates all missing reports up until yesterday """
+        missing = self.find_missing_reports()
+        self.prepare_reports(missing)
+        for experiment, report_dates in missing:
+            self.generate_daily_reports_for_experiment(experiment, report_dates)
+    
+    def prepare_reports(self, missing):
+        """
+        Called with the result of find_missing_reports() before any of the
+        missing reports are generated.
+        """
+        pass
+    
+    def find_missing_reports(self):
+        """
+        Returns a list of (experiment, report dates) pairs for the reports
+        missing up until yesterday.
+        """
+        missing = []
         experiments = Experiment.objects.filter(start_date__isnull=False)
         yesterday = (datetime.today() - timedelta(days=1)).date()
+        existing_dates = {}
+        for experiment_id, report_date in self.report_model_class.objects.filter(
+                experiment__start_date__isnull=False).values_list(
+                'experiment', 'date'):
+            existing_dates.setdefault(experiment_id, set()).add(report_date)
+        
         for experiment in experiments:
             start_date = experiment.start_date
             current_date = start_date
@@ -160,12 +552,20 @@ class BaseReportGenerator(object):
             end_date = min(end_date, yesterday)
             
             # get or create the report for all the days of the experiment
+            report_dates = []
             while current_date <= end_date:
-                if (self.report_model_class.objects.filter(
-                        experiment=experiment, date=current_date).count() == 0):
-                    daily_report = self.generate_daily_report_for_experiment(
-                        experiment=experiment, report_date=current_date)
+                if current_date not in existing_dates.get(experiment.id, ()):
+                    report_dates.append(current_date)
                 current_date = current_date + timedelta(days=1)
+            if report_dates:
+                missing.append((experiment, report_dates))
+        return missing
+    
+    def generate_daily_reports_for_experiment(self, experiment, report_dates):
+        """ Generates the reports for all the dates in `report_dates` """
+        for report_date in report_dates:
+            self.generate_daily_report_for_experiment(
+                experiment=experiment, report_date=report_date)
     
 
 class ConversionReportGenerator(BaseReportGenerator):
@@ -199,18 +599,7 @@ class ConversionReportGenerator(BaseReportGenerator):
         total_test_conversion = self.goal_type_conversion_calculator(
             None, test_participants, report_date)
         
-        confidence = self.__confidence(test_participant_count, total_test_conversion,
-                                       control_participant_count, total_control_conversion)
-        
-        report = DailyConversionReport.objects.create(
-            experiment=experiment,
-            date=report_date,
-            test_group_size=test_participant_count,
-            control_group_size=control_participant_count,
-            overall_test_conversion=total_test_conversion,
-            overall_control_conversion=total_control_conversion,
-            confidence=confidence)
-        
+        goal_conversions = []
         for goal_type in GoalType.objects.all():
             control_count = self.goal_type_conversion_calculator(goal_type,
                                                                  control_participants,
@@ -218,59 +607,637 @@ class ConversionReportGenerator(BaseReportGenerator):
             test_count = self.goal_type_conversion_calculator(goal_type,
                                                               test_participants,
                                                               report_date)
-            confidence = self.__confidence(test_participant_count, test_count,
-                                           control_participant_count, control_count)
+            goal_conversions.append((goal_type, test_count, control_count))
+        
+        return self.create_report(experiment, report_date,
+                                  test_participant_count,
+                                  control_participant_count,
+                                  total_test_conversion,
+                                  total_control_conversion,
+                                  goal_conversions)
+    
+    def create_report(self, experiment, report_date, test_group_size,
+                      control_group_size, test_conversion, control_conversion,
+                      goal_conversions):
+        """
+        Stores a conversion report, computing the confidence of each
+        conversion count. `goal_conversions` is a sequence of
+        (goal_type, test_conversion, control_conversion) tuples.
+        """
+        confidence = self.__confidence(test_group_size, test_conversion,
+                                       control_group_size, control_conversion)
+        
+        report = DailyConversionReport.objects.create(
+            experiment=experiment,
+            date=report_date,
+            test_group_size=test_group_size,
+            control_group_size=control_group_size,
+            overall_test_conversion=test_conversion,
+            overall_control_conversion=control_conversion,
+            confidence=confidence)
+        
+        for goal_type, test_count, control_count in goal_conversions:
+            confidence = self.__confidence(test_group_size, test_count,
+                                           control_group_size, control_count)
             DailyConversionReportGoalData.objects.create(
                 report=report, goal_type=goal_type,
                 test_conversion=test_count,
                 control_conversion=control_count,
                 confidence=confidence)
+        return report
+    
+    @transaction.commit_on_success
+    def create_reports(self, experiment, reports):
+        """
+        Stores several conversion reports with bulk inserts. `reports` is a
+        sequence of tuples of the create_report() arguments that follow
+        `experiment`.
+        """
+        report_rows = []
+        for (report_date, test_group_size, control_group_size,
+             test_conversion, control_conversion, goal_conversions) in reports:
+            report_rows.append((
+                    experiment.id, report_date, test_group_size,
+                    control_group_size, test_conversion, control_conversion,
+                    self.__confidence(test_group_size, test_conversion,
+                                      control_group_size, control_conversion)))
+        bulk_insert(DailyConversionReport,
+                    ('experiment', 'date', 'test_group_size',
+                     'control_group_size', 'overall_test_conversion',
+                     'overall_control_conversion', 'confidence'),
+                    report_rows)
+        
+        report_ids = dict(DailyConversionReport.objects.filter(
+                experiment=experiment,
+                date__in=[report[0] for report in reports]).values_list(
+                'date', 'id'))
+        goal_rows = []
+        for (report_date, test_group_size, control_group_size,
+             test_conversion, control_conversion, goal_conversions) in reports:
+            for goal_type, test_count, control_count in goal_conversions:
+                goal_rows.append((
+                        report_ids[report_date], goal_type.id, test_count,
+                        control_count,
+                        self.__confidence(test_group_size, test_count,
+                                          control_group_size, control_count)))
+        bulk_insert(DailyConversionReportGoalData,
+                    ('report', 'goal_type', 'test_conversion',
+                     'control_conversion', 'confidence'),
+                    goal_rows)
+        report_cache.invalidate(experiment.id,
+                                [report[0] for report in reports])
+    
+
+class AggregateConversionReportGenerator(ConversionReportGenerator):
+    """
+    Computes the same reports as ConversionReportGenerator with three
+    aggregate queries per experiment and day, rather than one query per
+    participant, goal type and day.
+    """
+    def __init__(self):
+        ConversionReportGenerator.__init__(self)
+    
+    def find_participants(self, experiment, report_date):
+        return Participant.objects.filter(
+            experiment=experiment,
+            enrollment_date__lte=report_date,
+            anonymous_visitor__isnull=False).order_by()
+    
+    def count_conversions(self, experiment, report_date):
+        """
+        Returns a dictionary mapping (group, goal type id) to the number of
+        participants in that group who converted by the report date. Goal
+        type id None stands for any goal.
+        """
+        return self.count_participant_conversions(
+            self.find_participants(experiment, report_date), report_date)
+    
+    def count_participant_conversions(self, participants, report_date):
+        """
+        Returns the count_conversions() dictionary of the given participants,
+        searching their goal records.
+        """
+        # Participants with a goal record between their enrollment date and
+        # the end of the report date. Both conditions must be given in the
+        # same filter() call so that they apply to the same goal record.
+        converted = participants.filter(
+            anonymous_visitor__goalrecord__created__gte=F('enrollment_date'),
+            anonymous_visitor__goalrecord__created__lt=(
+                report_date + timedelta(days=1)))
+        return _count_converted(converted,
+                                'anonymous_visitor__goalrecord__goal_type')
+    
+    def generate_daily_report_for_experiment(self, experiment, report_date):
+        """ Generates a single conversion report """
+        group_sizes = dict(self.find_participants(
+                experiment, report_date).values_list('group').annotate(
+                Count('id')))
+        counts = self.count_conversions(experiment, report_date)
+        return self.create_report(experiment, *self.get_report_values(
+                report_date, group_sizes, counts, GoalType.objects.all()))
+    
+    def get_report_values(self, report_date, group_sizes, counts, goal_types):
+        """
+        Returns the create_report() arguments that follow the experiment,
+        given the group sizes and the conversion counts (as returned by
+        count_conversions()) on the report date.
+        """
+        goal_conversions = []
+        for goal_type in goal_types:
+            goal_conversions.append((
+                    goal_type,
+                    counts.get((Participant.TEST_GROUP, goal_type.id), 0),
+                    counts.get((Participant.CONTROL_GROUP, goal_type.id), 0)))
+        return (report_date,
+                group_sizes.get(Participant.TEST_GROUP, 0),
+                group_sizes.get(Participant.CONTROL_GROUP, 0),
+                counts.get((Participant.TEST_GROUP, None), 0),
+                counts.get((Participant.CONTROL_GROUP, None), 0),
+                goal_conversions)
+    
+
+class BackfillConversionReportGenerator(AggregateConversionReportGenerator):
+    """
+    Computes all the missing reports of an experiment in a single sweep.
+    Its participants and the date on which each of them first achieved
+    each goal type are loaded once, then counted cumulatively over the
+    report dates, and the reports are stored with bulk inserts.
+    """
+    def generate_daily_report_for_experiment(self, experiment, report_date):
+        self.generate_daily_reports_for_experiment(experiment, [report_date])
+    
+    def generate_daily_reports_for_experiment(self, experiment, report_dates):
+        report_dates = sorted(report_dates)
+        goal_types = list(GoalType.objects.all())
+        self.create_reports(experiment, [
+                self.get_report_values(report_date, group_sizes, counts,
+                                       goal_types)
+                for report_date, (group_sizes, counts) in zip(
+                    report_dates,
+                    self.compute_series(experiment, report_dates))])
+    
+    def compute_series(self, experiment, report_dates):
+        """
+        Returns one (group sizes, conversion counts) pair per date of the
+        sorted sequence `report_dates`, with the conversion counts keyed as
+        by count_conversions().
+        """
+        last_date = report_dates[-1]
+        participants = self.find_participants(experiment, last_date)
+        enrollments = [(enrollment_date, group) for group, enrollment_date
+                       in participants.values_list('group', 'enrollment_date')]
+        
+        first_dates = {}
+        for participant_id, group, goal_type_id, created in participants.filter(
+                anonymous_visitor__goalrecord__created__gte=F('enrollment_date'),
+                anonymous_visitor__goalrecord__created__lt=(
+                    last_date + timedelta(days=1))).values_list(
+                'id', 'group', 'anonymous_visitor__goalrecord__goal_type').annotate(
+                Min('anonymous_visitor__goalrecord__created')):
+            conversion_date = created.date()
+            first_dates[(participant_id, group, goal_type_id)] = conversion_date
+            any_goal = (participant_id, group, None)
+            first_dates[any_goal] = min(conversion_date,
+                                        first_dates.get(any_goal,
+                                                        conversion_date))
+        conversions = [(conversion_date, (group, goal_type_id))
+                       for (participant_id, group, goal_type_id), conversion_date
+                       in first_dates.iteritems()]
+        return zip(cumulative_counts(enrollments, report_dates),
+                   cumulative_counts(conversions, report_dates))
+    
+
+class NumpyConversionReportGenerator(BackfillConversionReportGenerator):
+    """
+    Computes all the missing reports of an experiment like
+    BackfillConversionReportGenerator, but loads the experiment's goal
+    records into NumPy arrays and derives each participant's first
+    conversion day and the cumulative counts with vectorized operations.
+    Falls back to the pure Python computation when NumPy is missing.
+    """
+    def compute_series(self, experiment, report_dates):
+        try:
+            import numpy
+        except ImportError:
+            return BackfillConversionReportGenerator.compute_series(
+                self, experiment, report_dates)
+        
+        last_date = report_dates[-1]
+        report_days = numpy.array([d.toordinal() for d in report_dates],
+                                  dtype=numpy.int64)
+        
+        enrollments = self.find_participants(experiment, last_date).values_list(
+            'group', 'enrollment_date')
+        groups = numpy.array([e[0] for e in enrollments], dtype=numpy.int64)
+        enrollment_days = numpy.array([e[1].toordinal() for e in enrollments],
+                                      dtype=numpy.int64)
+        group_sizes = _numpy_cumulative_counts(numpy, groups, enrollment_days,
+                                               report_days)
+        
+        records = list(GoalRecord.objects.filter(
+                anonymous_visitor__participant__experiment=experiment,
+                created__gte=F('anonymous_visitor__participant__enrollment_date'),
+                created__lt=last_date + timedelta(days=1)).values_list(
+                'anonymous_visitor', 'anonymous_visitor__participant__group',
+                'goal_type', 'created'))
+        visitors = numpy.array([r[0] for r in records], dtype=numpy.int64)
+        record_groups = numpy.array([r[1] for r in records], dtype=numpy.int64)
+        goal_type_ids, goal_codes = numpy.unique(
+            numpy.array([r[2] for r in records], dtype=numpy.int64),
+            return_inverse=True)
+        days = numpy.array([r[3].date().toordinal() for r in records],
+                           dtype=numpy.int64)
+        
+        # Sorting by visitor, goal type and day puts each visitor's first
+        # conversion to a goal type first in its run of records. The code
+        # one past the last goal type stands for any goal.
+        any_goal = len(goal_type_ids)
+        first_keys = []
+        first_days = []
+        for codes in (goal_codes, numpy.repeat(any_goal, len(records))):
+            order = numpy.lexsort((days, codes, visitors))
+            sorted_visitors = visitors[order]
+            sorted_codes = codes[order]
+            first = numpy.ones(len(order), dtype=bool)
+            first[1:] = ((sorted_visitors[1:] != sorted_visitors[:-1]) |
+                         (sorted_codes[1:] != sorted_codes[:-1]))
+            first_keys.append(record_groups[order][first] * (any_goal + 1) +
+                              sorted_codes[first])
+            first_days.append(days[order][first])
+        conversions = _numpy_cumulative_counts(
+            numpy, numpy.concatenate(first_keys),
+            numpy.concatenate(first_days), report_days)
+        
+        series = []
+        for i in range(len(report_dates)):
+            counts = {}
+            for key, key_counts in conversions.iteritems():
+                group, code = divmod(key, any_goal + 1)
+                if code == any_goal:
+                    goal_type_id = None
+                else:
+                    goal_type_id = int(goal_type_ids[code])
+                counts[(group, goal_type_id)] = int(key_counts[i])
+            series.append((dict((group, int(sizes[i]))
+                                for group, sizes in group_sizes.iteritems()),
+                           counts))
+        return series
+    
+
+class IncrementalConversionReportGenerator(AggregateConversionReportGenerator):
+    """
+    Computes conversion reports from the date on which each participant
+    first converted (ParticipantConversion), which is carried from one run
+    to the next. Each run only scans the goal records created since the
+    experiment's ConversionReportCheckpoint, so a nightly update costs one
+    day of traffic rather than the experiment's whole history.
+    
+    Goal records or enrollments stored after their day has been folded in
+    (for instance by a late write-behind drain) are not picked up. Delete
+    the experiment's checkpoint and ParticipantConversion rows to rebuild
+    them.
+    """
+    def count_conversions(self, experiment, report_date):
+        self.update_conversions(experiment, report_date)
+        conversions = ParticipantConversion.objects.filter(
+            participant__experiment=experiment,
+            date__lte=report_date).order_by()
+        return dict(((group, goal_type_id), count)
+                    for group, goal_type_id, count in conversions.values_list(
+                        'participant__group', 'goal_type').annotate(
+                        Count('id')))
+    
+    @transaction.commit_on_success
+    def update_conversions(self, experiment, report_date):
+        """
+        Folds the goal records created after the experiment's checkpoint and
+        up to the end of the report date into its ParticipantConversion rows.
+        """
+        try:
+            checkpoint = ConversionReportCheckpoint.objects.get(
+                experiment=experiment)
+        except ConversionReportCheckpoint.DoesNotExist:
+            checkpoint = ConversionReportCheckpoint(experiment=experiment)
+        else:
+            if checkpoint.date >= report_date:
+                return
+        
+        start_date = None
+        if checkpoint.date is not None:
+            start_date = checkpoint.date + timedelta(days=1)
+        self.fold_conversions(self.find_participants(experiment, report_date),
+                              start_date, report_date)
+        checkpoint.date = report_date
+        checkpoint.save()
+    
+    def fold_conversions(self, participants, start_date, end_date):
+        """
+        Stores the first conversions of `participants` among the goal records
+        created from the start date (or the participant's enrollment date,
+        if later or if start_date is None) to the end of the end date.
+        """
+        window = Q(anonymous_visitor__goalrecord__created__gte=F(
+                'enrollment_date'),
+                   anonymous_visitor__goalrecord__created__lt=(
+                end_date + timedelta(days=1)))
+        if start_date is not None:
+            window &= Q(anonymous_visitor__goalrecord__created__gte=start_date)
+        rows = participants.filter(window).values_list(
+            'id', 'anonymous_visitor__goalrecord__goal_type').annotate(
+            Min('anonymous_visitor__goalrecord__created'))
+        
+        first_dates = {}
+        for participant_id, goal_type_id, created in rows:
+            conversion_date = created.date()
+            first_dates[(participant_id, goal_type_id)] = conversion_date
+            any_goal = (participant_id, None)
+            first_dates[any_goal] = min(conversion_date,
+                                        first_dates.get(any_goal,
+                                                        conversion_date))
+        
+        # Conversions folded in by earlier runs happened first.
+        participant_ids = list(set(key[0] for key in first_dates))
+        for i in range(0, len(participant_ids), 500):
+            for key in ParticipantConversion.objects.filter(
+                    participant__in=participant_ids[i:i + 500]).values_list(
+                    'participant', 'goal_type'):
+                first_dates.pop(key, None)
+        bulk_insert(ParticipantConversion, ('participant', 'goal_type', 'date'),
+                    [key + (conversion_date,)
+                     for key, conversion_date in first_dates.items()])
+    
+
+class SharedScanConversionReportGenerator(IncrementalConversionReportGenerator):
+    """
+    Like IncrementalConversionReportGenerator, but before reporting folds
+    each day's goal records into the conversion state of all the
+    experiments being reported on with a single query, so that a goal
+    record is scanned once however many experiments its visitor takes part
+    in.
+    """
+    def prepare_reports(self, missing):
+        last_dates = dict((experiment.id, report_dates[-1])
+                          for experiment, report_dates in missing)
+        checkpoints = dict(ConversionReportCheckpoint.objects.filter(
+                experiment__in=last_dates.keys()).values_list(
+                'experiment', 'date'))
+        
+        # Experiments reported on for the first time need their whole
+        # history scanned once.
+        for experiment, report_dates in missing:
+            if experiment.id not in checkpoints:
+                self.update_conversions(experiment, report_dates[-1])
+        
+        checkpoints = dict((experiment_id, checkpoint_date)
+                           for experiment_id, checkpoint_date
+                           in checkpoints.iteritems()
+                           if checkpoint_date < last_dates[experiment_id])
+        if not checkpoints:
+            return
+        current_date = min(checkpoints.values()) + timedelta(days=1)
+        while current_date <= max(last_dates.values()):
+            experiment_ids = [experiment_id for experiment_id, checkpoint_date
+                              in checkpoints.iteritems()
+                              if checkpoint_date < current_date <=
+                              last_dates[experiment_id]]
+            if experiment_ids:
+                self.fold_day(experiment_ids, current_date)
+            current_date += timedelta(days=1)
+    
+    @transaction.commit_on_success
+    def fold_day(self, experiment_ids, report_date):
+        """
+        Folds the goal records created on the report date into the
+        conversion state of the given experiments, whose checkpoints must
+        be on the previous day.
+        """
+        participants = Participant.objects.filter(
+            experiment__in=experiment_ids,
+            enrollment_date__lte=report_date,
+            anonymous_visitor__isnull=False).order_by()
+        self.fold_conversions(participants, report_date, report_date)
+        ConversionReportCheckpoint.objects.filter(
+            experiment__in=experiment_ids).update(date=report_date)
     
 
+class FirstConversionReportGenerator(AggregateConversionReportGenerator):
+    """
+    Computes conversion reports by joining the participants with the
+    FirstConversion table, which holds one row per visitor and goal type
+    however many goal records the visitor produced, rather than with the
+    goal records. The table is brought up to date before reporting.
+    
+    A visitor may have first achieved a goal before enrolling, and achieved
+    it again since, or have goal records that have not been compacted yet
+    (the most recent ones are left for a later run): the conversions of
+    those participants are counted from their goal records instead.
+    """
+    def prepare_reports(self, missing):
+        if missing:
+            with lockfile(COMPACT_LOCKFILE, LOCK_EX, wait=True):
+                compact_all_goal_records()
+    
+    def count_conversions(self, experiment, report_date):
+        # Read first, so that goal records compacted in the meantime are
+        # counted from the goal records as well.
+        position = get_watermark(FIRST_CONVERSIONS).position
+        participants = self.find_participants(experiment, report_date)
+        uncompacted = participants.filter(
+            Q(anonymous_visitor__firstconversion__created__lt=F(
+                    'enrollment_date')) |
+            Q(anonymous_visitor__goalrecord__id__gt=position)).values('id')
+        counts = _count_converted(
+            participants.exclude(id__in=uncompacted).filter(
+                anonymous_visitor__firstconversion__created__lt=(
+                    report_date + timedelta(days=1))),
+            'anonymous_visitor__firstconversion__goal_type')
+        for key, count in self.count_participant_conversions(
+                participants.filter(id__in=uncompacted),
+                report_date).iteritems():
+            counts[key] = counts.get(key, 0) + count
+        return counts
+    
+
+CONVERSION_REPORT_ENGINES = {
+    'default': ConversionReportGenerator,
+    'aggregate': AggregateConversionReportGenerator,
+    'incremental': IncrementalConversionReportGenerator,
+    'backfill': BackfillConversionReportGenerator,
+    'numpy': NumpyConversionReportGenerator,
+    'shared': SharedScanConversionReportGenerator,
+    'first_conversion': FirstConversionReportGenerator,
+}
+
+
 class EngagementReportGenerator(BaseReportGenerator):
+    """
+    Generates engagement reports with the given engagement score calculator.
+    
+    If the calculator has a calculate_user_engagement_scores(user_enrollments,
+    report_date) method, it is called with lists of up to BATCH_SIZE
+    (user id, enrollment date) pairs, and must return their scores in the
+    same order. Otherwise calculate_user_engagement_score() is called for
+    each participant.
+    
+    If the calculator has a calculate_engagement_contributions(user_ids,
+    date) method instead, a user's score is the sum of their daily
+    contributions from their enrollment date up to the report date. The
+    method must return a {user id: contribution} dict for the given day
+    (users left out contribute 0). Contributions are stored as
+    DailyEngagementContribution rows and each user-day is only calculated
+    once, however many report dates and experiments include it.
+    
+    Scores are only accumulated into running statistics, and participants
+    are read in batches, so memory use does not grow with the size of the
+    groups.
+    """
+    BATCH_SIZE = 1000
+    CONTRIBUTION_BATCH_SIZE = 500
+    
     def __init__(self, engagement_score_calculator):
         BaseReportGenerator.__init__(self, DailyEngagementReport)
         self.engagement_score_calculator = engagement_score_calculator
     
     def __generate_scores(self, experiment, group, report_date):
         """
-        Returns an array of all scores for participants in the given group in the
+        Yields the scores of all the participants in the given group in the
         given experiment, as of the specified report date.
         """
         participants = Participant.objects.filter(
                             experiment=experiment,
                             group=group,
                             enrollment_date__lte=report_date).exclude(user=None)
-        scores = []
-        for participant in participants:
-            scores.append(self.engagement_score_calculator.
-                          calculate_user_engagement_score(participant.user,
-                                                          participant.enrollment_date,
-                                                          report_date))
-        return scores
+        calculate_contributions = getattr(
+            self.engagement_score_calculator,
+            'calculate_engagement_contributions', None)
+        if calculate_contributions is not None:
+            for score in self.__generate_contribution_scores(
+                    participants, report_date, calculate_contributions):
+                yield score
+            return
+        calculate_scores = getattr(self.engagement_score_calculator,
+                                   'calculate_user_engagement_scores', None)
+        if calculate_scores is not None:
+            user_enrollments = participants.values_list(
+                'user', 'enrollment_date').iterator()
+            while True:
+                batch = list(islice(user_enrollments, self.BATCH_SIZE))
+                if not batch:
+                    break
+                for score in calculate_scores(batch, report_date):
+                    yield score
+            return
+        for participant in participants.select_related('user').iterator():
+            yield (self.engagement_score_calculator.
+                   calculate_user_engagement_score(participant.user,
+                                                   participant.enrollment_date,
+                                                   report_date))
+    
+    def __sum_contributions(self, participants, report_date):
+        """
+        Returns {user id: (total, number of days)} of the contributions
+        stored for the participants between their enrollment and the report
+        date. Participants without any stored contribution are left out.
+        """
+        sums = participants.filter(
+            user__dailyengagementcontribution__date__gte=F('enrollment_date'),
+            user__dailyengagementcontribution__date__lte=report_date
+        ).values('user').annotate(
+            total=Sum('user__dailyengagementcontribution__value'),
+            days=Count('user__dailyengagementcontribution__id'))
+        return dict((row['user'], (row['total'], row['days']))
+                    for row in sums)
+    
+    def __calculate_contributions(self, user_enrollments, report_date,
+                                  calculate_contributions):
+        """
+        Calculates and stores the contributions missing for the given
+        (user id, enrollment date) pairs up to the report date.
+        """
+        first_date = min(enrollment_date
+                         for user_id, enrollment_date in user_enrollments)
+        existing = set(DailyEngagementContribution.objects.filter(
+            user__in=[user_id for user_id, enrollment_date in user_enrollments],
+            date__gte=first_date,
+            date__lte=report_date).values_list('user', 'date'))
+        missing = {}
+        for user_id, enrollment_date in user_enrollments:
+            day = enrollment_date
+            while day <= report_date:
+                if (user_id, day) not in existing:
+                    missing.setdefault(day, []).append(user_id)
+                day += timedelta(days=1)
+        for day, user_ids in sorted(missing.items()):
+            contributions = calculate_contributions(user_ids, day)
+            store_engagement_contributions(day, dict((user_id,
+                                           contributions.get(user_id, 0.0))
+                                          for user_id in user_ids))
+    
+    def __generate_contribution_scores(self, participants, report_date,
+                                       calculate_contributions):
+        """
+        Yields the participants' scores CONTRIBUTION_BATCH_SIZE participants
+        at a time: the contributions missing for a batch are calculated and
+        stored, then summed, so only one batch is held in memory.
+        """
+        # Seek past the last participant of the previous batch rather than
+        # keep a cursor open while contributions are being stored.
+        participants = participants.order_by('id')
+        last_id = 0
+        while True:
+            batch = list(participants.filter(id__gt=last_id).values_list(
+                    'id', 'user', 'enrollment_date')[
+                    :self.CONTRIBUTION_BATCH_SIZE])
+            if not batch:
+                break
+            last_id = batch[-1][0]
+            batch_participants = participants.filter(
+                id__in=[row[0] for row in batch])
+            sums = self.__sum_contributions(batch_participants, report_date)
+            incomplete = [(user_id, enrollment_date)
+                          for participant_id, user_id, enrollment_date in batch
+                          if sums.get(user_id, (0.0, 0))[1] <
+                          (report_date - enrollment_date).days + 1]
+            if incomplete:
+                self.__calculate_contributions(incomplete, report_date,
+                                               calculate_contributions)
+                sums = self.__sum_contributions(batch_participants,
+                                                report_date)
+            for participant_id, user_id, enrollment_date in batch:
+                yield sums.get(user_id, (0.0, 0))[0]
+    
+    def __generate_stats(self, experiment, group, report_date):
+        stats = RunningStats()
+        for score in self.__generate_scores(experiment, group, report_date):
+            stats.push(score)
+        return stats
     
     def generate_daily_report_for_experiment(self, experiment, report_date):
         """ Generates a single engagement report """
         try:
-            from numpy import mean, isnan
-            from scipy.stats import ttest_ind
+            from scipy.stats import ttest_ind_from_stats
         except ImportError:
-            from django_lean.experiments.stats import mean, isnan, ttest_ind 
-        test_group_scores = self.__generate_scores(
+            from django_lean.experiments.stats import ttest_ind_from_stats
+        from django_lean.experiments.stats import isnan
+        test_group_stats = self.__generate_stats(
             experiment, Participant.TEST_GROUP, report_date)
-        control_group_scores = self.__generate_scores(
+        control_group_stats = self.__generate_stats(
             experiment, Participant.CONTROL_GROUP, report_date)
         
         test_group_mean = None
         control_group_mean = None
         confidence = None
         
-        if len(test_group_scores):
-            test_group_mean = mean(test_group_scores)
-        if len(control_group_scores):
-            control_group_mean = mean(control_group_scores)
-        if len(test_group_scores) and len(control_group_scores):
-            t_value, p_value = ttest_ind(test_group_scores, control_group_scores)
+        if test_group_stats.count:
+            test_group_mean = test_group_stats.mean
+        if control_group_stats.count:
+            control_group_mean = control_group_stats.mean
+        if test_group_stats.count and control_group_stats.count:
+            t_value, p_value = ttest_ind_from_stats(
+                test_group_stats.mean, test_group_stats.stdev(),
+                test_group_stats.count,
+                control_group_stats.mean, control_group_stats.stdev(),
+                control_group_stats.count)
             if isnan(p_value):
                 confidence = None
             else:
@@ -281,7 +1248,7 @@ class EngagementReportGenerator(BaseReportGenerator):
             date=report_date,
             test_score=test_group_mean,
             control_score=control_group_mean,
-            test_group_size=len(test_group_scores),
-            control_group_size=len(control_group_scores),
+            test_group_size=test_group_stats.count,
+            control_group_size=control_group_stats.count,
             confidence=confidence)
     
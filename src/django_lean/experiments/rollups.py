@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Hourly rollups and first conversions of goal records.
+
+The rollup_goal_records management command folds the goal records stored
+since its previous run into HourlyGoalRollup counts per goal type,
+experiment, group and hour, so that dashboards can read small aggregates
+rather than scan the goal record table.
+
+The compact_goal_records management command likewise folds them into the
+FirstConversion table, which keeps a single row per anonymous visitor and
+goal type however many times the goal was achieved.
+"""
+import logging
+l = logging.getLogger(__name__)
+
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Max
+
+from django_lean.experiments.models import (FirstConversion, GoalRecord,
+                                            HourlyGoalRollup, ReportWatermark)
+from django_lean.utils import bulk_insert
+
+
+HOURLY_GOAL_ROLLUP = 'hourly_goal_rollup'
+FIRST_CONVERSIONS = 'first_conversions'
+
+# Held while compacting, so that the compact_goal_records command and the
+# report generators do not insert the same first conversions.
+COMPACT_LOCKFILE = 'compact_goal_records.lock'
+
+
+def get_watermark(name):
+    """Returns the ReportWatermark named `name`, creating it if needed."""
+    watermark, created = ReportWatermark.objects.get_or_create(name=name)
+    return watermark
+
+
+def get_compaction_cutoff():
+    """
+    Returns the time before which rows are assumed to be committed.
+
+    Ids are allocated when rows are inserted, but rows only become visible
+    when their transaction commits, so a row may appear below an id that
+    has already been read. Rows must commit within LEAN_COMPACTION_LAG
+    seconds (default 300) of the time they were created.
+    """
+    return datetime.now() - timedelta(
+        seconds=getattr(settings, 'LEAN_COMPACTION_LAG', 300))
+
+
+def get_settled_id(queryset, position, field, cutoff):
+    """
+    Returns the id of the last row of `queryset` past `position` that can
+    be read for good, or `position`: rows from the first one whose `field`
+    is not before `cutoff` are left out, as rows with lower ids may still
+    be committed after it.
+    """
+    queryset = queryset.filter(id__gt=position)
+    recent = list(queryset.filter(**{'%s__gte' % field: cutoff}).order_by(
+            'id').values_list('id', flat=True)[:1])
+    if recent:
+        queryset = queryset.filter(id__lt=recent[0])
+    return queryset.aggregate(Max('id'))['id__max'] or position
+
+
+@transaction.commit_on_success
+def rollup_goal_records(batch_size=10000):
+    """
+    Adds up to `batch_size` goal records past the watermark to the hourly
+    rollups, and returns the number of goal records read.
+
+    Goal records are counted for the experiments their visitor is enrolled
+    in when they are rolled up, like the daily reports count them: only
+    those recorded on or after the enrollment date. The counts and the
+    watermark are updated in the same transaction, so each goal record is
+    counted exactly once. Goal records created after the compaction cutoff,
+    and those that follow them, are left for a later run.
+    """
+    watermark = get_watermark(HOURLY_GOAL_ROLLUP)
+    settled_id = get_settled_id(GoalRecord.objects.all(), watermark.position,
+                                'created', get_compaction_cutoff())
+    ids = list(GoalRecord.objects.filter(
+            id__gt=watermark.position, id__lte=settled_id).order_by(
+            'id').values_list('id', flat=True)[:batch_size])
+    if not ids:
+        return 0
+
+    counts = {}
+    for goal_type_id, experiment_id, group, created in GoalRecord.objects.filter(
+            id__gt=watermark.position, id__lte=ids[-1],
+            anonymous_visitor__participant__isnull=False,
+            created__gte=F('anonymous_visitor__participant__enrollment_date')
+            ).values_list(
+            'goal_type', 'anonymous_visitor__participant__experiment',
+            'anonymous_visitor__participant__group', 'created'):
+        key = (goal_type_id, experiment_id, group,
+               created.replace(minute=0, second=0, microsecond=0))
+        counts[key] = counts.get(key, 0) + 1
+
+    existing = {}
+    if counts:
+        for rollup in HourlyGoalRollup.objects.filter(
+                hour__in=set(key[3] for key in counts),
+                experiment__in=set(key[1] for key in counts)).values_list(
+                'id', 'goal_type', 'experiment', 'group', 'hour'):
+            existing[rollup[1:]] = rollup[0]
+    # Existing rollups are incremented with one UPDATE per distinct count
+    # rather than per rollup, which is few statements per batch.
+    increments = {}
+    rows = []
+    for key, count in counts.iteritems():
+        if key in existing:
+            increments.setdefault(count, []).append(existing[key])
+        else:
+            rows.append(key + (count,))
+    for count, rollup_ids in increments.iteritems():
+        HourlyGoalRollup.objects.filter(id__in=rollup_ids).update(
+            count=F('count') + count)
+    bulk_insert(HourlyGoalRollup,
+                ('goal_type', 'experiment', 'group', 'hour', 'count'), rows)
+    ReportWatermark.objects.filter(id=watermark.id).update(position=ids[-1])
+    return len(ids)
+
+
+@transaction.commit_on_success
+def compact_goal_records(batch_size=10000):
+    """
+    Folds up to `batch_size` goal records past the watermark into the first
+    conversions, and returns the number of goal records read.
+
+    A goal record stored late (for instance by a write-behind drain) may
+    predate the first conversion already stored, which is then moved back.
+    Goal records created after the compaction cutoff, and those that follow
+    them, are left for a later run.
+    """
+    watermark = get_watermark(FIRST_CONVERSIONS)
+    settled_id = get_settled_id(GoalRecord.objects.all(), watermark.position,
+                                'created', get_compaction_cutoff())
+    records = list(GoalRecord.objects.filter(
+            id__gt=watermark.position, id__lte=settled_id).order_by(
+            'id').values_list('id', 'anonymous_visitor', 'goal_type',
+                              'created')[:batch_size])
+    if not records:
+        return 0
+
+    first = {}
+    for record_id, visitor_id, goal_type_id, created in records:
+        key = (visitor_id, goal_type_id)
+        if key not in first or created < first[key]:
+            first[key] = created
+
+    visitor_ids = list(set(key[0] for key in first))
+    for i in range(0, len(visitor_ids), 500):
+        for conversion_id, visitor_id, goal_type_id, created in (
+                FirstConversion.objects.filter(
+                anonymous_visitor__in=visitor_ids[i:i + 500]).values_list(
+                'id', 'anonymous_visitor', 'goal_type', 'created')):
+            key = (visitor_id, goal_type_id)
+            if key not in first:
+                continue
+            if first[key] < created:
+                FirstConversion.objects.filter(id=conversion_id).update(
+                    created=first[key])
+            del first[key]
+    bulk_insert(FirstConversion, ('anonymous_visitor', 'goal_type', 'created'),
+                [key + (created,) for key, created in first.iteritems()])
+    ReportWatermark.objects.filter(id=watermark.id).update(
+        position=records[-1][0])
+    return len(records)
+
+
+def compact_all_goal_records(batch_size=10000):
+    """
+    Folds all the goal records past the watermark into the first
+    conversions, `batch_size` per transaction, and returns their number.
+    """
+    total = 0
+    while True:
+        count = compact_goal_records(batch_size)
+        total += count
+        if count < batch_size:
+            return total
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+NumPy snapshots of experiment data, for offline analysis.
+
+A snapshot is an .npz file holding, for each participant of an experiment
+with an anonymous visitor (the participants conversion reports count):
+
+participant_ids, visitor_ids, groups
+    One entry per participant, in participant id order.
+enrollment_days
+    The participants' enrollment dates, as datetime64[D].
+goal_type_ids, goal_type_names
+    One entry per goal type.
+first_conversion_days
+    A (participants, goal types) datetime64[D] array with the date each
+    participant first achieved each goal type on or after enrolling, or NaT.
+first_any_conversion_days
+    The date each participant first achieved any goal, or NaT.
+last_participant_id, last_goal_record_id
+    The ids up to which participants and goal records were read, so that
+    updating the snapshot only reads the rows stored since. Participants
+    enrolled and goal records created since the compaction cutoff (see
+    django_lean.experiments.rollups) are left for a later update.
+"""
+import logging
+l = logging.getLogger(__name__)
+
+import os
+from datetime import date
+
+from django.db.models import Q
+
+from django_lean.experiments.models import GoalRecord, GoalType, Participant
+from django_lean.experiments.rollups import (get_compaction_cutoff,
+                                             get_settled_id)
+
+
+EPOCH = date(1970, 1, 1)
+# Stands for missing dates while a snapshot is being updated.
+NEVER = 2 ** 63 - 1
+
+ARRAYS = ('participant_ids', 'visitor_ids', 'groups', 'enrollment_days',
+          'goal_type_ids', 'goal_type_names', 'first_conversion_days',
+          'first_any_conversion_days', 'last_participant_id',
+          'last_goal_record_id')
+
+
+def get_snapshot_path(directory, experiment):
+    return os.path.join(directory, 'experiment_%d.npz' % experiment.id)
+
+
+def _days(numpy, dates):
+    return numpy.array([(d - EPOCH).days for d in dates], dtype=numpy.int64)
+
+
+def _empty_snapshot(numpy):
+    return {
+        'participant_ids': numpy.zeros(0, dtype=numpy.int64),
+        'visitor_ids': numpy.zeros(0, dtype=numpy.int64),
+        'groups': numpy.zeros(0, dtype=numpy.int8),
+        'enrollment_days': numpy.zeros(0, dtype=numpy.int64),
+        'goal_type_ids': numpy.zeros(0, dtype=numpy.int64),
+        'goal_type_names': numpy.zeros(0, dtype=numpy.unicode_),
+        'first_conversion_days': numpy.zeros((0, 0), dtype=numpy.int64),
+        'first_any_conversion_days': numpy.zeros(0, dtype=numpy.int64),
+        'last_participant_id': numpy.int64(0),
+        'last_goal_record_id': numpy.int64(0),
+    }
+
+
+def load_snapshot(path):
+    """
+    Returns the arrays of the snapshot stored in `path`, with dates as
+    int64 days since 1970-01-01 and missing dates as NEVER, or None if
+    there is no snapshot.
+    """
+    import numpy
+    if not os.path.exists(path):
+        return None
+    stored = numpy.load(path)
+    try:
+        snapshot = dict((name, stored[name]) for name in ARRAYS)
+    finally:
+        stored.close()
+    for name in ('enrollment_days', 'first_conversion_days',
+                 'first_any_conversion_days'):
+        days = snapshot[name].view(numpy.int64).copy()
+        days[numpy.isnat(snapshot[name])] = NEVER
+        snapshot[name] = days
+    return snapshot
+
+
+def save_snapshot(path, snapshot):
+    """Atomically replaces the snapshot stored in `path`."""
+    import numpy
+    arrays = dict(snapshot)
+    for name in ('enrollment_days', 'first_conversion_days',
+                 'first_any_conversion_days'):
+        days = arrays[name].copy()
+        days[days == NEVER] = numpy.datetime64('NaT').view(numpy.int64)
+        arrays[name] = days.view('datetime64[D]')
+    temporary = path + '.tmp'
+    f = open(temporary, 'wb')
+    try:
+        numpy.savez(f, **arrays)
+    finally:
+        f.close()
+    os.rename(temporary, path)
+
+
+def update_snapshot(experiment, path):
+    """
+    Creates or updates the snapshot of `experiment` stored in `path`, only
+    reading the participants and goal records stored since the previous
+    update. Returns the number of participants in the snapshot.
+    """
+    import numpy
+    snapshot = load_snapshot(path) or _empty_snapshot(numpy)
+    last_participant_id = int(snapshot['last_participant_id'])
+    last_goal_record_id = int(snapshot['last_goal_record_id'])
+    # Fix the watermarks first, so that rows stored while the snapshot is
+    # being updated are left for the next update. Recent rows are left out
+    # as well, as rows with lower ids may still be committed after them;
+    # enrollments only have a date, so those of the cutoff day wait for the
+    # next day.
+    cutoff = get_compaction_cutoff()
+    participant_id = get_settled_id(Participant.objects.all(),
+                                    last_participant_id, 'enrollment_date',
+                                    cutoff.date())
+    goal_record_id = get_settled_id(GoalRecord.objects.all(),
+                                    last_goal_record_id, 'created', cutoff)
+
+    participants = list(Participant.objects.filter(
+            experiment=experiment, anonymous_visitor__isnull=False,
+            id__gt=last_participant_id, id__lte=participant_id
+    ).order_by('id').values_list('id', 'anonymous_visitor', 'group',
+                                 'enrollment_date'))
+    if participants:
+        count = len(participants)
+        snapshot['participant_ids'] = numpy.concatenate([
+                snapshot['participant_ids'],
+                numpy.array([p[0] for p in participants], dtype=numpy.int64)])
+        snapshot['visitor_ids'] = numpy.concatenate([
+                snapshot['visitor_ids'],
+                numpy.array([p[1] for p in participants], dtype=numpy.int64)])
+        snapshot['groups'] = numpy.concatenate([
+                snapshot['groups'],
+                numpy.array([p[2] for p in participants], dtype=numpy.int8)])
+        snapshot['enrollment_days'] = numpy.concatenate([
+                snapshot['enrollment_days'],
+                _days(numpy, [p[3] for p in participants])])
+        snapshot['first_conversion_days'] = numpy.concatenate([
+                snapshot['first_conversion_days'],
+                numpy.empty((count, len(snapshot['goal_type_ids'])),
+                            dtype=numpy.int64)])
+        snapshot['first_conversion_days'][-count:] = NEVER
+        snapshot['first_any_conversion_days'] = numpy.concatenate([
+                snapshot['first_any_conversion_days'],
+                numpy.empty(count, dtype=numpy.int64)])
+        snapshot['first_any_conversion_days'][-count:] = NEVER
+
+    goal_types = list(GoalType.objects.exclude(
+            id__in=[int(i) for i in snapshot['goal_type_ids']]
+    ).order_by('id').values_list('id', 'name'))
+    if goal_types:
+        snapshot['goal_type_ids'] = numpy.concatenate([
+                snapshot['goal_type_ids'],
+                numpy.array([g[0] for g in goal_types], dtype=numpy.int64)])
+        snapshot['goal_type_names'] = numpy.concatenate([
+                snapshot['goal_type_names'],
+                numpy.array([g[1] for g in goal_types], dtype=numpy.unicode_)])
+        columns = numpy.empty((len(snapshot['participant_ids']),
+                               len(goal_types)), dtype=numpy.int64)
+        columns[:] = NEVER
+        snapshot['first_conversion_days'] = numpy.hstack([
+                snapshot['first_conversion_days'], columns])
+
+    # New goal records of all participants, and older goal records of the
+    # new participants.
+    records = list(GoalRecord.objects.filter(
+            Q(id__gt=last_goal_record_id) |
+            Q(anonymous_visitor__participant__id__gt=last_participant_id),
+            anonymous_visitor__participant__experiment=experiment,
+            anonymous_visitor__participant__id__lte=participant_id,
+            id__lte=goal_record_id
+    ).values_list('anonymous_visitor', 'goal_type', 'created'))
+    if records:
+        visitor_ids = snapshot['visitor_ids']
+        order = numpy.argsort(visitor_ids)
+        rows = order[numpy.searchsorted(
+                visitor_ids[order],
+                numpy.array([r[0] for r in records], dtype=numpy.int64))]
+        goal_type_ids = snapshot['goal_type_ids']
+        goal_order = numpy.argsort(goal_type_ids)
+        columns = goal_order[numpy.searchsorted(
+                goal_type_ids[goal_order],
+                numpy.array([r[1] for r in records], dtype=numpy.int64))]
+        days = _days(numpy, [r[2].date() for r in records])
+        converted = days >= snapshot['enrollment_days'][rows]
+        rows, columns, days = rows[converted], columns[converted], days[converted]
+        numpy.minimum.at(snapshot['first_conversion_days'], (rows, columns),
+                         days)
+        numpy.minimum.at(snapshot['first_any_conversion_days'], rows, days)
+
+    snapshot['last_participant_id'] = numpy.int64(participant_id)
+    snapshot['last_goal_record_id'] = numpy.int64(goal_record_id)
+    save_snapshot(path, snapshot)
+    return len(snapshot['participant_ids'])
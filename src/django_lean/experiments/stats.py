@@ -65,6 +65,34 @@ def stdev(inlist):
     """
     return sqrt(var(inlist))
 
+class RunningStats(object):
+    """
+    Accumulates the count, mean and sum of squared deviations from the mean
+    of a stream of values in constant memory, using Welford's method.
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+    
+    def push(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+    
+    def var(self):
+        """
+        Returns the variance of the values using N-1 for the denominator,
+        like var().
+        """
+        if self.count <= 1:
+            return 0.0
+        return self.m2 / (self.count - 1)
+    
+    def stdev(self):
+        return sqrt(self.var())
+
 def gammln(xx):
     """
     Returns the gamma function of xx.
@@ -157,9 +185,16 @@ def ttest_ind(a, b):
     Usage:   lttest_ind(a,b)
     Returns: t-value, two-tailed prob
     """
-    x1, x2 = mean(a), mean(b)
-    v1, v2 = stdev(a)**2, stdev(b)**2
-    n1, n2 = len(a), len(b)
+    return ttest_ind_from_stats(mean(a), stdev(a), len(a),
+                                mean(b), stdev(b), len(b))
+
+def ttest_ind_from_stats(x1, s1, n1, x2, s2, n2):
+    """
+    Calculates the T-test of ttest_ind() from the mean, standard deviation
+    (using N-1 in the denominator) and size of each sample.
+    Returns t-value, and two-tailed prob.
+    """
+    v1, v2 = s1**2, s2**2
     df = n1+n2-2
     try:
         svar = ((n1-1)*v1+(n2-1)*v2)/float(df)
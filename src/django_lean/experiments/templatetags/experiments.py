@@ -92,7 +92,7 @@ class ClientSideExperimentNode(BaseExperimentNode):
             context[self.CONTEXT_KEY]= {}
         
         if self.experiment_name not in context[self.CONTEXT_KEY]:
-            user = self.create_user(context)
+            user = self.get_user(context)
             group = None
             
             if Experiment.test(self.experiment_name, user):
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+from django.conf import settings
+from django.db import IntegrityError
+
+from django_lean.experiments.assignment import (HashAssignment,
+                                                get_anonymous_identity)
+from django_lean.experiments.models import Experiment, Participant
+from django_lean.experiments.signals import user_enrolled
+from django_lean.experiments.tests.utils import patch, TestCase, TestUser
+
+
+HASH_ASSIGNMENT = 'django_lean.experiments.assignment.HashAssignment'
+
+
+class TestHashAssignment(TestCase):
+    def setUp(self):
+        self.experiment = Experiment(name="hashed")
+        self.experiment.save()
+        self.experiment.state = Experiment.ENABLED_STATE
+        self.experiment.save()
+
+    def testStableGroups(self):
+        assignment = HashAssignment()
+        groups = [assignment.assign(self.experiment, 'user:%s' % i)
+                  for i in range(200)]
+        self.assertEquals(groups,
+                          [assignment.assign(self.experiment, 'user:%s' % i)
+                           for i in range(200)])
+        self.assertTrue(Participant.TEST_GROUP in groups)
+        self.assertTrue(Participant.CONTROL_GROUP in groups)
+
+    def testSplitRatios(self):
+        assignment = HashAssignment()
+        with patch(settings, 'LEAN_TEST_GROUP_RATIOS', {'hashed': 0.1}):
+            groups = [assignment.assign(self.experiment, 'user:%s' % i)
+                      for i in range(1000)]
+        test_count = groups.count(Participant.TEST_GROUP)
+        self.assertTrue(50 < test_count < 150)
+
+    def testNoReadsOnceRecorded(self):
+        with patch(settings, 'LEAN_GROUP_ASSIGNMENT', HASH_ASSIGNMENT):
+            with patch(settings, 'LEAN_EXPERIMENT_CACHE_TIMEOUT', 60):
+                for i in range(20):
+                    user = TestUser(username="user%s" % i)
+                    in_test = Experiment.test("hashed", user)
+                    self.assertNumQueries(
+                        0, lambda: Experiment.test("hashed", user))
+                    self.assertEquals(in_test,
+                                      Experiment.test("hashed", user))
+                    participant = Participant.objects.get(
+                        user=user.user, experiment=self.experiment)
+                    self.assertEquals(in_test, participant.group ==
+                                      Participant.TEST_GROUP)
+
+                    # A new session records nothing new.
+                    other_session = TestUser(username="user%s" % i)
+                    self.assertEquals(in_test,
+                                      Experiment.test("hashed", other_session))
+                    self.assertEquals(1, Participant.objects.filter(
+                        user=user.user).count())
+
+    def testAnonymousVisitors(self):
+        with patch(settings, 'LEAN_GROUP_ASSIGNMENT', HASH_ASSIGNMENT):
+            user = TestUser()
+            in_test = Experiment.test("hashed", user)
+            anonymous_id = user.get_anonymous_id()
+            self.assertNotEquals(None, anonymous_id)
+            expected = HashAssignment().assign(
+                self.experiment, get_anonymous_identity(anonymous_id))
+            self.assertEquals(in_test, expected == Participant.TEST_GROUP)
+            self.assertEquals(expected, Participant.objects.get(
+                anonymous_visitor=anonymous_id).group)
+
+    def testExistingEnrollments(self):
+        # Enrolled at random before hash assignment was enabled, in the
+        # other group than the hash gives.
+        user = TestUser(username="enrolled")
+        hashed = HashAssignment().assign(self.experiment,
+                                         'user:%s' % user.user.pk)
+        stored = 1 - hashed
+        Participant.objects.create(user=user.user, experiment=self.experiment,
+                                   group=stored)
+        with patch(settings, 'LEAN_GROUP_ASSIGNMENT', HASH_ASSIGNMENT):
+            with patch(settings, 'LEAN_EXPERIMENT_CACHE_TIMEOUT', 60):
+                in_test = stored == Participant.TEST_GROUP
+                self.assertEquals(in_test, Experiment.test("hashed", user))
+                self.assertNumQueries(
+                    0, lambda: Experiment.test("hashed", user))
+                self.assertEquals(in_test, Experiment.test("hashed", user))
+        self.assertEquals(stored, Participant.objects.get(
+                user=user.user).group)
+
+    def testFailedEnrollments(self):
+        # The participant can't be stored, and the user isn't enrolled yet.
+        enrollments = []
+        def on_enrolled(sender, group_id, **kwargs):
+            enrollments.append(group_id)
+        def create(**kwargs):
+            raise IntegrityError("foreign key constraint failed")
+        user_enrolled.connect(on_enrolled)
+        try:
+            with patch(settings, 'LEAN_GROUP_ASSIGNMENT', HASH_ASSIGNMENT):
+                user = TestUser(username="unstored")
+                with patch(Participant.objects, 'create', create):
+                    Experiment.test("hashed", user)
+                self.assertEquals([], enrollments)
+                # Nothing was recorded in the session, so it is retried.
+                Experiment.test("hashed", user)
+                self.assertEquals(1, len(enrollments))
+        finally:
+            user_enrolled.disconnect(on_enrolled)
+        self.assertEquals(enrollments[0], Participant.objects.get(
+                user=user.user).group)
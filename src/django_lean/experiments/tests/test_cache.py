@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+
+from django_lean.experiments.cache import (ExperimentCache, experiment_cache,
+                                           live_counters, report_cache)
+from django_lean.experiments.models import (AnonymousVisitor,
+                                            DailyConversionReport,
+                                            DailyConversionReportGoalData,
+                                            DailyEngagementReport, Experiment,
+                                            GoalRecord, GoalType, Participant)
+from django_lean.experiments.reports import (ConversionReportGenerator,
+                                             get_conversion_data,
+                                             get_daily_data,
+                                             get_live_conversion_data)
+from django_lean.experiments.tests.utils import patch, TestCase, TestUser
+
+
+class TestExperimentCache(TestCase):
+    def setUp(self):
+        self.experiment = Experiment(name="cached")
+        self.experiment.save()
+
+    def testCachedLookups(self):
+        user = TestUser(username="user1")
+        with patch(settings, 'LEAN_EXPERIMENT_CACHE_TIMEOUT', 60):
+            self.assertTrue(Experiment.control("cached", user))
+            self.assertNumQueries(0, lambda: Experiment.control("cached", user))
+            self.assertNumQueries(0, lambda: Experiment.test("undefined", user))
+
+    def testSaveInvalidates(self):
+        user = TestUser(username="user1")
+        with patch(settings, 'LEAN_EXPERIMENT_CACHE_TIMEOUT', 60):
+            self.assertFalse(Experiment.test("cached", user))
+            self.experiment.state = Experiment.ENABLED_STATE
+            self.experiment.save()
+            self.experiment.state = Experiment.PROMOTED_STATE
+            self.experiment.save()
+            self.assertTrue(Experiment.test("cached", user))
+            self.assertEquals(self.experiment.start_date,
+                              experiment_cache.get("cached").start_date)
+
+    def testDeleteInvalidates(self):
+        with patch(settings, 'LEAN_EXPERIMENT_CACHE_TIMEOUT', 60):
+            experiment_cache.get("cached")
+            self.experiment.delete()
+            self.assertRaises(Experiment.DoesNotExist,
+                              lambda: experiment_cache.get("cached"))
+
+    def testDisabled(self):
+        with patch(settings, 'LEAN_EXPERIMENT_CACHE_TIMEOUT', NotImplemented):
+            experiment_cache.get("cached")
+            self.assertNumQueries(1, lambda: experiment_cache.get("cached"))
+
+    def testSharedCache(self):
+        with patch(settings, 'LEAN_EXPERIMENT_CACHE_TIMEOUT', 60):
+            with patch(settings, 'LEAN_EXPERIMENT_SHARED_CACHE', True):
+                # Another process, sharing the same cache backend.
+                other_process = ExperimentCache()
+                self.assertEquals(Experiment.DISABLED_STATE,
+                                  other_process.get("cached").state)
+                # Reloads are only needed when the version changes.
+                other_process._expires = 0
+                self.assertNumQueries(0, lambda: other_process.get("cached"))
+                experiment_cache.invalidate()
+                other_process._expires = 0
+                self.assertNumQueries(1, lambda: other_process.get("cached"))
+                # Our own reload picks up the table published above.
+                self.assertNumQueries(0, lambda: experiment_cache.get("cached"))
+
+                self.experiment.state = Experiment.ENABLED_STATE
+                self.experiment.save()
+                self.assertEquals(Experiment.DISABLED_STATE,
+                                  other_process.get("cached").state)
+                other_process._expires = 0
+                self.assertEquals(Experiment.ENABLED_STATE,
+                                  other_process.get("cached").state)
+
+
+class TestReportCache(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.experiment = Experiment.objects.create(name="reported")
+        self.goal_type = GoalType.objects.create(name="signup")
+        self.yesterday = date.today() - timedelta(days=1)
+        self.start_date = date.today() - timedelta(days=3)
+        for days_ago in (1, 2, 3):
+            report_date = date.today() - timedelta(days=days_ago)
+            report = DailyConversionReport.objects.create(
+                experiment=self.experiment, date=report_date,
+                test_group_size=10, control_group_size=10,
+                overall_test_conversion=days_ago,
+                overall_control_conversion=1, confidence=None)
+            DailyConversionReportGoalData.objects.create(
+                report=report, goal_type=self.goal_type, test_conversion=1,
+                control_conversion=1, confidence=None)
+            DailyEngagementReport.objects.create(
+                experiment=self.experiment, date=report_date, test_score=1.0,
+                control_score=2.0, test_group_size=10, control_group_size=10,
+                confidence=None)
+
+    def getDailyData(self):
+        return get_daily_data(self.experiment, self.start_date,
+                              date.today())
+
+    def testCachedDays(self):
+        with patch(settings, 'LEAN_REPORT_CACHE_TIMEOUT', 60):
+            daily_data = self.getDailyData()
+            self.assertNumQueries(2, self.getDailyData)
+            self.assertEquals(daily_data, self.getDailyData())
+            # Only today's empty reports are looked up again.
+            self.assertNumQueries(0, lambda: get_daily_data(
+                    self.experiment, self.start_date, self.yesterday))
+            self.assertNumQueries(0, lambda: get_conversion_data(
+                    self.experiment, self.yesterday))
+
+    def testRegeneratedReportInvalidates(self):
+        with patch(settings, 'LEAN_REPORT_CACHE_TIMEOUT', 60):
+            self.getDailyData()
+            DailyConversionReport.objects.filter(
+                date=self.yesterday).delete()
+            self.assertEquals(None, get_conversion_data(self.experiment,
+                                                        self.yesterday))
+            ConversionReportGenerator().create_reports(
+                self.experiment,
+                [(self.yesterday, 10, 10, 5, 1, [(self.goal_type, 4, 1)])])
+            data = self.getDailyData()[1]["conversion_data"]
+            self.assertEquals(5, data["totals"]["test_count"])
+            self.assertEquals(4, data["goal_types"]["signup"]["test_count"])
+
+            DailyEngagementReport.objects.filter(
+                date=self.yesterday).update(test_score=3.0)
+            report = DailyEngagementReport.objects.get(date=self.yesterday)
+            self.assertEquals(1.0, self.getDailyData()[1]
+                              ["engagement_data"]["test_group_score"])
+            report.save()
+            self.assertEquals(3.0, self.getDailyData()[1]
+                              ["engagement_data"]["test_group_score"])
+
+    def testNewGoalTypeInvalidates(self):
+        with patch(settings, 'LEAN_REPORT_CACHE_TIMEOUT', 60):
+            self.getDailyData()
+            GoalType.objects.create(name="purchase")
+            data = get_conversion_data(self.experiment, self.yesterday)
+            self.assertEquals(None, data["goal_types"]["purchase"])
+
+    def testDisabled(self):
+        with patch(settings, 'LEAN_REPORT_CACHE_TIMEOUT', NotImplemented):
+            self.getDailyData()
+            self.assertNumQueries(4, self.getDailyData)
+            self.assertEquals({}, report_cache.get(self.experiment.id,
+                                                   [self.yesterday]))
+
+
+class TestLiveCounters(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.experiment = Experiment.objects.create(name="live")
+        self.experiment.state = Experiment.ENABLED_STATE
+        self.experiment.save()
+        self.signup = GoalType.objects.create(name="signup")
+        self.purchase = GoalType.objects.create(name="purchase")
+
+    def visit(self):
+        user = TestUser(anonymous_visitor=AnonymousVisitor.objects.create())
+        Experiment.test("live", user)
+        return user
+
+    def testCounts(self):
+        with patch(settings, 'LEAN_LIVE_COUNTERS', True):
+            with patch(settings, 'LEAN_LIVE_COUNTER_SHARDS', 2):
+                users = [self.visit() for i in range(6)]
+                for user in users[:3]:
+                    GoalRecord.record("signup", user)
+                    GoalRecord.record("signup", user)
+                GoalRecord.record("purchase", users[0])
+
+                # A visitor enrolled on an earlier day, converting today.
+                visitor = AnonymousVisitor.objects.create()
+                participant = Participant.objects.create(
+                    anonymous_visitor=visitor, experiment=self.experiment,
+                    group=Participant.TEST_GROUP)
+                participant.enrollment_date = date.today() - timedelta(days=2)
+                participant.save()
+                returning = TestUser(anonymous_visitor=visitor)
+                self.assertTrue(Experiment.test("live", returning))
+                GoalRecord.record("signup", returning)
+                # Registered users are not counted by the reports either.
+                Experiment.test("live", TestUser(username="registered"))
+
+                data = get_live_conversion_data(self.experiment, date.today())
+        groups = [Participant.objects.get(anonymous_visitor=user.anonymous_id
+                                          ).group for user in users]
+        control = groups.count(Participant.CONTROL_GROUP)
+        self.assertEquals(control, data["control_group_size"])
+        self.assertEquals(6 - control, data["test_group_size"])
+        converted = groups[:3]
+        signup = data["goal_types"]["signup"]
+        self.assertEquals(converted.count(Participant.CONTROL_GROUP),
+                          signup["control_count"])
+        self.assertEquals(converted.count(Participant.TEST_GROUP),
+                          signup["test_count"])
+        self.assertEquals(None, signup["confidence"])
+        self.assertEquals(1, data["goal_types"]["purchase"]["control_count"] +
+                          data["goal_types"]["purchase"]["test_count"])
+        self.assertEquals(3, data["totals"]["control_count"] +
+                          data["totals"]["test_count"])
+
+        # Other days have their own counters.
+        data = get_live_conversion_data(self.experiment,
+                                        date.today() - timedelta(days=1))
+        self.assertEquals(0, data["control_group_size"] +
+                          data["test_group_size"])
+
+    def testDisabled(self):
+        with patch(settings, 'LEAN_LIVE_COUNTERS', NotImplemented):
+            GoalRecord.record("signup", self.visit())
+        self.assertEquals({}, cache.get_many(
+                [live_counters._key(date.today(), self.experiment.id, group,
+                                    live_counters.ENROLLED, shard)
+                 for group in (0, 1)
+                 for shard in range(live_counters.get_shards())]))
@@ -3,18 +3,33 @@ import logging
 l = logging.getLogger(__name__)
 
 import mox
+import os
+import shutil
+import tempfile
 
 from datetime import date, datetime, time, timedelta
 
-from django_lean.experiments.models import (Experiment, DailyEngagementReport,
+from django.db.models import F
+
+from django_lean.experiments.models import (ConversionReportCheckpoint,
+                                            DailyEngagementContribution,
+                                            Experiment, DailyEngagementReport,
+                                            FirstConversion,
                                             DailyConversionReport,
                                             DailyConversionReportGoalData,
                                             Participant, AnonymousVisitor,
                                             GoalType, GoalRecord)
 from django_lean.experiments.reports import (EngagementReportGenerator,
                                              ConversionReportGenerator,
+                                             AggregateConversionReportGenerator,
+                                             FirstConversionReportGenerator,
+                                             BackfillConversionReportGenerator,
+                                             NumpyConversionReportGenerator,
+                                             SharedScanConversionReportGenerator,
+                                             IncrementalConversionReportGenerator,
                                              calculate_participant_conversion,
                                              get_conversion_data,
+                                             get_daily_data,
                                              calculate_goal_type_conversion,
                                              find_experiment_group_participants)
 from django_lean.experiments.tests.utils import create_user_in_group, TestCase
@@ -104,6 +119,94 @@ class TestDailyReports(TestCase):
         self.assertEquals(4, experiment_report.control_group_size)
         self.assertAlmostEqual(96.819293337188498, experiment_report.confidence)
     
+    def testBulkEngagementScoreCalculator(self):
+        users = []
+        for i in range(6):
+            users.append(create_user_in_group(self.experiment, i, i % 2,
+                                              date.today() - timedelta(days=i)))
+        report_date = date.today() - timedelta(days=1)
+        calls = []
+        
+        class BulkEngagementScoreCalculator(object):
+            def calculate_user_engagement_score(self, user, start_date,
+                                                end_date):
+                return user.id * 1.5 + (end_date - start_date).days
+            
+            def calculate_user_engagement_scores(self, user_enrollments,
+                                                 report_date):
+                calls.append(user_enrollments)
+                return [user_id * 1.5 + (report_date - start_date).days
+                        for user_id, start_date in user_enrollments]
+        
+        (EngagementReportGenerator(BulkEngagementScoreCalculator()).
+           generate_daily_report_for_experiment(self.experiment, report_date))
+        self.assertEquals(2, len(calls))
+        self.assertEquals(5, sum(len(c) for c in calls))
+        bulk_report = DailyEngagementReport.objects.get(
+            experiment=self.experiment, date=report_date)
+        bulk_report.delete()
+        
+        del BulkEngagementScoreCalculator.calculate_user_engagement_scores
+        (EngagementReportGenerator(BulkEngagementScoreCalculator()).
+           generate_daily_report_for_experiment(self.experiment, report_date))
+        report = DailyEngagementReport.objects.get(experiment=self.experiment,
+                                                   date=report_date)
+        self.assertAlmostEqual(report.test_score, bulk_report.test_score)
+        self.assertAlmostEqual(report.control_score, bulk_report.control_score)
+        self.assertAlmostEqual(report.confidence, bulk_report.confidence)
+        self.assertEquals(2, len(calls))
+    
+    def testEngagementContributions(self):
+        for i in range(6):
+            create_user_in_group(self.experiment, i, i % 2,
+                                 date.today() - timedelta(days=i))
+        calls = []
+        
+        # Users left out of the contributions score 0 on that day.
+        def contribution(user_id, day):
+            if user_id % 2:
+                return user_id + day.toordinal() % 3
+            return 0
+        
+        class ContributionCalculator(object):
+            def calculate_user_engagement_score(self, user, start_date,
+                                                end_date):
+                return sum(contribution(user.id, start_date + timedelta(days=i))
+                           for i in range((end_date - start_date).days + 1))
+            
+            def calculate_engagement_contributions(self, user_ids, day):
+                calls.extend((user_id, day) for user_id in user_ids)
+                return dict((user_id, contribution(user_id, day))
+                            for user_id in user_ids if user_id % 2)
+        
+        generator = EngagementReportGenerator(ContributionCalculator())
+        # Several batches of participants per group.
+        generator.CONTRIBUTION_BATCH_SIZE = 2
+        for days_ago in (3, 2, 1):
+            generator.generate_daily_report_for_experiment(
+                self.experiment, date.today() - timedelta(days=days_ago))
+        # Every user-day is calculated exactly once.
+        self.assertEquals(len(calls), len(set(calls)))
+        self.assertEquals(len(calls),
+                          DailyEngagementContribution.objects.count())
+        self.assertEquals(6 + 4 + 5, len(calls))
+        contribution_report = DailyEngagementReport.objects.get(
+            experiment=self.experiment, date=date.today() - timedelta(days=1))
+        
+        del ContributionCalculator.calculate_engagement_contributions
+        report_date = date.today() - timedelta(days=1)
+        DailyEngagementReport.objects.all().delete()
+        (EngagementReportGenerator(ContributionCalculator()).
+           generate_daily_report_for_experiment(self.experiment, report_date))
+        report = DailyEngagementReport.objects.get(experiment=self.experiment,
+                                                   date=report_date)
+        self.assertAlmostEqual(report.test_score,
+                               contribution_report.test_score)
+        self.assertAlmostEqual(report.control_score,
+                               contribution_report.control_score)
+        self.assertEquals(report.test_group_size,
+                          contribution_report.test_group_size)
+    
     def testZeroParticipantExperiment(self):
         mocker = mox.Mox()
         engagement_calculator = mocker.CreateMockAnything()
@@ -421,6 +524,43 @@ class TestDailyReports(TestCase):
         self.assertAlmostEquals((23./139-21./142)/(21./142)*100.,
                                 data["goal_types"][goal_types[2].name]["improvement"])
 
+    
+    def testGetDailyData(self):
+        days = [datetime.combine(date.today() + timedelta(days=i), time(hour=12))
+                for i in range(-7, 0)]
+        self.create_conversion_data(days)
+        for day in days[1:]:
+            ConversionReportGenerator().generate_daily_report_for_experiment(
+                self.experiment, day.date())
+        engagement_report = DailyEngagementReport.objects.create(
+            experiment=self.experiment, date=days[2].date(), test_score=2.5,
+            control_score=2.0, test_group_size=4, control_group_size=5,
+            confidence=60.0)
+        start_date = days[0].date() - timedelta(days=1)
+        end_date = days[-1].date()
+        
+        with self.assertNumQueries(4):
+            daily_data = get_daily_data(self.experiment, start_date, end_date)
+        self.assertEquals((end_date - start_date).days + 1, len(daily_data))
+        for data in daily_data:
+            self.assertEquals(get_conversion_data(self.experiment,
+                                                  data["date"]),
+                              data["conversion_data"])
+            if data["date"] == engagement_report.date:
+                self.assertEquals(2.5, data["engagement_data"]["test_group_score"])
+                self.assertAlmostEqual(25.0, data["engagement_data"]
+                                       ["test_group_improvement"])
+            else:
+                self.assertEquals(None, data["engagement_data"])
+        self.assertEquals(end_date, daily_data[0]["date"])
+        self.assertEquals(None, daily_data[-1]["conversion_data"])
+        self.assertEquals(None, daily_data[-2]["conversion_data"])
+        self.assertTrue(daily_data[0]["conversion_data"])
+        
+        weekly_data = get_daily_data(self.experiment, start_date, end_date,
+                                     step=7)
+        self.assertEquals([daily_data[0], daily_data[7]], weekly_data)
+
 
 #TODO test with zero participants and check rate == None
 
@@ -559,3 +699,167 @@ class TestDailyReports(TestCase):
             goal_type=goal_types[0])[0].confidence
         self.assertAlmostEqual(98.935467172597029, day_5_goal_0_confidence, places=6)
     
+    
+    def get_conversion_reports(self, experiment):
+        reports = []
+        for report in DailyConversionReport.objects.filter(
+                experiment=experiment).order_by('date'):
+            goal_data = sorted((g.goal_type_id, g.test_conversion,
+                                g.control_conversion, g.confidence)
+                               for g in report.goal_data.all())
+            reports.append((report.date, report.test_group_size,
+                            report.control_group_size,
+                            report.overall_test_conversion,
+                            report.overall_control_conversion,
+                            report.confidence, goal_data))
+        return reports
+    
+    def create_conversion_data(self, days):
+        goal_types = [GoalType.objects.create(name="%s" % i) for i in range(3)]
+        experiments = [self.experiment, self.other_experiment]
+        
+        for i in range(40):
+            anonymous_visitor = AnonymousVisitor.objects.create()
+            enrollment_day = days[i % 5]
+            for j, experiment in enumerate(experiments):
+                if (i + j) % 3:
+                    self.create_participant(
+                        anonymous_visitor=anonymous_visitor,
+                        experiment=experiment,
+                        enrollment_date=enrollment_day.date(),
+                        group=(i + j) % 2)
+            # Goals before, on and after the enrollment date, some of them
+            # recorded more than once.
+            for k in range(i % 4):
+                self.create_goal_record(days[(i + 2 * k) % 7],
+                                        anonymous_visitor,
+                                        goal_types[(i + k) % 3])
+            self.create_goal_record(enrollment_day.replace(hour=0),
+                                    anonymous_visitor,
+                                    goal_types[i % 3])
+        return goal_types
+    
+    def assertSameConversionReports(self, generator, days):
+        for experiment in [self.experiment, self.other_experiment]:
+            for day in days:
+                ConversionReportGenerator().generate_daily_report_for_experiment(
+                    experiment, day)
+            expected = self.get_conversion_reports(experiment)
+            self.assertTrue([r for r in expected if r[3] and r[4]])
+            DailyConversionReport.objects.filter(experiment=experiment).delete()
+            generator.generate_daily_reports_for_experiment(experiment, days)
+            self.assertEquals(expected,
+                              self.get_conversion_reports(experiment))
+            DailyConversionReport.objects.filter(experiment=experiment).delete()
+    
+    def testAggregateConversionReportGenerator(self):
+        days = [datetime.combine(date.today() + timedelta(days=i), time(hour=12))
+                for i in range(-7, 0)]
+        self.create_conversion_data(days)
+        self.assertSameConversionReports(AggregateConversionReportGenerator(),
+                                         [d.date() for d in days])
+    
+    def testFirstConversionReportGenerator(self):
+        days = [datetime.combine(date.today() + timedelta(days=i), time(hour=12))
+                for i in range(-7, 0)]
+        goal_types = self.create_conversion_data(days)
+        generator = FirstConversionReportGenerator()
+        directory = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            generator.prepare_reports(generator.find_missing_reports())
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(directory)
+        self.assertEquals(
+            GoalRecord.objects.values('anonymous_visitor', 'goal_type'
+                                      ).distinct().count(),
+            FirstConversion.objects.count())
+        # Some participants converted before enrolling, and again since.
+        self.assertTrue(Participant.objects.filter(
+                anonymous_visitor__firstconversion__created__lt=F(
+                    'enrollment_date')).exists())
+        self.assertSameConversionReports(generator, [d.date() for d in days])
+        
+        # Goal records that have not been compacted yet still count.
+        visitor = Participant.objects.filter(
+            experiment=self.experiment, anonymous_visitor__isnull=False,
+            anonymous_visitor__goalrecord__isnull=True)[0].anonymous_visitor
+        self.create_goal_record(days[-1], visitor, goal_types[0])
+        self.assertSameConversionReports(generator, [d.date() for d in days])
+    
+    def testIncrementalConversionReportGenerator(self):
+        days = [datetime.combine(date.today() + timedelta(days=i), time(hour=12))
+                for i in range(-7, 0)]
+        goal_types = self.create_conversion_data(days)
+        generator = IncrementalConversionReportGenerator()
+        self.assertSameConversionReports(generator, [d.date() for d in days])
+        
+        # Later runs only fold in the goal records of the new day, and can
+        # still report on earlier days.
+        today = date.today()
+        self.assertEquals(days[-1].date(), ConversionReportCheckpoint.objects.get(
+                experiment=self.experiment).date)
+        visitor = Participant.objects.filter(
+            experiment=self.experiment, anonymous_visitor__isnull=False,
+            anonymous_visitor__goalrecord__isnull=True)[0].anonymous_visitor
+        self.create_goal_record(datetime.combine(today, time(hour=1)),
+                                visitor, goal_types[0])
+        self.assertSameConversionReports(
+            generator, [today] + [d.date() for d in days])
+        self.assertEquals(today, ConversionReportCheckpoint.objects.get(
+                experiment=self.experiment).date)
+    
+    def testBackfillConversionReportGenerator(self):
+        days = [datetime.combine(date.today() + timedelta(days=i), time(hour=12))
+                for i in range(-7, 0)]
+        self.create_conversion_data(days)
+        self.assertSameConversionReports(BackfillConversionReportGenerator(),
+                                         [d.date() for d in days])
+        
+        self.assertSameConversionReports(NumpyConversionReportGenerator(),
+                                         [d.date() for d in days])
+        
+        # Only the missing reports are generated.
+        ConversionReportGenerator().generate_daily_report_for_experiment(
+            self.experiment, self.experiment.start_date)
+        expected = self.get_conversion_reports(self.experiment)
+        BackfillConversionReportGenerator().generate_all_daily_reports()
+        reports = self.get_conversion_reports(self.experiment)
+        self.assertEquals(5, len(reports))
+        self.assertEquals(expected, reports[:1])
+        DailyConversionReport.objects.filter(experiment=self.experiment).delete()
+        ConversionReportGenerator().generate_all_daily_reports()
+        self.assertEquals(reports, self.get_conversion_reports(self.experiment))
+    
+    def testSharedScanConversionReportGenerator(self):
+        days = [datetime.combine(date.today() + timedelta(days=i), time(hour=12))
+                for i in range(-7, 0)]
+        goal_types = self.create_conversion_data(days)
+        experiments = [self.experiment, self.other_experiment]
+        ConversionReportGenerator().generate_all_daily_reports()
+        expected = [self.get_conversion_reports(e) for e in experiments]
+        DailyConversionReport.objects.all().delete()
+        
+        # The first experiment already has conversion state for its first
+        # day, the other one has none yet.
+        IncrementalConversionReportGenerator().generate_daily_report_for_experiment(
+            self.experiment, self.experiment.start_date)
+        generator = SharedScanConversionReportGenerator()
+        missing = generator.find_missing_reports()
+        generator.prepare_reports(missing)
+        self.assertEquals(
+            [self.experiment.end_date or days[-1].date(),
+             self.other_experiment.end_date],
+            [ConversionReportCheckpoint.objects.get(experiment=e).date
+             for e in experiments])
+        # No goal records are scanned while reporting: each report takes
+        # the checkpoint, the group sizes, the conversion counts, the goal
+        # types and the inserts.
+        for experiment, report_dates in missing:
+            with self.assertNumQueries((5 + len(goal_types)) * len(report_dates)):
+                generator.generate_daily_reports_for_experiment(
+                    experiment, report_dates)
+        self.assertEquals(expected,
+                          [self.get_conversion_reports(e) for e in experiments])
@@ -3,16 +3,27 @@ from __future__ import with_statement
 import logging
 l = logging.getLogger(__name__)
 
+import csv
+import gzip
+import os
+import shutil
+import tempfile
+from cStringIO import StringIO
 from datetime import timedelta
 
 from django.conf import settings
 from django.core.management.base import CommandError
+from django.utils import simplejson
 
-from django_lean.experiments.models import (Experiment, DailyEngagementReport,
-                                            DailyConversionReport)
+from django_lean.experiments.models import (AnonymousVisitor, Experiment,
+                                            DailyEngagementReport,
+                                            DailyConversionReport,
+                                            GoalRecord, GoalType, Participant)
 from django_lean.experiments.management.commands import (
-    update_experiment_reports
+    export_experiment_data, update_experiment_reports
 )
+from django_lean.experiments.reports import (ConversionReportGenerator,
+                                             generate_reports)
 from django_lean.experiments.tests.utils import patch, TestCase
 
 class TestManagement(TestCase):
@@ -46,3 +57,97 @@ class TestManagement(TestCase):
             self.assertEquals(5, DailyConversionReport.objects.filter(
                     experiment=self.experiment).count())
     
+    
+    def testManageCommandOptions(self):
+        self.runner = update_experiment_reports.Command().run_from_argv
+        self.runner(['manage.py', 'update_experiment_reports',
+                     '--engine=backfill', '--workers=1', '--wait'])
+        self.assertEquals(5, DailyConversionReport.objects.filter(
+                experiment=self.experiment).count())
+    
+    def testFailuresAreIsolated(self):
+        broken_experiment = Experiment(name="broken_experiment")
+        broken_experiment.save()
+        broken_experiment.state = Experiment.ENABLED_STATE
+        broken_experiment.save()
+        broken_experiment.start_date = self.experiment.start_date
+        broken_experiment.save()
+        
+        class FailingReportGenerator(ConversionReportGenerator):
+            def generate_daily_report_for_experiment(self, experiment,
+                                                     report_date):
+                if experiment == broken_experiment:
+                    raise Exception("broken")
+                ConversionReportGenerator.generate_daily_report_for_experiment(
+                    self, experiment, report_date)
+        
+        failed = generate_reports(FailingReportGenerator())
+        self.assertEquals([broken_experiment.id], [f[0] for f in failed])
+        self.assertEquals(5, len(failed[0][1]))
+        self.assertEquals(5, DailyConversionReport.objects.filter(
+                experiment=self.experiment).count())
+        self.assertEquals(0, DailyConversionReport.objects.filter(
+                experiment=broken_experiment).count())
+
+
+class TestExportExperimentData(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.experiment = Experiment.objects.create(name="exported")
+        other_experiment = Experiment.objects.create(name="other")
+        goal_type = GoalType.objects.create(name="signup")
+        for i in range(7):
+            visitor = AnonymousVisitor.objects.create()
+            Participant.objects.create(anonymous_visitor=visitor,
+                                       experiment=self.experiment,
+                                       group=i % 2)
+            Participant.objects.create(anonymous_visitor=visitor,
+                                       experiment=other_experiment,
+                                       group=i % 2)
+            GoalRecord.objects.create(anonymous_visitor=visitor,
+                                      goal_type=goal_type)
+        GoalRecord.objects.create(
+            anonymous_visitor=AnonymousVisitor.objects.create(),
+            goal_type=goal_type)
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def export(self, *args, **options):
+        path = os.path.join(self.directory, 'export')
+        export_experiment_data.Command().handle(
+            "exported", *args, **dict(options, output=path, verbosity=0))
+        if options.get('gzip'):
+            return gzip.open(path).read()
+        return open(path).read()
+    
+    def testJSONLines(self):
+        records = [simplejson.loads(line) for line in
+                   self.export("participants", batch_size=3).splitlines()]
+        participants = Participant.objects.filter(
+            experiment=self.experiment).order_by('id')
+        self.assertEquals([p.id for p in participants],
+                          [r['id'] for r in records])
+        self.assertEquals(participants[0].enrollment_date.isoformat(),
+                          records[0]['enrollment_date'])
+        self.assertEquals(None, records[0]['user_id'])
+    
+    def testResumeCompressedCSV(self):
+        goal_records = GoalRecord.objects.filter(
+            anonymous_visitor__participant__experiment=self.experiment
+        ).order_by('id')
+        rows = list(csv.reader(StringIO(self.export(
+                        "goal_records", format='csv', gzip=True,
+                        batch_size=2, after_id=goal_records[2].id))))
+        self.assertEquals(['id', 'anonymous_visitor_id', 'goal_type',
+                           'created'], rows[0])
+        self.assertEquals([str(g.id) for g in goal_records[3:]],
+                          [row[0] for row in rows[1:]])
+        self.assertEquals('signup', rows[1][2])
+    
+    def testArguments(self):
+        command = export_experiment_data.Command()
+        self.assertRaises(CommandError, command.handle, "exported")
+        self.assertRaises(CommandError, command.handle, "exported", "users")
+        self.assertRaises(CommandError, command.handle, "unknown",
+                          "participants")
@@ -1,8 +1,18 @@
 # -*- coding: utf-8 -*-
+from __future__ import with_statement
+
 from django.conf import settings
+from django.contrib.auth.models import User
+
+from django_lean.experiments.models import Experiment, Participant
+from django_lean.experiments.tests.utils import patch, TestCase, TestUser
+from django_lean.experiments.utils import WebUser
 
-from django_lean.experiments.models import Experiment
-from django_lean.experiments.tests.utils import TestCase, TestUser
+
+class Request(object):
+    def __init__(self, user, session):
+        self.user = user
+        self.session = session
 
 
 class TestParticipants(TestCase):
@@ -116,3 +126,37 @@ class TestParticipants(TestCase):
         self.assertFalse(Experiment.test("enabled", control_user))
         self.assertFalse(Experiment.test("enabled", test_user))
     
+
+    def testEnrollmentsMemoizedPerRequest(self):
+        experiments = []
+        for name in ("enabled1", "enabled2", "enabled3"):
+            experiment = Experiment(name=name)
+            experiment.save()
+            experiment.state = Experiment.ENABLED_STATE
+            experiment.save()
+            experiments.append(experiment)
+        user = User.objects.create(username="user1",
+                                   email="user1@example.com")
+        Participant.objects.create(user=user, experiment=experiments[0],
+                                   group=Participant.TEST_GROUP)
+        Participant.objects.create(user=user, experiment=experiments[1],
+                                   group=Participant.CONTROL_GROUP)
+
+        with patch(settings, 'LEAN_EXPERIMENT_CACHE_TIMEOUT', 60):
+            Experiment.test("enabled1", TestUser())
+            request = Request(user=user, session={})
+            # All of the user's enrollments are loaded at once...
+            self.assertNumQueries(
+                1, lambda: Experiment.test("enabled1", WebUser(request)))
+            # ... and reused for the rest of the request.
+            self.assertNumQueries(
+                0, lambda: Experiment.control("enabled2", WebUser(request)))
+            self.assertTrue(Experiment.test("enabled1", WebUser(request)))
+            self.assertTrue(Experiment.control("enabled2", WebUser(request)))
+            # New enrollments are remembered as well.
+            in_test = Experiment.test("enabled3", WebUser(request))
+            self.assertNumQueries(
+                0, lambda: Experiment.test("enabled3", WebUser(request)))
+            self.assertEquals(in_test,
+                              Experiment.test("enabled3", WebUser(request)))
+            self.assertEquals(3, Participant.objects.filter(user=user).count())
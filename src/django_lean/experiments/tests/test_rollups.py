@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+from datetime import date, datetime, timedelta
+
+from django.core.management import call_command
+
+from django_lean.experiments.models import (AnonymousVisitor, Experiment,
+                                            FirstConversion, GoalRecord,
+                                            GoalType, HourlyGoalRollup,
+                                            Participant)
+from django_lean.experiments.rollups import (compact_goal_records,
+                                             rollup_goal_records)
+from django_lean.experiments.tests.utils import TestCase
+
+
+class TestHourlyGoalRollup(TestCase):
+    def setUp(self):
+        self.experiments = [Experiment.objects.create(name="first"),
+                            Experiment.objects.create(name="second")]
+        self.goal_type = GoalType.objects.create(name="signup")
+        self.visitors = []
+        for i in range(3):
+            visitor = AnonymousVisitor.objects.create()
+            for experiment in self.experiments[:i + 1]:
+                participant = Participant.objects.create(
+                    anonymous_visitor=visitor, experiment=experiment,
+                    group=i % 2)
+                participant.enrollment_date = date(2010, 1, 1)
+                participant.save()
+            self.visitors.append(visitor)
+        # Not enrolled in any experiment.
+        self.visitors.append(AnonymousVisitor.objects.create())
+
+    def record(self, visitor, created):
+        goal_record = GoalRecord.objects.create(anonymous_visitor=visitor,
+                                                goal_type=self.goal_type)
+        goal_record.created = created
+        goal_record.save()
+
+    def get_counts(self):
+        return dict(((r.experiment.name, r.group, r.hour), r.count)
+                    for r in HourlyGoalRollup.objects.all())
+
+    def testRollup(self):
+        for visitor in self.visitors:
+            self.record(visitor, datetime(2010, 1, 1, 12, 15))
+            self.record(visitor, datetime(2010, 1, 1, 12, 45))
+        self.record(self.visitors[0], datetime(2010, 1, 1, 13, 5))
+        self.assertEquals(4, rollup_goal_records(batch_size=4))
+        self.assertEquals(4, rollup_goal_records(batch_size=4))
+        self.assertEquals(1, rollup_goal_records(batch_size=4))
+        self.assertEquals(0, rollup_goal_records(batch_size=4))
+        noon = datetime(2010, 1, 1, 12)
+        expected = {("first", 0, noon): 4,
+                    ("first", 1, noon): 2,
+                    ("second", 0, noon): 2,
+                    ("second", 1, noon): 2,
+                    ("first", 0, datetime(2010, 1, 1, 13)): 1}
+        self.assertEquals(expected, self.get_counts())
+
+        # Later runs add to the existing counts.
+        self.record(self.visitors[1], datetime(2010, 1, 1, 12, 50))
+        self.assertEquals(1, rollup_goal_records())
+        expected[("first", 1, noon)] += 1
+        expected[("second", 1, noon)] += 1
+        self.assertEquals(expected, self.get_counts())
+
+    def testBeforeEnrollment(self):
+        Participant.objects.filter(anonymous_visitor=self.visitors[1]).update(
+            enrollment_date=date(2010, 1, 2))
+        self.record(self.visitors[1], datetime(2010, 1, 1, 12, 15))
+        self.record(self.visitors[1], datetime(2010, 1, 2, 12, 15))
+        self.assertEquals(2, rollup_goal_records())
+        noon = datetime(2010, 1, 2, 12)
+        self.assertEquals({("first", 1, noon): 1, ("second", 1, noon): 1},
+                          self.get_counts())
+
+    def testLateCommits(self):
+        # A goal record whose transaction commits after one with a higher id
+        # has been read.
+        GoalRecord.objects.create(id=101, anonymous_visitor=self.visitors[0],
+                                  goal_type=self.goal_type)
+        self.assertEquals(0, rollup_goal_records())
+        GoalRecord.objects.create(id=100, anonymous_visitor=self.visitors[0],
+                                  goal_type=self.goal_type)
+        # Once they are older than the lag, both are rolled up.
+        created = datetime.now() - timedelta(minutes=10)
+        GoalRecord.objects.update(created=created)
+        self.assertEquals(2, rollup_goal_records())
+        self.assertEquals(2, HourlyGoalRollup.objects.get().count)
+
+    def testCommand(self):
+        self.record(self.visitors[0], datetime(2010, 1, 1, 12, 15))
+        directory = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            call_command('rollup_goal_records', verbosity=0)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(directory)
+        self.assertEquals(1, HourlyGoalRollup.objects.get().count)
+
+
+class TestFirstConversions(TestCase):
+    def setUp(self):
+        self.signup = GoalType.objects.create(name="signup")
+        self.purchase = GoalType.objects.create(name="purchase")
+        self.visitors = [AnonymousVisitor.objects.create() for i in range(2)]
+
+    def record(self, visitor, goal_type, created):
+        goal_record = GoalRecord.objects.create(anonymous_visitor=visitor,
+                                                goal_type=goal_type)
+        goal_record.created = created
+        goal_record.save()
+
+    def get_first_conversions(self):
+        return dict(((c.anonymous_visitor_id, c.goal_type.name), c.created)
+                    for c in FirstConversion.objects.all())
+
+    def testCompaction(self):
+        for hour in (14, 12, 13):
+            self.record(self.visitors[0], self.signup,
+                        datetime(2010, 1, 1, hour))
+        self.record(self.visitors[1], self.signup, datetime(2010, 1, 2))
+        self.assertEquals(3, compact_goal_records(batch_size=3))
+        self.assertEquals(1, compact_goal_records(batch_size=3))
+        self.assertEquals(0, compact_goal_records(batch_size=3))
+        expected = {(self.visitors[0].id, "signup"): datetime(2010, 1, 1, 12),
+                    (self.visitors[1].id, "signup"): datetime(2010, 1, 2)}
+        self.assertEquals(expected, self.get_first_conversions())
+
+        # Later goal records only add first conversions, or move them back
+        # when they were stored late.
+        self.record(self.visitors[0], self.signup, datetime(2010, 1, 3))
+        self.record(self.visitors[0], self.purchase, datetime(2010, 1, 3))
+        self.record(self.visitors[1], self.signup, datetime(2010, 1, 1))
+        self.assertEquals(3, compact_goal_records())
+        expected[(self.visitors[0].id, "purchase")] = datetime(2010, 1, 3)
+        expected[(self.visitors[1].id, "signup")] = datetime(2010, 1, 1)
+        self.assertEquals(expected, self.get_first_conversions())
+
+    def testLateCommits(self):
+        # A goal record whose transaction commits after one with a higher id
+        # has been read.
+        GoalRecord.objects.create(id=101, anonymous_visitor=self.visitors[0],
+                                  goal_type=self.signup)
+        self.assertEquals(0, compact_goal_records())
+        GoalRecord.objects.create(id=100, anonymous_visitor=self.visitors[1],
+                                  goal_type=self.signup)
+        # Once they are older than the lag, both are compacted.
+        created = datetime.now() - timedelta(minutes=10)
+        GoalRecord.objects.update(created=created)
+        self.assertEquals(2, compact_goal_records())
+        self.assertEquals(2, FirstConversion.objects.count())
+
+    def testCommand(self):
+        self.record(self.visitors[0], self.signup, datetime(2010, 1, 1))
+        directory = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            call_command('compact_goal_records', verbosity=0)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(directory)
+        self.assertEquals(1, FirstConversion.objects.count())
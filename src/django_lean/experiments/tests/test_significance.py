@@ -3,6 +3,8 @@ import logging
 l = logging.getLogger(__name__)
 
 from django_lean.experiments.significance import chi_square_p_value
+from django_lean.experiments.stats import (RunningStats, mean, var,
+                                           ttest_ind, ttest_ind_from_stats)
 from django_lean.experiments.tests.utils import TestCase
 
 
@@ -23,3 +25,31 @@ class TestSignificance(TestCase):
         self.assertAlmostEqual(7.2646044251357011, chi_square_value)
         self.assertAlmostEqual(p_value, 0.00703267568724)
     
+    
+    def testRunningStats(self):
+        scores = [3.2, 2.5, 4.1, 0, 1e6 + 0.5, 1e6 + 1.5, 7]
+        stats = RunningStats()
+        self.assertEquals(0.0, stats.var())
+        for score in scores:
+            stats.push(score)
+        self.assertEquals(len(scores), stats.count)
+        self.assertAlmostEqual(mean(scores), stats.mean)
+        self.assertAlmostEqual(1.0, stats.var() / var(scores))
+        
+        stats = RunningStats()
+        stats.push(5)
+        self.assertEquals(0.0, stats.var())
+    
+    def testTTestFromStats(self):
+        a = [3.2, 2.5, 4.1, 0]
+        b = [0, 0.5, 0, 1.25, 0]
+        stats = [RunningStats(), RunningStats()]
+        for sample, sample_stats in zip((a, b), stats):
+            for score in sample:
+                sample_stats.push(score)
+        t_value, p_value = ttest_ind(a, b)
+        stats_t_value, stats_p_value = ttest_ind_from_stats(
+            stats[0].mean, stats[0].stdev(), stats[0].count,
+            stats[1].mean, stats[1].stdev(), stats[1].count)
+        self.assertAlmostEqual(t_value, stats_t_value)
+        self.assertAlmostEqual(p_value, stats_p_value)
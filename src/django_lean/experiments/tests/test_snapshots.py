@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+from datetime import date, datetime, timedelta
+
+from django.core.management.base import CommandError
+from django.utils.unittest import skipIf
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from django_lean.experiments.management.commands import snapshot_experiments
+from django_lean.experiments.models import (AnonymousVisitor, Experiment,
+                                            GoalRecord, GoalType, Participant)
+from django_lean.experiments.tests.utils import TestCase
+
+
+@skipIf(numpy is None, "NumPy is not installed")
+class TestSnapshots(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.experiment = Experiment.objects.create(
+            name="snapshot", start_date=date.today() - timedelta(days=5))
+        self.other_experiment = Experiment.objects.create(name="other")
+        self.signup = GoalType.objects.create(name="signup")
+        self.day = date.today() - timedelta(days=3)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def enroll(self, enrollment_date, group=Participant.TEST_GROUP):
+        visitor = AnonymousVisitor.objects.create()
+        participant = Participant.objects.create(anonymous_visitor=visitor,
+                                                 experiment=self.experiment,
+                                                 group=group)
+        participant.enrollment_date = enrollment_date
+        participant.save()
+        return visitor
+
+    def record(self, visitor, goal_type, day):
+        record = GoalRecord.objects.create(anonymous_visitor=visitor,
+                                           goal_type=goal_type)
+        record.created = datetime.combine(day, datetime.min.time())
+        record.save()
+
+    def snapshot(self):
+        snapshot_experiments.Command().handle(directory=self.directory,
+                                              verbosity=0)
+        return numpy.load(os.path.join(self.directory,
+                                       'experiment_%d.npz' %
+                                       self.experiment.id))
+
+    def testIncrementalUpdates(self):
+        early = self.enroll(self.day, Participant.CONTROL_GROUP)
+        self.record(early, self.signup, self.day - timedelta(days=1))
+        self.record(early, self.signup, self.day + timedelta(days=1))
+        snapshot = self.snapshot()
+        self.assertEquals([early.id], list(snapshot['visitor_ids']))
+        self.assertEquals([Participant.CONTROL_GROUP], list(snapshot['groups']))
+        self.assertEquals(numpy.datetime64(self.day),
+                          snapshot['enrollment_days'][0])
+        self.assertEquals([[numpy.datetime64(self.day + timedelta(days=1))]],
+                          snapshot['first_conversion_days'].tolist())
+
+        # A new participant whose goals were recorded before the previous
+        # snapshot, a new goal type and an earlier conversion arriving late.
+        late = AnonymousVisitor.objects.create()
+        self.record(late, self.signup, self.day + timedelta(days=1))
+        purchase = GoalType.objects.create(name="purchase")
+        self.record(early, self.signup, self.day)
+        self.record(early, purchase, self.day + timedelta(days=2))
+        participant = Participant.objects.create(anonymous_visitor=late,
+                                                 experiment=self.experiment,
+                                                 group=Participant.TEST_GROUP)
+        participant.enrollment_date = self.day + timedelta(days=2)
+        participant.save()
+        Participant.objects.create(anonymous_visitor=late,
+                                   experiment=self.other_experiment,
+                                   group=Participant.TEST_GROUP)
+
+        snapshot = self.snapshot()
+        self.assertEquals([early.id, late.id], list(snapshot['visitor_ids']))
+        self.assertEquals([u'signup', u'purchase'],
+                          list(snapshot['goal_type_names']))
+        days = snapshot['first_conversion_days']
+        self.assertEquals(numpy.datetime64(self.day), days[0, 0])
+        self.assertEquals(numpy.datetime64(self.day + timedelta(days=2)),
+                          days[0, 1])
+        # Goals achieved before enrolling do not count.
+        self.assertTrue(numpy.isnat(days[1]).all())
+        self.assertEquals(numpy.datetime64(self.day),
+                          snapshot['first_any_conversion_days'][0])
+        self.assertTrue(numpy.isnat(snapshot['first_any_conversion_days'][1]))
+        self.assertEquals(GoalRecord.objects.order_by('-id')[0].id,
+                          snapshot['last_goal_record_id'])
+
+    def testLateCommits(self):
+        visitor = self.enroll(self.day)
+        # A goal record whose transaction commits after one with a higher id
+        # has been read, and a participant enrolled today.
+        GoalRecord.objects.create(id=101, anonymous_visitor=visitor,
+                                  goal_type=self.signup)
+        self.enroll(date.today())
+        snapshot = self.snapshot()
+        self.assertEquals([visitor.id], list(snapshot['visitor_ids']))
+        self.assertEquals(0, snapshot['last_goal_record_id'])
+        GoalRecord.objects.create(id=100, anonymous_visitor=visitor,
+                                  goal_type=self.signup)
+        # Once it is older than the lag, the late goal record is read.
+        GoalRecord.objects.filter(id=100).update(created=datetime.combine(
+                self.day, datetime.min.time()))
+        GoalRecord.objects.filter(id=101).update(
+            created=datetime.now() - timedelta(minutes=10))
+        snapshot = self.snapshot()
+        self.assertEquals(numpy.datetime64(self.day),
+                          snapshot['first_any_conversion_days'][0])
+        self.assertEquals(101, snapshot['last_goal_record_id'])
+
+    def testArguments(self):
+        command = snapshot_experiments.Command()
+        self.assertRaises(CommandError, command.handle, verbosity=0)
+        self.assertRaises(CommandError, command.handle, "unknown",
+                          directory=self.directory, verbosity=0)
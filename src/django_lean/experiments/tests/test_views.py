@@ -1,17 +1,31 @@
 # -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+import csv
 from BeautifulSoup import BeautifulSoup
+from cStringIO import StringIO
 from datetime import date, timedelta
 
-from django.contrib.auth.models import User
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
 from django.core.urlresolvers import reverse
-from django.test.client import Client
+from django.test.client import Client, RequestFactory
+from django.utils import simplejson
 
 from django_lean.experiments.models import (Experiment, Participant,
                                             DailyEngagementReport,
                                             AnonymousVisitor,
                                             GoalType, DailyConversionReport,
                                             DailyConversionReportGoalData)
-from django_lean.experiments.tests.utils import TestCase
+from django_lean.experiments.reports import (EXPORT_FIELDS,
+                                             generate_report_rows)
+from django_lean.experiments.tests.utils import patch, TestCase
+from django_lean.experiments.views import (experiment_details,
+                                           experiment_details_etag,
+                                           export_reports,
+                                           get_report_window,
+                                           list_experiments,
+                                           list_experiments_etag)
 
 
 def get_tables(html):
@@ -274,3 +288,145 @@ class TestExperimentViews(object):
             self.assertEquals(response.status_code, 200)
             self.assertTrue(response.content.strip().lower() in ("test",
                                                                  "control"))
+
+
+class TestConditionalGet(TestCase):
+    def setUp(self):
+        self.experiment = Experiment(name="experiment")
+        self.experiment.save()
+        self.experiment.state = Experiment.ENABLED_STATE
+        self.experiment.save()
+        self.request = RequestFactory().get('/')
+        self.request.user = AnonymousUser()
+    
+    def testNotModified(self):
+        for view, etag_func, args, queries in (
+                (list_experiments, list_experiments_etag, (), 1),
+                (experiment_details, experiment_details_etag,
+                 ("experiment",), 4)):
+            request = RequestFactory().get(
+                '/', HTTP_IF_NONE_MATCH='"%s"' % etag_func(self.request, *args))
+            request.user = AnonymousUser()
+            # Answered without loading any report or rendering a template.
+            self.assertNumQueries(queries, lambda: self.assertEquals(
+                    304, view(request, *args).status_code))
+    
+    def testETagChanges(self):
+        etag = experiment_details_etag(self.request, "experiment")
+        list_etag = list_experiments_etag(self.request)
+        self.assertEquals(etag, experiment_details_etag(self.request,
+                                                        "experiment"))
+        DailyEngagementReport.objects.create(
+            date=days_ago(1), experiment=self.experiment, control_score=3.2,
+            test_score=2.3, control_group_size=3, test_group_size=5,
+            confidence=93.2)
+        self.assertNotEquals(etag, experiment_details_etag(self.request,
+                                                           "experiment"))
+        self.assertEquals(list_etag, list_experiments_etag(self.request))
+        etag = experiment_details_etag(self.request, "experiment")
+        self.experiment.state = Experiment.PROMOTED_STATE
+        self.experiment.save()
+        self.assertNotEquals(etag, experiment_details_etag(self.request,
+                                                           "experiment"))
+        self.assertNotEquals(list_etag, list_experiments_etag(self.request))
+        self.assertEquals(None, experiment_details_etag(self.request,
+                                                        "unknown"))
+
+
+class TestReportWindow(TestCase):
+    def getWindow(self, **params):
+        request = RequestFactory().get('/', params)
+        with patch(settings, 'LEAN_REPORT_PAGE_SIZE', 10):
+            return get_report_window(request.GET, date(2010, 1, 1),
+                                     date(2010, 3, 1))
+    
+    def testPages(self):
+        window = self.getWindow()
+        self.assertEquals((date(2010, 2, 20), date(2010, 3, 1)),
+                          (window["first"], window["last"]))
+        self.assertEquals((1, 6), (window["page"], window["pages"]))
+        self.assertEquals(None, window["previous_query"])
+        self.assertEquals("page=2", window["next_query"])
+        window = self.getWindow(page="6")
+        self.assertEquals((date(2010, 1, 1), date(2010, 1, 10)),
+                          (window["first"], window["last"]))
+        self.assertEquals(None, window["next_query"])
+        self.assertEquals(6, self.getWindow(page="60")["page"])
+        self.assertEquals(1, self.getWindow(page="last")["page"])
+    
+    def testWindow(self):
+        window = self.getWindow(start="2010-01-05", end="2010-01-09")
+        self.assertEquals((date(2010, 1, 5), date(2010, 1, 9)),
+                          (window["first"], window["last"]))
+        self.assertEquals(1, window["pages"])
+        window = self.getWindow(start="2009-01-01", end="tomorrow")
+        self.assertEquals((date(2010, 1, 1), date(2010, 3, 1)),
+                          (window["start"], window["end"]))
+    
+    def testWeeklySummary(self):
+        window = self.getWindow(summary="weekly")
+        self.assertEquals(7, window["step"])
+        self.assertEquals(1, window["pages"])
+        self.assertEquals((date(2010, 1, 1), date(2010, 3, 1)),
+                          (window["first"], window["last"]))
+        window = self.getWindow(summary="weekly", start="2009-06-01")
+        self.assertEquals(1, window["pages"])
+
+
+class TestExport(TestCase):
+    urls = 'experiments.tests.urls'
+    
+    def setUp(self):
+        goal_types = [GoalType.objects.create(name=name)
+                      for name in ("b_goal", "a_goal")]
+        for name in ("experiment 1", "experiment 2"):
+            experiment = Experiment.objects.create(name=name)
+            for i in range(1, 4):
+                DailyEngagementReport.objects.create(
+                    date=days_ago(i), experiment=experiment, control_score=3.2,
+                    test_score=2.3, control_group_size=3, test_group_size=5,
+                    confidence=None)
+                report = DailyConversionReport.objects.create(
+                    date=days_ago(i), experiment=experiment,
+                    overall_test_conversion=12, overall_control_conversion=i,
+                    test_group_size=39, control_group_size=27, confidence=87.4)
+                for goal_type in goal_types:
+                    DailyConversionReportGoalData.objects.create(
+                        report=report, goal_type=goal_type, test_conversion=11,
+                        control_conversion=7, confidence=45.3)
+    
+    def export(self, format, **params):
+        request = RequestFactory().get(
+            reverse('experiments_export_reports', args=[format]), params)
+        response = export_reports(request, format)
+        self.assertEquals(200, response.status_code)
+        return "".join(response)
+    
+    def testBatches(self):
+        experiments = list(Experiment.objects.order_by("name"))
+        rows = list(generate_report_rows(experiments))
+        self.assertEquals(2 * 3 * 4, len(rows))
+        self.assertEquals(rows, list(generate_report_rows(experiments,
+                                                          batch_size=2)))
+        self.assertEquals(("experiment 1", days_ago(3), "engagement", None,
+                           3, 5, 3.2, 2.3, None), rows[0])
+        self.assertEquals([None, "a_goal", "b_goal"],
+                          [row[3] for row in rows[3:6]])
+    
+    def testCSV(self):
+        rows = list(csv.reader(StringIO(self.export("csv"))))
+        self.assertEquals(list(EXPORT_FIELDS), rows[0])
+        self.assertEquals(1 + 2 * 3 * 4, len(rows))
+        self.assertEquals(["experiment 2", unicode(days_ago(1)), "conversion",
+                           "", "27", "39", "1", "12", "87.4"], rows[-3])
+    
+    def testJSON(self):
+        records = simplejson.loads(self.export("json",
+                                               experiment="experiment 2"))
+        self.assertEquals(3 * 4, len(records))
+        self.assertEquals({"experiment": "experiment 2",
+                           "date": days_ago(1).isoformat(),
+                           "report": "conversion", "goal_type": "b_goal",
+                           "control_group_size": 27, "test_group_size": 39,
+                           "control": 7, "test": 11, "confidence": 45.3},
+                          records[-1])
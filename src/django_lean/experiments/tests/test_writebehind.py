@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+import os
+import shutil
+import tempfile
+import Queue
+from datetime import date, datetime
+
+from django.conf import settings
+from django.core.management import call_command
+
+from django_lean.experiments.models import (AnonymousVisitor, Experiment,
+                                            GoalRecord, GoalType, Participant)
+from django_lean.experiments.tests.utils import patch, TestCase, TestUser
+from django_lean.experiments.writebehind import (BaseWriter, QueueWriter,
+                                                 SpoolWriter, drain_spool,
+                                                 get_writer, goal_event,
+                                                 participant_event,
+                                                 write_events, _writers)
+
+
+HASH_ASSIGNMENT = 'django_lean.experiments.assignment.HashAssignment'
+LIST_WRITER = 'django_lean.experiments.tests.test_writebehind.ListWriter'
+
+
+class ListWriter(BaseWriter):
+    def __init__(self):
+        self.events = []
+
+    def put(self, event):
+        self.events.append(event)
+
+
+class TestWriteBehind(TestCase):
+    def setUp(self):
+        _writers.pop(LIST_WRITER, None)
+        self.experiment = Experiment(name="buffered")
+        self.experiment.save()
+        self.experiment.state = Experiment.ENABLED_STATE
+        self.experiment.save()
+        self.goal_type = GoalType.objects.create(name="signup")
+        self.visitor = AnonymousVisitor.objects.create()
+
+    def testGoalRecordIsQueued(self):
+        user = TestUser(anonymous_visitor=self.visitor)
+        with patch(settings, 'LEAN_WRITE_BEHIND', LIST_WRITER):
+            writer = get_writer()
+            goal_record = GoalRecord.record("signup", user)
+        self.assertEquals(None, goal_record.id)
+        self.assertEquals(self.goal_type, goal_record.goal_type)
+        self.assertEquals(0, GoalRecord.objects.count())
+        self.assertEquals([goal_event(self.visitor.id, self.goal_type.id,
+                                      goal_record.created)],
+                          writer.events)
+
+        write_events(writer.events)
+        stored = GoalRecord.objects.get()
+        self.assertEquals(self.visitor, stored.anonymous_visitor)
+        self.assertEquals(goal_record.created, stored.created)
+
+    def testEnrollmentIsQueued(self):
+        user = TestUser(username="buffered_user")
+        with patch(settings, 'LEAN_GROUP_ASSIGNMENT', HASH_ASSIGNMENT):
+            with patch(settings, 'LEAN_WRITE_BEHIND', LIST_WRITER):
+                writer = get_writer()
+                in_test = Experiment.test("buffered", user)
+                # The group does not depend on the queued enrollment.
+                self.assertEquals(in_test, Experiment.test("buffered", user))
+        self.assertEquals(0, Participant.objects.count())
+        self.assertEquals(1, len(writer.events))
+
+        write_events(writer.events)
+        participant = Participant.objects.get()
+        self.assertEquals(user.user, participant.user)
+        self.assertEquals(in_test,
+                          participant.group == Participant.TEST_GROUP)
+
+    def testDuplicateEnrollments(self):
+        Participant.objects.create(anonymous_visitor=self.visitor,
+                                   experiment=self.experiment,
+                                   group=Participant.TEST_GROUP)
+        other_visitor = AnonymousVisitor.objects.create()
+        today = date.today()
+        write_events([
+            participant_event(self.experiment.id, Participant.CONTROL_GROUP,
+                              today, anonymous_visitor_id=self.visitor.id),
+            participant_event(self.experiment.id, Participant.CONTROL_GROUP,
+                              today, anonymous_visitor_id=other_visitor.id),
+            participant_event(self.experiment.id, Participant.TEST_GROUP,
+                              today, anonymous_visitor_id=other_visitor.id),
+        ])
+        self.assertEquals(Participant.TEST_GROUP,
+                          Participant.objects.get(
+                              anonymous_visitor=self.visitor).group)
+        self.assertEquals(Participant.CONTROL_GROUP,
+                          Participant.objects.get(
+                              anonymous_visitor=other_visitor).group)
+
+    def testQueueWriterFlush(self):
+        writer = QueueWriter()
+        # Stand in for _start() so that no background thread competes with
+        # the flush below.
+        writer.queue = Queue.Queue()
+        writer.pid = os.getpid()
+        created = datetime(2010, 1, 1, 12, 0)
+        for i in range(5):
+            writer.record_goal(self.visitor.id, self.goal_type.id, created)
+        writer.enroll(self.experiment.id, Participant.TEST_GROUP,
+                      date.today(), anonymous_visitor_id=self.visitor.id)
+        writer.flush()
+        self.assertTrue(writer.queue.empty())
+        self.assertEquals(5, GoalRecord.objects.filter(created=created).count())
+        self.assertEquals(1, Participant.objects.count())
+
+
+class TestSpool(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'events.spool')
+        self.experiment = Experiment(name="spooled")
+        self.experiment.save()
+        self.goal_type = GoalType.objects.create(name="signup")
+        self.visitor = AnonymousVisitor.objects.create()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def getWriter(self):
+        with patch(settings, 'LEAN_WRITE_BEHIND_SPOOL', self.path):
+            return SpoolWriter()
+
+    def testDrain(self):
+        writer = self.getWriter()
+        created = datetime(2010, 1, 1, 12, 0, 0, 500)
+        writer.record_goal(self.visitor.id, self.goal_type.id, created)
+        writer.enroll(self.experiment.id, Participant.TEST_GROUP,
+                      date(2010, 1, 1), anonymous_visitor_id=self.visitor.id)
+        writer.enroll(self.experiment.id, Participant.TEST_GROUP,
+                      date(2010, 1, 1), anonymous_visitor_id=self.visitor.id)
+        # A record cut short by a crashed writer, followed by a complete one.
+        open(self.path, 'a').write('["goal", 1')
+        writer.record_goal(self.visitor.id, self.goal_type.id, created)
+
+        self.assertEquals(4, drain_spool(self.path))
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(self.path + '.draining'))
+        self.assertEquals([created, created],
+                          [r.created for r in GoalRecord.objects.all()])
+        participant = Participant.objects.get()
+        self.assertEquals(self.visitor, participant.anonymous_visitor)
+        self.assertEquals(date(2010, 1, 1), participant.enrollment_date)
+        self.assertEquals(0, drain_spool(self.path))
+
+    def testNewSpoolAfterDrain(self):
+        writer = self.getWriter()
+        created = datetime(2010, 1, 1, 12, 0)
+        writer.record_goal(self.visitor.id, self.goal_type.id, created)
+        self.assertEquals(1, drain_spool(self.path))
+        writer.record_goal(self.visitor.id, self.goal_type.id, created)
+        writer.record_goal(self.visitor.id, self.goal_type.id, created)
+        self.assertEquals(2, len(open(self.path).readlines()))
+
+    def testInterruptedDrain(self):
+        writer = self.getWriter()
+        created = datetime(2010, 1, 1, 12, 0)
+        writer.record_goal(self.visitor.id, self.goal_type.id, created)
+        os.rename(self.path, self.path + '.draining')
+        writer.record_goal(self.visitor.id, self.goal_type.id, created)
+        # The left-over file is drained before the spool is touched.
+        self.assertEquals(1, drain_spool(self.path))
+        self.assertEquals(1, drain_spool(self.path))
+        self.assertEquals(2, GoalRecord.objects.count())
+
+    def testDrainCommand(self):
+        writer = self.getWriter()
+        writer.record_goal(self.visitor.id, self.goal_type.id,
+                           datetime(2010, 1, 1, 12, 0))
+        cwd = os.getcwd()
+        os.chdir(self.directory)
+        try:
+            with patch(settings, 'LEAN_WRITE_BEHIND_SPOOL', self.path):
+                call_command('drain_experiment_spool', verbosity=0)
+        finally:
+            os.chdir(cwd)
+        self.assertEquals(1, GoalRecord.objects.count())
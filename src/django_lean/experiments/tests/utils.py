@@ -10,6 +10,7 @@ from django.test import TestCase as DjangoTestCase
 from django.utils.importlib import import_module
 from django.utils.functional import LazyObject
 
+from django_lean.experiments.cache import experiment_cache, goal_type_cache
 from django_lean.experiments.loader import ExperimentLoader
 from django_lean.experiments.models import Participant
 from django_lean.lean_analytics import reset_caches
@@ -41,6 +42,8 @@ class TestCase(DjangoTestCase):
         self.original_LEAN_ANALYTICS = getattr(settings, 'LEAN_ANALYTICS', [])
         settings.LEAN_ANALYTICS = []
         reset_caches()
+        experiment_cache.invalidate()
+        goal_type_cache.invalidate()
 
     def _post_teardown(self):
         settings.LEAN_ANALYTICS = self.original_LEAN_ANALYTICS
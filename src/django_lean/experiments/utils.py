@@ -2,8 +2,10 @@
 import logging
 l = logging.getLogger(__name__)
 
-from django_lean.experiments.models import (AnonymousVisitor, Experiment,
-                                            Participant)
+from django_lean.experiments.assignment import (get_anonymous_identity,
+                                                get_assignment)
+from django_lean.experiments.cache import experiment_cache
+from django_lean.experiments.models import AnonymousVisitor, Participant
 
 
 class WebUser(object):
@@ -33,6 +35,19 @@ class WebUser(object):
     def is_verified_human(self):
         return self.session.get('verified_human', False)
 
+    def get_enrollment_cache(self):
+        """
+        Returns a dict used to memoize experiment enrollments for the rest of
+        the request. It is shared by every WebUser wrapping the same request.
+        """
+        if self.request is None:
+            return None
+        try:
+            return self.request.experiment_enrollments
+        except AttributeError:
+            self.request.experiment_enrollments = {}
+            return self.request.experiment_enrollments
+
     def get_or_create_anonymous_visitor(self):
         anonymous_visitor = None
         anonymous_id = self.get_anonymous_id()
@@ -55,11 +70,16 @@ class WebUser(object):
             return
 
         anonymous_visitor = self.get_or_create_anonymous_visitor()
+        assignment = get_assignment()
         for experiment_name, group_id in enrollments.items():
             try:
-                experiment = Experiment.objects.get(name=experiment_name)
+                experiment = experiment_cache.get(experiment_name)
             except:
                 continue
+            if assignment.deterministic:
+                # From now on the group is derived from the visitor.
+                group_id = assignment.assign(
+                    experiment, get_anonymous_identity(anonymous_visitor.id))
             try:
                 Participant.objects.create(anonymous_visitor=anonymous_visitor,
                                            experiment=experiment,
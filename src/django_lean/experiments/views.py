@@ -2,16 +2,31 @@
 import logging
 l = logging.getLogger(__name__)
 
-from datetime import date, timedelta
+import csv
+from cStringIO import StringIO
+from datetime import date, datetime, timedelta
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
 
+from django.conf import settings
+from django.db.models import Count, Max
 from django.http import HttpResponse
 from django.shortcuts import render_to_response, get_object_or_404
 from django.template import RequestContext
+from django.utils import simplejson
 from django.views.decorators.cache import never_cache
+from django.views.decorators.http import condition
 
-from django_lean.experiments.models import (Experiment, GoalRecord,
-                                            DailyEngagementReport)
-from django_lean.experiments.reports import get_conversion_data
+from django_lean.experiments.cache import live_counters
+from django_lean.experiments.models import (DailyConversionReport,
+                                            DailyEngagementReport, Experiment,
+                                            GoalRecord, GoalType)
+from django_lean.experiments.reports import (EXPORT_FIELDS,
+                                             generate_report_rows,
+                                             get_daily_data,
+                                             get_live_conversion_data)
 from django_lean.experiments.utils import WebUser
 
 
@@ -47,6 +62,39 @@ def record_experiment_goal(request, goal_name):
     
     return HttpResponse(TRANSPARENT_1X1_PNG, mimetype="image/png")
 
+def _etag(*values):
+    return md5(repr(values)).hexdigest()
+
+def list_experiments_etag(request, *args, **kwargs):
+    """
+    Returns an ETag for the experiment list, which only changes when an
+    experiment is added, removed or changes state.
+    """
+    return _etag(request.user.id, list(Experiment.objects.order_by(
+                "id").values_list("id", "name", "state", "start_date",
+                                  "end_date")))
+
+def experiment_details_etag(request, experiment_name, *args, **kwargs):
+    """
+    Returns an ETag for the details of an experiment, which changes with the
+    experiment's state, its reports, the goal types and the current date.
+    """
+    experiment = list(Experiment.objects.filter(
+            name=experiment_name).values_list("id", "state", "start_date",
+                                              "end_date"))
+    if not experiment:
+        return None
+    experiment_id = experiment[0][0]
+    reports = [model.objects.filter(experiment=experiment_id).aggregate(
+            Max("id"), Count("id"))
+               for model in (DailyEngagementReport, DailyConversionReport)]
+    goal_types = GoalType.objects.aggregate(Max("id"), Count("id"))
+    return _etag(request.user.id, date.today(), sorted(request.GET.items()),
+                 experiment,
+                 sorted(reports[0].items()), sorted(reports[1].items()),
+                 sorted(goal_types.items()))
+
+@condition(etag_func=list_experiments_etag)
 def list_experiments(request, template_name='experiments/list_experiments.html'):
     """docstring for list_experiments"""
     context_var = {"experiments": Experiment.objects.order_by("-start_date"),
@@ -57,6 +105,57 @@ def list_experiments(request, template_name='experiments/list_experiments.html')
     return render_to_response(template_name, context_var,
                               context_instance=RequestContext(request))
 
+def _parse_date(value):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except (TypeError, ValueError):
+        return None
+
+def get_report_window(params, first_date, last_date):
+    """
+    Returns the part of the reports between first_date and last_date that
+    the "start", "end", "page" and "summary" request parameters ask for:
+    {
+      "start", "end" (the requested date range),
+      "first", "last" (the range of dates shown on the page),
+      "step" (7 for a weekly summary, 1 otherwise),
+      "page", "pages",
+      "previous_query", "next_query" (the parameters of adjacent pages)
+    }
+    Pages hold LEAN_REPORT_PAGE_SIZE (default 30) reports, most recent
+    first. A weekly summary shows the cumulative report of every 7th day.
+    """
+    start = max(_parse_date(params.get("start")) or first_date, first_date)
+    end = min(_parse_date(params.get("end")) or last_date, last_date)
+    step = 1
+    if params.get("summary") == "weekly":
+        step = 7
+    page_size = getattr(settings, "LEAN_REPORT_PAGE_SIZE", 30)
+    count = max((end - start).days // step + 1, 0)
+    pages = max((count + page_size - 1) // page_size, 1)
+    try:
+        page = min(max(int(params.get("page", 1)), 1), pages)
+    except ValueError:
+        page = 1
+    last = end - timedelta(days=(page - 1) * page_size * step)
+    first = max(start, last - timedelta(days=(page_size - 1) * step))
+    
+    def query(page):
+        query = params.copy()
+        query["page"] = page
+        return query.urlencode()
+    
+    return {"start": start,
+            "end": end,
+            "first": first,
+            "last": last,
+            "step": step,
+            "page": page,
+            "pages": pages,
+            "previous_query": page > 1 and query(page - 1) or None,
+            "next_query": page < pages and query(page + 1) or None}
+
+@condition(etag_func=experiment_details_etag)
 def experiment_details(request, experiment_name,
                        template_name="experiments/experiment_details.html"):
     """
@@ -96,11 +195,16 @@ def experiment_details(request, experiment_name,
                 }
                }
              })
+        "window" (as returned by get_report_window, or None if the
+                  experiment has not been started)
     
+    Only the reports of the page of dates selected by the "start", "end",
+    "page" and "summary" parameters are loaded.
     """
     experiment = get_object_or_404(Experiment, name=experiment_name)
     
     daily_data = []
+    window = None
     
     start_date = experiment.start_date
     if experiment.start_date:
@@ -112,43 +216,104 @@ def experiment_details(request, experiment_name,
                 end_date = experiment.end_date
         else:
             end_date = date.today() - timedelta(days=1)
-        current_date = end_date
-        while current_date >= start_date:
-            daily_engagement_data = None
-            daily_conversion_data = None
-            engagement_report = None
-            conversion_report = None
-            try:
-                engagement_report = DailyEngagementReport.objects.get(experiment=experiment,
-                                                                  date=current_date)
-            except:
-                l.warn("No engagement report for date %s and experiment %s" %
-                       (current_date, experiment.name))
-            daily_conversion_data = get_conversion_data(experiment, current_date)
-            
-            if engagement_report:
-                improvement = None
-                
-                if engagement_report.control_score > 0:
-                    improvement = ((engagement_report.test_score -
-                                    engagement_report.control_score) /
-                                   engagement_report.control_score) * 100
-                daily_engagement_data = {
-                    "control_group_size": engagement_report.control_group_size,
-                    "control_group_score": engagement_report.control_score,
-                    "test_group_size": engagement_report.test_group_size,
-                    "test_group_score": engagement_report.test_score,
-                    "test_group_improvement": improvement,
-                    "confidence": engagement_report.confidence}
-            daily_data.append({
-                    "date": current_date,
-                    "conversion_data": daily_conversion_data,
-                    "engagement_data": daily_engagement_data})
-            current_date = current_date - timedelta(1)
+        window = get_report_window(request.GET, start_date, end_date)
+        if window["first"] <= window["last"]:
+            daily_data = get_daily_data(experiment, window["first"],
+                                        window["last"], window["step"])
     context_var = {"experiment": experiment,
                    "daily_data": daily_data,
+                   "window": window,
                    "experiment_states": experiment_states,
                    "root_path": "../../",
                    "title": "Experiment Report"}
     return render_to_response(template_name, context_var,
                               context_instance=RequestContext(request))
+
+@never_cache
+def live_experiment(request, experiment_name,
+                    template_name="experiments/live_experiment.html"):
+    """
+    Displays today's approximate conversion rates of an experiment, read
+    from the live counters rather than from the reports or raw tables.
+    Exposes:
+        "experiment" (the experiment model)
+        "day" (today)
+        "enabled" (whether LEAN_LIVE_COUNTERS is enabled)
+        "daily_data" (a single item array, as in experiment_details,
+                      without engagement data)
+    """
+    experiment = get_object_or_404(Experiment, name=experiment_name)
+    today = date.today()
+    daily_data = []
+    if live_counters.is_enabled():
+        daily_data.append({
+                "date": today,
+                "conversion_data": get_live_conversion_data(experiment,
+                                                            today)})
+    context_var = {"experiment": experiment,
+                   "day": today,
+                   "enabled": live_counters.is_enabled(),
+                   "daily_data": daily_data,
+                   "root_path": "../../../",
+                   "title": "Live Experiment Data"}
+    return render_to_response(template_name, context_var,
+                              context_instance=RequestContext(request))
+
+def _buffered(chunks, size=8192):
+    """Joins `chunks` into strings of at least `size` bytes."""
+    buffer = []
+    length = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield "".join(buffer)
+            buffer = []
+            length = 0
+    if buffer:
+        yield "".join(buffer)
+
+def _csv_export(rows):
+    output = StringIO()
+    writer = csv.writer(output)
+    writer.writerow(EXPORT_FIELDS)
+    for row in rows:
+        writer.writerow([value is not None and unicode(value).encode("utf-8")
+                         or "" for value in row])
+        yield output.getvalue()
+        output.seek(0)
+        output.truncate()
+
+def _json_export(rows):
+    yield "["
+    separator = "\n"
+    for row in rows:
+        record = dict(zip(EXPORT_FIELDS, row))
+        record["date"] = record["date"].isoformat()
+        yield separator + simplejson.dumps(record)
+        separator = ",\n"
+    yield "\n]\n"
+
+EXPORT_FORMATS = {
+    "csv": (_csv_export, "text/csv; charset=utf-8"),
+    "json": (_json_export, "application/json")
+}
+
+def export_reports(request, format):
+    """
+    Streams the daily reports of the experiments named by the "experiment"
+    parameters (all experiments by default) as CSV or JSON, with one record
+    of EXPORT_FIELDS per report and goal type.
+    """
+    experiments = Experiment.objects.order_by("name")
+    names = request.GET.getlist("experiment")
+    if names:
+        experiments = experiments.filter(name__in=names)
+    export, mimetype = EXPORT_FORMATS[format]
+    response = HttpResponse(
+        _buffered(export(generate_report_rows(list(experiments)))),
+        mimetype=mimetype)
+    response["Content-Disposition"] = ("attachment; "
+                                       "filename=experiment_reports.%s" %
+                                       format)
+    return response
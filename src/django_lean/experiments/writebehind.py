@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+"""
+Write-behind buffering of goal records and enrollments.
+
+When LEAN_WRITE_BEHIND names a writer class, GoalRecord.record() and new
+enrollments no longer INSERT rows inside the request. The events are handed
+to the writer instead, which stores them in batches:
+
+LEAN_WRITE_BEHIND = 'django_lean.experiments.writebehind.QueueWriter'
+
+QueueWriter keeps the events in memory. SpoolWriter appends them to a spool
+file instead, which the drain_experiment_spool management command writes to
+the database.
+"""
+import logging
+l = logging.getLogger(__name__)
+
+import atexit
+import os
+import threading
+import time
+import Queue
+from datetime import datetime
+from errno import ENOENT
+from fcntl import lockf, LOCK_EX, LOCK_SH, LOCK_UN
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.urlresolvers import get_callable
+from django.db import DatabaseError, transaction
+from django.utils import simplejson
+
+from django_lean.experiments.models import GoalRecord, Participant
+from django_lean.utils import bulk_insert
+
+
+GOAL = 'goal'
+PARTICIPANT = 'participant'
+
+GOAL_FIELDS = ('anonymous_visitor', 'goal_type', 'created')
+PARTICIPANT_FIELDS = ('experiment', 'group', 'user', 'anonymous_visitor',
+                      'enrollment_date')
+
+DATE_FORMAT = '%Y-%m-%d'
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+_writers = {}
+
+def get_writer():
+    """
+    Returns the writer named by LEAN_WRITE_BEHIND, or None if goal records
+    and enrollments should be written synchronously.
+    """
+    name = getattr(settings, 'LEAN_WRITE_BEHIND', None)
+    if not name:
+        return None
+    writer = _writers.get(name)
+    if writer is None:
+        writer = _writers.setdefault(name, get_callable(name)())
+    return writer
+
+
+def goal_event(anonymous_visitor_id, goal_type_id, created):
+    return (GOAL, anonymous_visitor_id, goal_type_id, created)
+
+def participant_event(experiment_id, group, enrollment_date, user_id=None,
+                      anonymous_visitor_id=None):
+    return (PARTICIPANT, experiment_id, group, user_id, anonymous_visitor_id,
+            enrollment_date)
+
+def encode_event(event):
+    """Returns `event` as a line of JSON."""
+    if event[0] == GOAL:
+        event = event[:3] + (event[3].strftime(DATETIME_FORMAT),)
+    elif event[0] == PARTICIPANT:
+        event = event[:5] + (event[5].strftime(DATE_FORMAT),)
+    return simplejson.dumps(event) + '\n'
+
+def decode_event(line):
+    """Returns the event encoded in `line` by encode_event()."""
+    event = tuple(simplejson.loads(line))
+    if event[0] == GOAL:
+        event = event[:3] + (datetime.strptime(event[3], DATETIME_FORMAT),)
+    elif event[0] == PARTICIPANT:
+        event = event[:5] + (
+            datetime.strptime(event[5], DATE_FORMAT).date(),)
+    return event
+
+def _decode_spool_line(line):
+    """
+    Returns the event of a spool line, or None, and whether part of the line
+    was skipped. A writer that crashed while appending leaves a record cut
+    short, to which the next record is appended, so the line is decoded
+    again from the start of each later record until one is found.
+    """
+    start = 0
+    while start != -1:
+        try:
+            return decode_event(line[start:]), start > 0
+        except ValueError:
+            start = line.find('["', start + 1)
+    return None, True
+
+def _existing_participants(participants, column):
+    """
+    Returns the (experiment id, `column` id) pairs of `participants` which are
+    already stored.
+    """
+    index = list(PARTICIPANT_FIELDS).index(column)
+    ids = set(p[index] for p in participants if p[index] is not None)
+    if not ids:
+        return set()
+    experiment_ids = set(p[0] for p in participants)
+    filters = {'experiment__in': experiment_ids, '%s__in' % column: ids}
+    return set(Participant.objects.filter(**filters).values_list('experiment',
+                                                                 column))
+
+def _insert(model, fields, rows):
+    """
+    Inserts `rows` in batches. If a batch is rejected (for instance because
+    a row refers to a deleted anonymous visitor), falls back to inserting
+    the rows one by one, dropping the rejected ones.
+    """
+    try:
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            bulk_insert(model, fields, rows)
+            transaction.commit()
+            return
+        except DatabaseError:
+            transaction.rollback()
+            for row in rows:
+                try:
+                    bulk_insert(model, fields, [row])
+                    transaction.commit()
+                except DatabaseError:
+                    transaction.rollback()
+                    l.exception("Dropping %s row %r" %
+                                (model._meta.object_name, row))
+    finally:
+        transaction.leave_transaction_management()
+
+def write_events(events):
+    """
+    Stores goal and enrollment events with batched INSERTs.
+
+    Enrollments which are already stored, or which appear more than once in
+    `events`, are only written once to honour the unique constraints on
+    Participant.
+    """
+    goals = []
+    participants = []
+    seen = set()
+    for event in events:
+        if event[0] == GOAL:
+            goals.append(event[1:])
+        elif event[0] == PARTICIPANT:
+            participant = event[1:]
+            (experiment_id, group, user_id, anonymous_visitor_id,
+             enrollment_date) = participant
+            if user_id is not None:
+                key = (experiment_id, 'user', user_id)
+            else:
+                key = (experiment_id, 'anonymous_visitor',
+                       anonymous_visitor_id)
+            if key not in seen:
+                seen.add(key)
+                participants.append(participant)
+        else:
+            l.warning("Ignoring unknown event %r" % (event,))
+
+    if participants:
+        existing_users = _existing_participants(participants, 'user')
+        existing_visitors = _existing_participants(participants,
+                                                   'anonymous_visitor')
+        participants = [p for p in participants
+                        if (p[0], p[2]) not in existing_users and
+                           (p[0], p[3]) not in existing_visitors]
+        _insert(Participant, PARTICIPANT_FIELDS, participants)
+    if goals:
+        _insert(GoalRecord, GOAL_FIELDS, goals)
+
+
+class BaseWriter(object):
+    def record_goal(self, anonymous_visitor_id, goal_type_id, created):
+        self.put(goal_event(anonymous_visitor_id, goal_type_id, created))
+
+    def enroll(self, experiment_id, group, enrollment_date, user_id=None,
+               anonymous_visitor_id=None):
+        self.put(participant_event(experiment_id, group, enrollment_date,
+                                   user_id=user_id,
+                                   anonymous_visitor_id=anonymous_visitor_id))
+
+    def put(self, event):
+        raise NotImplementedError()
+
+    def flush(self):
+        pass
+
+
+class QueueWriter(BaseWriter):
+    """
+    Buffers events in an in-process queue, which a background thread drains
+    into the database every LEAN_WRITE_BEHIND_INTERVAL seconds (default 1),
+    or as soon as LEAN_WRITE_BEHIND_BATCH_SIZE events (default 1000) are
+    waiting.
+
+    Events still in the queue when the process exits are flushed by an
+    atexit handler, but are lost if the process is killed. If more than
+    LEAN_WRITE_BEHIND_QUEUE_SIZE events (default 100000) are waiting, new
+    events are written synchronously.
+    """
+    def __init__(self):
+        self.interval = getattr(settings, 'LEAN_WRITE_BEHIND_INTERVAL', 1)
+        self.batch_size = getattr(settings, 'LEAN_WRITE_BEHIND_BATCH_SIZE',
+                                  1000)
+        self.queue_size = getattr(settings, 'LEAN_WRITE_BEHIND_QUEUE_SIZE',
+                                  100000)
+        self.lock = threading.Lock()
+        self.pid = None
+        atexit.register(self.flush)
+
+    def _start(self):
+        # Threads do not survive a fork, so each process starts its own.
+        if self.pid == os.getpid():
+            return
+        self.lock.acquire()
+        try:
+            if self.pid != os.getpid():
+                self.queue = Queue.Queue(self.queue_size)
+                thread = threading.Thread(target=self._run,
+                                          name='django-lean write-behind')
+                thread.setDaemon(True)
+                thread.start()
+                self.pid = os.getpid()
+        finally:
+            self.lock.release()
+
+    def put(self, event):
+        self._start()
+        try:
+            self.queue.put_nowait(event)
+        except Queue.Full:
+            l.warning("Write-behind queue is full; writing synchronously")
+            write_events([event])
+
+    def _get_batch(self, block=True):
+        """
+        Returns up to batch_size queued events. When `block` is True, waits
+        for a first event, then for up to `interval` seconds for more.
+        """
+        events = []
+        try:
+            if block:
+                events.append(self.queue.get())
+            deadline = time.time() + self.interval
+            while len(events) < self.batch_size:
+                timeout = deadline - time.time()
+                if block and timeout > 0:
+                    events.append(self.queue.get(timeout=timeout))
+                else:
+                    events.append(self.queue.get_nowait())
+        except Queue.Empty:
+            pass
+        return events
+
+    def _write(self, events):
+        try:
+            write_events(events)
+        except Exception:
+            l.exception("Unable to write %d events" % len(events))
+
+    def _run(self):
+        while True:
+            self._write(self._get_batch())
+
+    def flush(self):
+        """Synchronously writes all the events currently queued."""
+        if self.pid != os.getpid():
+            return
+        while True:
+            events = self._get_batch(block=False)
+            if not events:
+                break
+            self._write(events)
+
+
+def get_spool_path():
+    path = getattr(settings, 'LEAN_WRITE_BEHIND_SPOOL', None)
+    if not path:
+        raise ImproperlyConfigured("LEAN_WRITE_BEHIND_SPOOL must name the "
+                                   "spool file.")
+    return os.path.abspath(path)
+
+
+class SpoolWriter(BaseWriter):
+    """
+    Appends events, one JSON record per line, to the spool file named by
+    LEAN_WRITE_BEHIND_SPOOL, so that they survive process restarts until
+    the drain_experiment_spool command writes them to the database.
+
+    LEAN_WRITE_BEHIND_FSYNC controls when the spool is flushed to disk:
+    'always' (the default) after every event, 'never' leaves it to the
+    operating system, and a number of seconds flushes at most that often.
+    Events that have not been flushed survive a process crash, but not a
+    crash of the machine.
+
+    Each event is appended under a shared lock. The drain renames the spool
+    and then waits for an exclusive lock, so writers that find the spool
+    renamed once they hold the lock start a new one.
+    """
+    def __init__(self):
+        self.path = get_spool_path()
+        self.fsync = getattr(settings, 'LEAN_WRITE_BEHIND_FSYNC', 'always')
+        self.lock = threading.Lock()
+        self.fd = None
+        self.pid = None
+        self.next_sync = 0
+
+    def _get_fd(self):
+        if self.fd is None or self.pid != os.getpid():
+            self.fd = os.open(self.path,
+                              os.O_RDWR | os.O_APPEND | os.O_CREAT, 0666)
+            self.pid = os.getpid()
+        return self.fd
+
+    def _is_current(self, fd):
+        """Returns True if `fd` is still open on the spool file."""
+        try:
+            current = os.stat(self.path)
+        except OSError, e:
+            if e.errno == ENOENT:
+                return False
+            raise
+        opened = os.fstat(fd)
+        return (current.st_dev, current.st_ino) == (opened.st_dev,
+                                                    opened.st_ino)
+
+    def _sync(self, fd):
+        if self.fsync == 'always':
+            os.fsync(fd)
+        elif self.fsync != 'never' and time.time() >= self.next_sync:
+            os.fsync(fd)
+            self.next_sync = time.time() + self.fsync
+
+    def put(self, event):
+        line = encode_event(event)
+        self.lock.acquire()
+        try:
+            while True:
+                fd = self._get_fd()
+                lockf(fd, LOCK_SH)
+                try:
+                    if self._is_current(fd):
+                        os.write(fd, line)
+                        self._sync(fd)
+                        return
+                finally:
+                    lockf(fd, LOCK_UN)
+                # The spool is being drained; start a new one.
+                os.close(fd)
+                self.fd = None
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        self.lock.acquire()
+        try:
+            if self.fd is not None and self.pid == os.getpid():
+                os.fsync(self.fd)
+        finally:
+            self.lock.release()
+
+
+def drain_spool(path, batch_size=1000):
+    """
+    Writes the events spooled in `path` to the database in batches of
+    `batch_size`, and returns the number of events read.
+
+    The spool is renamed to `path`.draining first, and is only removed once
+    all of its events are written. If a drain is interrupted, the next one
+    starts over from that file: its enrollments are deduplicated, but its
+    goal records may be written twice. Records cut short by a crashed
+    writer are dropped, and their number is logged.
+    """
+    draining = path + '.draining'
+    if not os.path.exists(draining):
+        try:
+            os.rename(path, draining)
+        except OSError, e:
+            if e.errno == ENOENT:
+                return 0
+            raise
+    f = open(draining, 'r+')
+    try:
+        # Wait for writers that opened the spool before it was renamed.
+        lockf(f.fileno(), LOCK_EX)
+        count = 0
+        dropped = 0
+        events = []
+        for line in f:
+            event, skipped = _decode_spool_line(line)
+            if skipped:
+                dropped += 1
+            if event is None:
+                continue
+            events.append(event)
+            count += 1
+            if len(events) >= batch_size:
+                write_events(events)
+                events = []
+        if events:
+            write_events(events)
+        if dropped:
+            l.warning("Dropped %d malformed records from %s" % (dropped,
+                                                                 draining))
+        os.unlink(draining)
+    finally:
+        f.close()
+    return count
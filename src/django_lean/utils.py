@@ -2,7 +2,7 @@ from contextlib import contextmanager
 
 from django.contrib.sites.models import Site
 from django.core import mail
-from django.db import transaction
+from django.db import connections, router, transaction
 from django.utils.functional import LazyObject
 
 
@@ -20,6 +20,36 @@ def in_transaction(test_ignore=True):
     return result
 
 
+def bulk_insert(model, fields, rows, batch_size=100, using=None):
+    """
+    Inserts `rows`, each a sequence of values for the model fields named in
+    `fields`, using multi-row INSERT statements of at most `batch_size` rows.
+
+    Unlike QuerySet.bulk_create(), values given for `auto_now_add` fields are
+    stored as-is, and no model instances need to be built.
+    """
+    if using is None:
+        using = router.db_for_write(model)
+    connection = connections[using]
+    quote_name = connection.ops.quote_name
+    model_fields = [model._meta.get_field(name) for name in fields]
+    columns = ', '.join([quote_name(f.column) for f in model_fields])
+    placeholder = '(%s)' % ', '.join(['%s'] * len(model_fields))
+    rows = list(rows)
+    cursor = connection.cursor()
+    for i in range(0, len(rows), batch_size):
+        batch = rows[i:i + batch_size]
+        params = []
+        for row in batch:
+            params.extend([f.get_db_prep_save(value, connection=connection)
+                           for f, value in zip(model_fields, row)])
+        cursor.execute('INSERT INTO %s (%s) VALUES %s' %
+                       (quote_name(model._meta.db_table), columns,
+                        ', '.join([placeholder] * len(batch))),
+                       params)
+    transaction.commit_unless_managed(using=using)
+
+
 @contextmanager
 def patch(namespace, name, function):
     """Patches `namespace`.`name` with `function`."""